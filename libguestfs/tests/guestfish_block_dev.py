@@ -7,6 +7,9 @@ import shutil
 import os
 import re
 
+from provider import guestfs_session
+from provider import guestfs_utils
+
 
 def prepare_image(params):
     """
@@ -33,7 +36,7 @@ def test_blockdev_flushbufs(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = params.get("gf_add_readonly", "no")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -64,7 +67,7 @@ def test_blockdev_set_get_ro_rw(vm, params):
     gf_result = []
     expect_result = ['false', 'true', 'false']
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -91,7 +94,7 @@ def test_blockdev_getsz(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = params.get("gf_add_readonly", "no")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -118,7 +121,7 @@ def test_blockdev_getbsz(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = params.get("gf_add_readonly", "no")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -140,7 +143,7 @@ def test_blockdev_getss(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = params.get("gf_add_readonly", "no")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -162,7 +165,7 @@ def test_blockdev_getsize64(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = params.get("gf_add_readonly", "no")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -189,7 +192,7 @@ def test_blockdev_rereadpt(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = params.get("gf_add_readonly", "no")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
     # add three disks here
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -211,7 +214,7 @@ def test_canonical_device_name(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = params.get("gf_add_readonly", "no")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -251,7 +254,7 @@ def test_device_index(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = params.get("gf_add_readonly", "no")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
     # add three disks here
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -276,7 +279,7 @@ def test_list_devices(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = params.get("gf_add_readonly", "no")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
     # add three disks here
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -303,7 +306,7 @@ def test_disk_format(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = params.get("gf_add_readonly", "no")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -338,7 +341,7 @@ def test_max_disks(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = params.get("gf_add_readonly", "no")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -359,7 +362,7 @@ def test_nr_devices(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = params.get("gf_add_readonly", "no")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -380,7 +383,7 @@ def test_list_partitions(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = params.get("gf_add_readonly", "no")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -413,7 +416,7 @@ def test_disk_has_backing_file(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = params.get("gf_add_readonly", "no")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -455,7 +458,7 @@ def test_disk_virtual_size(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = params.get("gf_add_readonly", "no")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -489,7 +492,7 @@ def test_scrub_device(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = params.get("gf_add_readonly", "no")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -558,7 +561,7 @@ def test_scrub_file(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = params.get("gf_add_readonly", "no")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -589,7 +592,7 @@ def test_scrub_freespace(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = params.get("gf_add_readonly", "no")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -638,7 +641,7 @@ def test_md_test(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = params.get("gf_add_readonly", "no")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
 
@@ -708,7 +711,7 @@ def test_part_add(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = params.get("gf_add_readonly", "no")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -752,7 +755,7 @@ def test_part_del(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = params.get("gf_add_readonly", "no")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -801,7 +804,7 @@ def test_part_init(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = params.get("gf_add_readonly", "no")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -843,7 +846,7 @@ def test_part_set_get_bootable(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = params.get("gf_add_readonly", "no")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -870,7 +873,7 @@ def test_part_set_get_mbr_id(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = params.get("gf_add_readonly", "no")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -897,7 +900,7 @@ def test_part_disk(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = params.get("gf_add_readonly", "no")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -931,7 +934,7 @@ def test_part_to_dev(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = params.get("gf_add_readonly", "no")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -959,7 +962,7 @@ def test_part_to_partnum(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = params.get("gf_add_readonly", "no")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -989,7 +992,7 @@ def test_sfdisk(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = params.get("gf_add_readonly", "no")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -1031,7 +1034,7 @@ def test_sfdiskM(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = params.get("gf_add_readonly", "no")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -1063,7 +1066,7 @@ def test_sfdisk_N(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = params.get("gf_add_readonly", "no")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -1102,7 +1105,7 @@ def test_sfdisk_disk_geometry(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = params.get("gf_add_readonly", "no")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -1127,7 +1130,7 @@ def test_sfdisk_kernel_geometry(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = params.get("gf_add_readonly", "no")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -1167,13 +1170,6 @@ def run(test, params, env):
 
     operation = params.get("guestfish_function")
     testcase = globals()["test_%s" % operation]
-    partition_types = params.get("partition_types")
     fs_types = params.get("fs_types")
-    image_formats = params.get("image_formats")
-
-    for image_format in re.findall("\w+", image_formats):
-        params["image_format"] = image_format
-        for partition_type in re.findall("\w+", partition_types):
-            params["partition_type"] = partition_type
-            prepare_image(params)
-            testcase(vm, params)
+
+    guestfs_utils.run_combinations(testcase, vm, params, prepare_image)
@@ -4,11 +4,14 @@ from virttest.tests import unattended_install
 import logging
 import shutil
 import os
-import re
 import random
 import string
 import hashlib
 
+from provider import guestfs_batch
+from provider import guestfs_session
+from provider import guestfs_utils
+
 
 def prepare_image(params):
     """
@@ -41,7 +44,7 @@ def test_chmod(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = params.get("gf_add_readonly", "no")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -92,7 +95,7 @@ def test_chown(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = params.get("gf_add_readonly", "no")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -131,7 +134,7 @@ def test_lchown(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = params.get("gf_add_readonly", "no")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -170,7 +173,7 @@ def test_du(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = params.get("gf_add_readonly", "no")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -191,7 +194,7 @@ def test_file(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = params.get("gf_add_readonly", "no")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -224,7 +227,7 @@ def test_file_architecture(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = params.get("gf_add_readonly", "no")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -254,7 +257,7 @@ def test_filesize(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = params.get("gf_add_readonly", "no")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -286,7 +289,7 @@ def test_stat(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = params.get("gf_add_readonly", "no")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -318,7 +321,7 @@ def test_lstat(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = params.get("gf_add_readonly", "no")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -350,7 +353,7 @@ def test_lstatlist(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = params.get("gf_add_readonly", "no")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -382,7 +385,7 @@ def test_touch(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = params.get("gf_add_readonly", "no")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -414,7 +417,7 @@ def test_umask(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = params.get("gf_add_readonly", "no")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -506,7 +509,7 @@ def test_cat(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = params.get("gf_add_readonly", "no")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -533,7 +536,7 @@ def test_checksum(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = params.get("gf_add_readonly", "no")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -580,7 +583,7 @@ def test_checksum_device(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = params.get("gf_add_readonly", "no")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -619,7 +622,9 @@ def test_checksums_out(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = params.get("gf_add_readonly", "no")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    # Nothing depends on the output of an earlier command, so all of them
+    # can run as one batch.
+    gf = guestfs_batch.GuestfishBatch(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -642,9 +647,18 @@ def test_checksums_out(vm, params):
     gf.cp_a('/file_ops/file_elf', '/test/subdir/')
     gf.download('/test/subdir/file_elf', '/tmp/file_elf')
     gf.download('/test/file_ascii', '/tmp/file_ascii')
+    for k in checksum_map:
+        gf.checksums_out(k, '/test', '/tmp/sumsfile.%s' % k)
+    perfect_result = gf.checksums_out('perfect', '/test', '/tmp/sumsfile')
+    gf.rm_rf('/test')
+    results = gf.execute(ignore_status=True)
+    for result in results:
+        if result is not perfect_result and result.exit_status:
+            raise error.TestFail("%s failed: %s" % (result.command,
+                                                    result.stderr))
+
     for k, v in checksum_map.items():
-        gf_result = gf.checksums_out(k, '/test', '/tmp/sumsfile').stdout.strip()
-        run_result = utils.run("cat /tmp/sumsfile").stdout.split()
+        run_result = utils.run("cat /tmp/sumsfile.%s" % k).stdout.split()
         if k == 'crc':
             run_result[2] = os.path.basename(run_result[2])
             run_result[5] = os.path.basename(run_result[5])
@@ -664,17 +678,12 @@ def test_checksums_out(vm, params):
             run_result[3] = os.path.basename(run_result[3])
             host_res = dict(zip(run_result[1::2], run_result[0::2]))
         if cmp(guest_res, host_res) != 0:
-            gf.close_session()
             raise error.TestFail("checksum failed.")
+        os.remove("/tmp/sumsfile.%s" % k)
 
-    gf_result = gf.checksums_out('perfect', '/test', '/tmp/sumsfile')
-    logging.debug(gf_result.stdout.strip())
-    if gf_result.exit_status == 0:
-        gf.close_session()
+    logging.debug(perfect_result.stdout.strip())
+    if perfect_result.exit_status == 0:
         raise error.TestFail("checksums-out failed.")
-    gf.rm_rf('/test')
-
-    gf.close_session()
 
 
 def test_equal(vm, params):
@@ -684,7 +693,7 @@ def test_equal(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = params.get("gf_add_readonly", "no")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -717,7 +726,7 @@ def test_fill(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = params.get("gf_add_readonly", "no")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -771,7 +780,7 @@ def test_fill_dir(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = params.get("gf_add_readonly", "no")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -804,7 +813,7 @@ def test_fill_pattern(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = params.get("gf_add_readonly", "no")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -863,7 +872,7 @@ def test_head(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = params.get("gf_add_readonly", "no")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -906,7 +915,7 @@ def test_hexdump(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = params.get("gf_add_readonly", "no")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -939,7 +948,7 @@ def test_more(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = params.get("gf_add_readonly", "no")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -962,7 +971,7 @@ def test_pread(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = params.get("gf_add_readonly", "no")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -1013,13 +1022,6 @@ def run(test, params, env):
 
     operation = params.get("guestfish_function")
     testcase = globals()["test_%s" % operation]
-    partition_types = params.get("partition_types")
     fs_types = params.get("fs_types")
-    image_formats = params.get("image_formats")
-
-    for image_format in re.findall("\w+", image_formats):
-        params["image_format"] = image_format
-        for partition_type in re.findall("\w+", partition_types):
-            params["partition_type"] = partition_type
-            prepare_image(params)
-            testcase(vm, params)
+
+    guestfs_utils.run_combinations(testcase, vm, params, prepare_image)
@@ -5,9 +5,11 @@ from virttest import qemu_storage
 import logging
 import shutil
 import os
-import re
 import commands
 
+from provider import guestfs_session
+from provider import guestfs_utils
+
 
 def prepare_image(params):
     """
@@ -34,7 +36,7 @@ def test_set_get_e2uuid(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = "yes" == params.get("gf_add_readonly")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -75,7 +77,7 @@ def test_set_uuid(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = "yes" == params.get("gf_add_readonly")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -103,7 +105,7 @@ def test_set_get_e2label(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = "yes" == params.get("gf_add_readonly")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -145,7 +147,7 @@ def test_set_label(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = "yes" == params.get("gf_add_readonly")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -173,7 +175,7 @@ def test_set_get_e2attrs(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = "yes" == params.get("gf_add_readonly")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -246,7 +248,7 @@ def test_set_get_e2generation(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = "yes" == params.get("gf_add_readonly")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -278,7 +280,7 @@ def test_statvfs(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = "yes" == params.get("gf_add_readonly")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -330,7 +332,7 @@ def test_tune2fs_l(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = "yes" == params.get("gf_add_readonly")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -363,7 +365,7 @@ def test_tune2fs(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = "yes" == params.get("gf_add_readonly")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -405,7 +407,7 @@ def test_checkfs(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = "yes" == params.get("gf_add_readonly")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -437,7 +439,7 @@ def test_mkfs_opts(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = "yes" == params.get("gf_add_readonly")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -514,7 +516,7 @@ def test_blkid(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = "yes" == params.get("gf_add_readonly")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -553,7 +555,7 @@ def test_filesystem_available(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = "yes" == params.get("gf_add_readonly")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -582,7 +584,7 @@ def test_e2fsck(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = "yes" == params.get("gf_add_readonly")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -609,7 +611,7 @@ def test_list_filesystems(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = "yes" == params.get("gf_add_readonly")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -637,7 +639,7 @@ def test_mkfifo(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = "yes" == params.get("gf_add_readonly")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -666,7 +668,7 @@ def test_sync(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = "yes" == params.get("gf_add_readonly")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -692,7 +694,7 @@ def test_mklost_and_found(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = "yes" == params.get("gf_add_readonly")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -720,7 +722,7 @@ def test_mknod(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = "yes" == params.get("gf_add_readonly")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -772,7 +774,7 @@ def test_mknod_b(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = "yes" == params.get("gf_add_readonly")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -809,7 +811,7 @@ def test_mknod_c(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = "yes" == params.get("gf_add_readonly")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -846,7 +848,7 @@ def test_ntfsresize_opts(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = "yes" == params.get("gf_add_readonly")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -906,7 +908,7 @@ def test_resize2fs(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = "yes" == params.get("gf_add_readonly")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -963,7 +965,7 @@ def test_resize2fs_M(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = "yes" == params.get("gf_add_readonly")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -1009,7 +1011,7 @@ def test_resize2fs_size(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = "yes" == params.get("gf_add_readonly")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -1039,6 +1041,40 @@ def test_resize2fs_size(vm, params):
     gf.close_session()
 
 
+def reuse_or_prepare_image(params, image_name):
+    """
+    Reuse the image of the image format and partition type in params if it
+    exists and gf_create_img_force is no, otherwise prepare it.
+
+    :param image_name: Image name without file system and partition type
+    """
+    fs_type = params.get("fs_type")
+    image_format = params["image_format"]
+    partition_type = params["partition_type"]
+    image_dir = params.get("img_dir", data_dir.get_tmp_dir())
+    image_name_with_fs_pt = image_name + '.' + fs_type + '.' + partition_type
+    params['image_name'] = image_name_with_fs_pt
+    image_path = image_dir + '/' + image_name_with_fs_pt + '.' + image_format
+
+    if params["gf_create_img_force"] == "no" and os.path.exists(image_path):
+        params["image_path"] = image_path
+        # get mount_point
+        if partition_type == 'lvm':
+            pv_name = params.get("pv_name", "/dev/sdb")
+            vg_name = params.get("vg_name", "vol_test")
+            lv_name = params.get("lv_name", "vol_file")
+            mount_point = "/dev/%s/%s" % (vg_name, lv_name)
+        elif partition_type == "physical":
+            logging.info("create physical partition...")
+            pv_name = params.get("pv_name", "/dev/sdb")
+            mount_point = pv_name + "1"
+        params["mount_point"] = mount_point
+
+        logging.debug("Skip preparing image, " + image_path + " exists")
+    else:
+        prepare_image(params)
+
+
 def run(test, params, env):
     """
     Test of built-in fs_attr_ops related commands in guestfish.
@@ -1061,36 +1097,8 @@ def run(test, params, env):
 
     operation = params.get("guestfish_function")
     testcase = globals()["test_%s" % operation]
-    partition_types = params.get("partition_types")
-    fs_type = params.get("fs_type")
-    image_formats = params.get("image_formats")
     image_name = params.get("image_name", "gs_common")
 
-    for image_format in re.findall("\w+", image_formats):
-        params["image_format"] = image_format
-        for partition_type in re.findall("\w+", partition_types):
-            params["partition_type"] = partition_type
-            image_dir = params.get("img_dir", data_dir.get_tmp_dir())
-            image_path = image_dir + '/' + image_name + '.' + image_format
-            image_name_with_fs_pt = image_name + '.' + fs_type + '.' + partition_type
-            params['image_name'] = image_name_with_fs_pt
-            image_path = image_dir + '/' + image_name_with_fs_pt + '.' + image_format
-
-            if params["gf_create_img_force"] == "no" and os.path.exists(image_path):
-                params["image_path"] = image_path
-                # get mount_point
-                if partition_type == 'lvm':
-                    pv_name = params.get("pv_name", "/dev/sdb")
-                    vg_name = params.get("vg_name", "vol_test")
-                    lv_name = params.get("lv_name", "vol_file")
-                    mount_point = "/dev/%s/%s" % (vg_name, lv_name)
-                elif partition_type == "physical":
-                    logging.info("create physical partition...")
-                    pv_name = params.get("pv_name", "/dev/sdb")
-                    mount_point = pv_name + "1"
-                params["mount_point"] = mount_point
-
-                logging.debug("Skip preparing image, " + image_path + " exists")
-            else:
-                prepare_image(params)
-            testcase(vm, params)
+    def prepare(combination_params):
+        reuse_or_prepare_image(combination_params, image_name)
+    guestfs_utils.run_combinations(testcase, vm, params, prepare)
@@ -5,9 +5,11 @@ from virttest import qemu_storage
 import logging
 import shutil
 import os
-import re
 import commands
 
+from provider import guestfs_session
+from provider import guestfs_utils
+
 
 def prepare_image(params):
     """
@@ -34,7 +36,7 @@ def test_mount(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = "yes" == params.get("gf_add_readonly")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -70,7 +72,7 @@ def test_mount_options(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = "yes" == params.get("gf_add_readonly")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -107,7 +109,7 @@ def test_mount_ro(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = "yes" == params.get("gf_add_readonly")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -144,7 +146,7 @@ def test_mounts(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = "yes" == params.get("gf_add_readonly")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -169,7 +171,7 @@ def test_mount_loop(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = "yes" == params.get("gf_add_readonly")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -211,7 +213,7 @@ def test_mountpoints(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = "yes" == params.get("gf_add_readonly")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -240,7 +242,7 @@ def test_umount(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = "yes" == params.get("gf_add_readonly")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -308,7 +310,7 @@ def test_mount_vfs(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = "yes" == params.get("gf_add_readonly")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -346,7 +348,7 @@ def test_umount_all(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = "yes" == params.get("gf_add_readonly")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -365,6 +367,40 @@ def test_umount_all(vm, params):
     gf.close_session()
 
 
+def reuse_or_prepare_image(params, image_name):
+    """
+    Reuse the image of the image format and partition type in params if it
+    exists and gf_create_img_force is no, otherwise prepare it.
+
+    :param image_name: Image name without file system and partition type
+    """
+    fs_type = params.get("fs_type")
+    image_format = params["image_format"]
+    partition_type = params["partition_type"]
+    image_dir = params.get("img_dir", data_dir.get_tmp_dir())
+    image_name_with_fs_pt = image_name + '.' + fs_type + '.' + partition_type
+    params['image_name'] = image_name_with_fs_pt
+    image_path = image_dir + '/' + image_name_with_fs_pt + '.' + image_format
+
+    if params["gf_create_img_force"] == "no" and os.path.exists(image_path):
+        params["image_path"] = image_path
+        # get mount_point
+        if partition_type == 'lvm':
+            pv_name = params.get("pv_name", "/dev/sdb")
+            vg_name = params.get("vg_name", "vol_test")
+            lv_name = params.get("lv_name", "vol_file")
+            mount_point = "/dev/%s/%s" % (vg_name, lv_name)
+        elif partition_type == "physical":
+            logging.info("create physical partition...")
+            pv_name = params.get("pv_name", "/dev/sdb")
+            mount_point = pv_name + "1"
+        params["mount_point"] = mount_point
+
+        logging.debug("Skip preparing image, " + image_path + " exists")
+    else:
+        prepare_image(params)
+
+
 def run(test, params, env):
     """
     Test of built-in fs_attr_ops related commands in guestfish.
@@ -387,36 +423,8 @@ def run(test, params, env):
 
     operation = params.get("guestfish_function")
     testcase = globals()["test_%s" % operation]
-    partition_types = params.get("partition_types")
-    fs_type = params.get("fs_type")
-    image_formats = params.get("image_formats")
     image_name = params.get("image_name", "gs_common")
 
-    for image_format in re.findall("\w+", image_formats):
-        params["image_format"] = image_format
-        for partition_type in re.findall("\w+", partition_types):
-            params["partition_type"] = partition_type
-            image_dir = params.get("img_dir", data_dir.get_tmp_dir())
-            image_path = image_dir + '/' + image_name + '.' + image_format
-            image_name_with_fs_pt = image_name + '.' + fs_type + '.' + partition_type
-            params['image_name'] = image_name_with_fs_pt
-            image_path = image_dir + '/' + image_name_with_fs_pt + '.' + image_format
-
-            if params["gf_create_img_force"] == "no" and os.path.exists(image_path):
-                params["image_path"] = image_path
-                # get mount_point
-                if partition_type == 'lvm':
-                    pv_name = params.get("pv_name", "/dev/sdb")
-                    vg_name = params.get("vg_name", "vol_test")
-                    lv_name = params.get("lv_name", "vol_file")
-                    mount_point = "/dev/%s/%s" % (vg_name, lv_name)
-                elif partition_type == "physical":
-                    logging.info("create physical partition...")
-                    pv_name = params.get("pv_name", "/dev/sdb")
-                    mount_point = pv_name + "1"
-                params["mount_point"] = mount_point
-
-                logging.debug("Skip preparing image, " + image_path + " exists")
-            else:
-                prepare_image(params)
-            testcase(vm, params)
+    def prepare(combination_params):
+        reuse_or_prepare_image(combination_params, image_name)
+    guestfs_utils.run_combinations(testcase, vm, params, prepare)
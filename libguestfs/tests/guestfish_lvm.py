@@ -5,6 +5,13 @@ import logging
 import shutil
 import os
 import re
+import math
+import time
+
+from provider import bench_utils
+from provider import guestfs_batch
+from provider import guestfs_session
+from provider import guestfs_utils
 
 
 def prepare_image(params):
@@ -60,7 +67,7 @@ def test_is_lv(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = params.get("gf_add_readonly", "no")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -94,37 +101,38 @@ def test_lvcreate(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = params.get("gf_add_readonly", "no")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_batch.GuestfishBatch(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
     gf.run()
-    pv_name = params.get("pv_name")
+    pv_name = params.get("pv_name", "/dev/sda")
 
     vg_name = "myvg"
     lv_name = "mylv"
 
-    create_lvm(gf, 'pvcreate')
-    create_lvm(gf, 'vgcreate', vg_name=vg_name)
-    create_lvm(gf, 'lvcreate', vg_name=vg_name, lv_name=lv_name)
+    # Same steps as create_lvm(), a failing one fails execute().
+    gf.part_init(pv_name, "msdos")
+    gf.pvcreate(pv_name)
+    gf.vgcreate(vg_name, pv_name)
+    gf.lvcreate(lv_name, vg_name, 100)
+    lvs_result = gf.lvs()
+    lvs_full_result = gf.lvs_full()
+    gf.execute()
 
     part_name = "/dev/%s/%s" % (vg_name, lv_name)
 
-    result = gf.lvs().stdout.strip()
+    result = lvs_result.stdout.strip()
 
     if result != part_name:
-        gf.close_session()
         raise error.TestFail("lv name is not match")
 
-    result = gf.lvs_full().stdout.strip()
+    result = lvs_full_result.stdout.strip()
     result = re.search("lv_name:\s+(\S+)", result).groups()[0]
 
     if result != lv_name:
-        gf.close_session()
         raise error.TestFail("lv name is not match")
 
-    gf.close_session()
-
 
 def test_lvm_canonical_lv_name(vm, params):
     """
@@ -133,7 +141,7 @@ def test_lvm_canonical_lv_name(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = params.get("gf_add_readonly", "no")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -165,7 +173,7 @@ def test_lvremove(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = params.get("gf_add_readonly", "no")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -195,7 +203,7 @@ def test_lvm_remove_all(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = params.get("gf_add_readonly", "no")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -232,7 +240,7 @@ def test_lvrename(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = params.get("gf_add_readonly", "no")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -263,7 +271,7 @@ def test_lvresize(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = params.get("gf_add_readonly", "no")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -301,7 +309,7 @@ def test_lvresize_free(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = params.get("gf_add_readonly", "no")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -342,7 +350,7 @@ def test_lvm_set_filter(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = params.get("gf_add_readonly", "no")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -382,7 +390,7 @@ def test_lvuuid(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = params.get("gf_add_readonly", "no")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -416,7 +424,7 @@ def test_vgcreate(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = params.get("gf_add_readonly", "no")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -450,7 +458,7 @@ def test_vgremove(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = params.get("gf_add_readonly", "no")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -480,7 +488,7 @@ def test_vgrename(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = params.get("gf_add_readonly", "no")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -511,7 +519,7 @@ def test_vgscan(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = params.get("gf_add_readonly", "no")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -536,7 +544,7 @@ def test_vguuid(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = params.get("gf_add_readonly", "no")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -570,7 +578,7 @@ def test_vg_activate(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = params.get("gf_add_readonly", "no")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -609,7 +617,7 @@ def test_vg_activate_all(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = params.get("gf_add_readonly", "no")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -648,7 +656,7 @@ def test_vglvuuids(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = params.get("gf_add_readonly", "no")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -678,7 +686,7 @@ def test_vgpvuuids(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = params.get("gf_add_readonly", "no")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -708,7 +716,7 @@ def test_pvcreate(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = params.get("gf_add_readonly", "no")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -735,7 +743,7 @@ def test_pvremove(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = params.get("gf_add_readonly", "no")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -766,7 +774,7 @@ def test_pvresize(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = params.get("gf_add_readonly", "no")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -806,7 +814,7 @@ def test_pvuuid(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = params.get("gf_add_readonly", "no")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -831,6 +839,115 @@ def test_pvuuid(vm, params):
     gf.close_session()
 
 
+def timed_cmd(gf, recorder, operation, cmd):
+    """
+    Run a guestfish command, record its latency and fail on error.
+    """
+    start = time.time()
+    result = gf.inner_cmd(cmd)
+    recorder.record(operation, time.time() - start)
+    if result.exit_status:
+        gf.close_session()
+        raise error.TestFail("%s failed: %s" % (cmd, result.stderr))
+    return result
+
+
+def scale_lvm(gf, params, pvs, lv_count, recorder):
+    """
+    Create lv_count LVs in one VG on pvs, then time the LVM commands on
+    that layout and remove everything again.
+    """
+    vg_name = params.get("gf_lvm_scale_vg_name", "scale_vg")
+    lv_size = int(params.get("gf_lvm_scale_lv_size", "4"))
+    sample = min(int(params.get("gf_lvm_scale_sample", "10")), lv_count)
+    repeat = int(params.get("gf_lvm_scale_repeat", "5"))
+
+    for pv in pvs:
+        timed_cmd(gf, recorder, "pvcreate", "pvcreate %s" % pv)
+    timed_cmd(gf, recorder, "vgcreate",
+              'vgcreate %s "%s"' % (vg_name, " ".join(pvs)))
+    for index in range(lv_count):
+        # The latency of the last creates shows the cost at lv_count.
+        operation = "lvcreate"
+        if index >= lv_count - sample:
+            operation = "lvcreate_tail"
+        timed_cmd(gf, recorder, operation,
+                  "lvcreate lv%d %s %d" % (index, vg_name, lv_size))
+    for _ in range(repeat):
+        lvs = timed_cmd(gf, recorder, "lvs", "lvs").stdout.split()
+    if len(lvs) != lv_count:
+        gf.close_session()
+        raise error.TestFail("lvs listed %s LVs instead of %s"
+                             % (len(lvs), lv_count))
+    step = lv_count // sample
+    sampled = ["/dev/%s/lv%d" % (vg_name, index * step)
+               for index in range(sample)]
+    for lv in sampled:
+        timed_cmd(gf, recorder, "lvresize",
+                  "lvresize %s %d" % (lv, lv_size * 2))
+    for lv in sampled:
+        timed_cmd(gf, recorder, "lvremove", "lvremove %s" % lv)
+    timed_cmd(gf, recorder, "lvm-remove-all", "lvm-remove-all")
+
+
+def run_lvm_scale(test, params):
+    """
+    Measure how the latency of LVM commands grows with the number of LVs.
+
+    For every count of gf_lvm_scale_counts a fresh layout of that many LVs
+    is built on sparse scratch images in one appliance.
+    """
+    counts = [int(count) for count in
+              params.get("gf_lvm_scale_counts", "10 100 1000").split()]
+    pv_count = int(params.get("gf_lvm_scale_pvs", "4"))
+    pv_size = params.get("gf_lvm_scale_pv_size", "100G")
+    img_dir = params.get("img_dir", data_dir.get_tmp_dir())
+
+    images = []
+    gf = utils_test.libguestfs.GuestfishTools(params)
+    report = {"pvs": pv_count, "pv_size": pv_size, "counts": {},
+              "scaling": {}}
+    try:
+        for index in range(pv_count):
+            image = os.path.join(img_dir, "lvm_scale%d.img" % index)
+            # Sparse, only written extents use space.
+            utils.run("qemu-img create -f raw %s %s" % (image, pv_size))
+            images.append(image)
+            gf.add_drive_opts(image, format="raw")
+        gf.run()
+        pvs = gf.list_devices().stdout.split()
+        for lv_count in counts:
+            recorder = bench_utils.LatencyRecorder()
+            start = time.time()
+            scale_lvm(gf, params, pvs, lv_count, recorder)
+            operations = recorder.report()["operations"]
+            report["counts"][lv_count] = {"seconds": time.time() - start,
+                                          "operations": operations}
+            logging.info("%s LVs in %.1fs", lv_count,
+                         report["counts"][lv_count]["seconds"])
+            recorder.log_summary()
+        gf.close_session()
+    finally:
+        for image in images:
+            if os.path.exists(image):
+                os.remove(image)
+
+    # Exponent of the growth of the mean latency between the smallest and
+    # the largest count, 0 is constant and 1 linear in the number of LVs.
+    low, high = min(counts), max(counts)
+    if low != high:
+        for operation, data in report["counts"][high]["operations"].items():
+            low_data = report["counts"][low]["operations"].get(operation)
+            if not low_data or not low_data["mean"] or not data["mean"]:
+                continue
+            report["scaling"][operation] = (math.log(data["mean"] /
+                                                     low_data["mean"]) /
+                                            math.log(float(high) / low))
+            logging.info("%s latency grows as LVs ** %.2f", operation,
+                         report["scaling"][operation])
+    bench_utils.save_report(test, "guestfish_lvm_scale", report)
+
+
 def run(test, params, env):
     """
     Test of built-in lvm related commands in guestfish.
@@ -852,14 +969,10 @@ def run(test, params, env):
         vm.destroy()
 
     operation = params.get("guestfish_function")
+    if operation == "lvm_scale":
+        run_lvm_scale(test, params)
+        return
     testcase = globals()["test_%s" % operation]
-    partition_types = params.get("partition_types")
     fs_types = params.get("fs_types")
-    image_formats = params.get("image_formats")
-
-    for image_format in re.findall("\w+", image_formats):
-        params["image_format"] = image_format
-        for partition_type in re.findall("\w+", partition_types):
-            params["partition_type"] = partition_type
-            prepare_image(params)
-            testcase(vm, params)
+
+    guestfs_utils.run_combinations(testcase, vm, params, prepare_image)
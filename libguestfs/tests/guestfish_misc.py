@@ -7,6 +7,9 @@ import shutil
 import os
 import re
 
+from provider import guestfs_session
+from provider import guestfs_utils
+
 
 def prepare_image(params):
     """
@@ -33,7 +36,7 @@ def test_df(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = params.get("gf_add_readonly", "no")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -58,7 +61,7 @@ def test_df_h(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = params.get("gf_add_readonly", "no")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -86,7 +89,7 @@ def test_dd(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = params.get("gf_add_readonly", "no")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -114,7 +117,7 @@ def test_copy_size(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = params.get("gf_add_readonly", "no")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -142,7 +145,7 @@ def test_download(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = params.get("gf_add_readonly", "no")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -153,7 +156,8 @@ def test_download(vm, params):
     gf.write("/src.txt", "Hello World")
     src_size = gf.filesize("/src.txt").stdout.strip()
 
-    dest = "%s/dest.txt" % data_dir.get_tmp_dir()
+    image_dir = params.get("img_dir", data_dir.get_tmp_dir())
+    dest = "%s/dest.txt" % image_dir
     gf.download("/src.txt", "%s" % dest)
     gf.close_session()
 
@@ -171,7 +175,7 @@ def test_download_offset(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = params.get("gf_add_readonly", "no")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -184,7 +188,8 @@ def test_download_offset(vm, params):
     gf.write("/src.txt", string)
     src_size = gf.filesize("/src.txt").stdout.strip()
 
-    dest = "%s/dest.txt" % data_dir.get_tmp_dir()
+    image_dir = params.get("img_dir", data_dir.get_tmp_dir())
+    dest = "%s/dest.txt" % image_dir
     gf.download_offset("/src.txt", "%s" % dest, 0, len(string))
     gf.close_session()
 
@@ -202,7 +207,7 @@ def test_upload(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = params.get("gf_add_readonly", "no")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -210,7 +215,8 @@ def test_upload(vm, params):
     gf.run()
     gf.do_mount("/")
 
-    filename = "%s/src.txt" % data_dir.get_tmp_dir()
+    image_dir = params.get("img_dir", data_dir.get_tmp_dir())
+    filename = "%s/src.txt" % image_dir
     fd = open(filename, "w+")
     fd.write("Hello World")
     fd.close()
@@ -231,7 +237,7 @@ def test_upload_offset(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = params.get("gf_add_readonly", "no")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -239,7 +245,8 @@ def test_upload_offset(vm, params):
     gf.run()
     gf.do_mount("/")
 
-    filename = "%s/src.txt" % data_dir.get_tmp_dir()
+    image_dir = params.get("img_dir", data_dir.get_tmp_dir())
+    filename = "%s/src.txt" % image_dir
     string = "Hello World"
     commands.getoutput("echo %s > %s" % (string, filename))
 
@@ -259,7 +266,7 @@ def test_fallocate(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = params.get("gf_add_readonly", "no")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -296,7 +303,7 @@ def test_fallocate64(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = params.get("gf_add_readonly", "no")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     gf.add_drive_opts(image_path, readonly=readonly)
@@ -348,13 +355,6 @@ def run(test, params, env):
 
     operation = params.get("guestfish_function")
     testcase = globals()["test_%s" % operation]
-    partition_types = params.get("partition_types")
     fs_types = params.get("fs_types")
-    image_formats = params.get("image_formats")
-
-    for image_format in re.findall("\w+", image_formats):
-        params["image_format"] = image_format
-        for partition_type in re.findall("\w+", partition_types):
-            params["partition_type"] = partition_type
-            prepare_image(params)
-            testcase(vm, params)
+
+    guestfs_utils.run_combinations(testcase, vm, params, prepare_image)
@@ -5,10 +5,12 @@ from virttest import virsh, qemu_storage
 import logging
 import shutil
 import os
-import re
 import commands
 import time
 
+from provider import guestfs_session
+from provider import guestfs_utils
+
 
 def prepare_image(params):
     """
@@ -35,7 +37,7 @@ def test_add_domain(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = "yes" == params.get("gf_add_readonly")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     pv_name = params.get("pv_name")
@@ -86,7 +88,7 @@ def test_add_drive(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = "yes" == params.get("gf_add_readonly")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     pv_name = params.get("pv_name")
@@ -113,7 +115,7 @@ def test_add_drive_opts(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = "yes" == params.get("gf_add_readonly")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     pv_name = params.get("pv_name")
@@ -156,7 +158,7 @@ def test_add_drive_ro(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = "yes" == params.get("gf_add_readonly")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     image_path = params.get("image_path")
     pv_name = params.get("pv_name")
@@ -178,7 +180,7 @@ def test_add_drive_ro_with_if(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = "yes" == params.get("gf_add_readonly")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     old_env = gf.get_backend()
     gf.set_backend('direct')
@@ -217,7 +219,7 @@ def test_add_drive_with_if(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = "yes" == params.get("gf_add_readonly")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     old_env = gf.get_backend()
     gf.set_backend('direct')
@@ -256,7 +258,7 @@ def test_available(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = "yes" == params.get("gf_add_readonly")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
     image_path = params.get("image_path")
     gf.add_drive(image_path)
     gf.run()
@@ -277,7 +279,7 @@ def test_available_all_groups(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = "yes" == params.get("gf_add_readonly")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
     image_path = params.get("image_path")
     gf.add_drive(image_path)
     gf.run()
@@ -296,7 +298,7 @@ def test_help(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = "yes" == params.get("gf_add_readonly")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     h_result = gf.help()
     hr_result = gf.help('run')
@@ -316,7 +318,7 @@ def test_echo(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = "yes" == params.get("gf_add_readonly")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     gf_result = gf.echo('1')
     if gf_result.stdout.split('\n')[0] != "1":
@@ -343,7 +345,7 @@ def test_echo_daemon(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = "yes" == params.get("gf_add_readonly")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
     image_path = params.get("image_path")
     gf.add_drive(image_path)
     gf.run()
@@ -371,7 +373,7 @@ def test_dmesg(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = "yes" == params.get("gf_add_readonly")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
     image_path = params.get("image_path")
     gf.add_drive(image_path)
     gf.run()
@@ -390,7 +392,7 @@ def test_version(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = "yes" == params.get("gf_add_readonly")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
     gf_result = gf.version()
     expected_str_list = ['major:', 'minor:', 'release:', 'extra:']
     for expected_str in expected_str_list:
@@ -407,7 +409,7 @@ def test_alloc(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = "yes" == params.get("gf_add_readonly")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
     img_dir = params.get("img_dir", data_dir.get_tmp_dir())
     test_img_normal = img_dir + '/alloc_test_normal.img'
     test_img_error = img_dir + '/alloc_test_error.img'
@@ -438,7 +440,7 @@ def test_sparse(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = "yes" == params.get("gf_add_readonly")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
     img_dir = params.get("img_dir", data_dir.get_tmp_dir())
     test_img = img_dir + '/sparse_test.img'
     os.system('rm -f %s' % test_img)
@@ -459,7 +461,7 @@ def test_modprobe(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = "yes" == params.get("gf_add_readonly")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
     image_path = params.get("image_path")
     gf.add_drive(image_path)
     gf.run()
@@ -477,7 +479,7 @@ def test_ping_daemon(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = "yes" == params.get("gf_add_readonly")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
     image_path = params.get("image_path")
     gf.add_drive(image_path)
     gf.run()
@@ -495,7 +497,7 @@ def test_reopen(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = "yes" == params.get("gf_add_readonly")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
     re_result = gf.reopen()
     if re_result.exit_status != 0:
         gf.close_session()
@@ -516,7 +518,7 @@ def test_time(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = "yes" == params.get("gf_add_readonly")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
     time_result = gf.time("version")
     if time_result.exit_status != 0 or 'elapsed time' not in time_result.stdout:
         gf.close_session()
@@ -532,7 +534,7 @@ def test_launch(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = "yes" == params.get("gf_add_readonly")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
     image_path = params.get("image_path")
     gf.add_drive(image_path)
     gf.run()
@@ -548,7 +550,7 @@ def test_man(vm, params):
     """
     Test command man:
     """
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
     test_dir = params.get("img_dir", data_dir.get_tmp_dir())
     tmp_file = "test_man_file"
     os.system("guestfish -- man > %s" % tmp_file)
@@ -569,7 +571,7 @@ def test_quit(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = "yes" == params.get("gf_add_readonly")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
     image_path = params.get("image_path")
     gf.add_drive(image_path)
     gf.set_attach_method("appliance")
@@ -595,7 +597,7 @@ def test_sleep(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = "yes" == params.get("gf_add_readonly")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
     image_path = params.get("image_path")
     gf.add_drive(image_path)
     gf.run()
@@ -617,7 +619,7 @@ def test_config(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = "yes" == params.get("gf_add_readonly")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
     gf.inner_cmd("trace 1")
     cf_result = gf.config("-name", "libguestfs-appliance")
     if cf_result.exit_status != 0 or 'libguestfs-appliance' not in cf_result.stdout:
@@ -639,7 +641,7 @@ def test_debug(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = "yes" == params.get("gf_add_readonly")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
     image_path = params.get("image_path")
     gf.add_drive(image_path)
     gf.run()
@@ -666,7 +668,7 @@ def test_kill_subprocess(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = "yes" == params.get("gf_add_readonly")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
     image_path = params.get("image_path")
     gf.add_drive(image_path)
     gf.run()
@@ -688,7 +690,7 @@ def test_shutdown(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = "yes" == params.get("gf_add_readonly")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
     image_path = params.get("image_path")
     gf.add_drive(image_path)
     gf.run()
@@ -710,7 +712,7 @@ def test_ntfs_3g_probe(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = "yes" == params.get("gf_add_readonly")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
     image_path = params.get("image_path")
 
     test_format = params.get("image_format")
@@ -750,7 +752,7 @@ def test_event(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = "yes" == params.get("gf_add_readonly")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
     gf.add_drive("/dev/null")
 
     name = "evt0"
@@ -863,7 +865,7 @@ def test_set_get_append(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = "yes" == params.get("gf_add_readonly")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
     image_path = params.get("image_path")
     gf.add_drive(image_path)
 
@@ -886,7 +888,7 @@ def test_set_get_smp(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = "yes" == params.get("gf_add_readonly")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
     gf.add_drive("/dev/null")
 
     temp, smp = commands.getstatusoutput("cat /proc/cpuinfo | grep -E '^processor' | wc -l")
@@ -908,7 +910,7 @@ def test_set_get_pgroup(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = "yes" == params.get("gf_add_readonly")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
     gf.add_drive("/dev/null")
 
     pgroup = "1"
@@ -942,7 +944,7 @@ def test_set_get_attach_method(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = "yes" == params.get("gf_add_readonly")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
     gf.add_drive("/dev/null")
 
     method = "appliance"
@@ -964,7 +966,7 @@ def test_set_get_autosync(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = "yes" == params.get("gf_add_readonly")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     gf.set_autosync("0")
     expected = "false"
@@ -992,7 +994,7 @@ def test_set_get_direct(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = "yes" == params.get("gf_add_readonly")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     gf.set_direct("0")
     expected = "false"
@@ -1020,7 +1022,7 @@ def test_set_get_memsize(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = "yes" == params.get("gf_add_readonly")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     memsize = "700"
     gf.set_memsize(memsize)
@@ -1040,7 +1042,7 @@ def test_set_get_path(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = "yes" == params.get("gf_add_readonly")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     path = "/usr/lib/guestfs"
     gf.set_path(path)
@@ -1060,7 +1062,7 @@ def test_set_get_qemu(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = "yes" == params.get("gf_add_readonly")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     qemu = "/usr/libexec/qemu-kvm"
     gf.set_path(qemu)
@@ -1080,7 +1082,7 @@ def test_set_get_recovery_proc(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = "yes" == params.get("gf_add_readonly")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     recoveryproc = 0
     expected = "false"
@@ -1110,7 +1112,7 @@ def test_set_get_trace(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = "yes" == params.get("gf_add_readonly")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     trace = 0
     expected = "false"
@@ -1140,7 +1142,7 @@ def test_set_get_verbose(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = "yes" == params.get("gf_add_readonly")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     verbose = "0"
     expected = "false"
@@ -1170,7 +1172,7 @@ def test_get_pid(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = "yes" == params.get("gf_add_readonly")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
     image_path = params.get("image_path")
     gf.add_drive(image_path)
 
@@ -1193,7 +1195,7 @@ def test_set_get_network(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = "yes" == params.get("gf_add_readonly")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     network = 0
     expected = "false"
@@ -1223,7 +1225,7 @@ def test_setenv(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = "yes" == params.get("gf_add_readonly")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     var1 = "VAR1"
     value1 = "value1"
@@ -1260,7 +1262,7 @@ def test_unsetenv(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = "yes" == params.get("gf_add_readonly")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
 
     var1 = "VAR1"
     value1 = "value1"
@@ -1300,7 +1302,7 @@ def test_is_config(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = "yes" == params.get("gf_add_readonly")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
     image_path = params.get("image_path")
 
     gf.add_drive(image_path)
@@ -1324,7 +1326,7 @@ def test_lcd(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = "yes" == params.get("gf_add_readonly")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
     os.system("rm -f /tmp/test_lcd.img")
 
     gf.lcd("/tmp")
@@ -1348,7 +1350,7 @@ def test_supported(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = "yes" == params.get("gf_add_readonly")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
     image_path = params.get("image_path")
     gf.add_drive(image_path)
     gf.run()
@@ -1374,7 +1376,7 @@ def test_extlinux(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = "yes" == params.get("gf_add_readonly")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
     test_format = params.get("image_format")
     test_size = "100M"
     test_dir = params.get("img_dir", data_dir.get_tmp_dir())
@@ -1430,7 +1432,7 @@ def test_syslinux(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = "yes" == params.get("gf_add_readonly")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
     test_format = params.get("image_format")
     test_size = "100M"
     test_dir = params.get("img_dir", data_dir.get_tmp_dir())
@@ -1468,7 +1470,7 @@ def test_feature_available(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = "yes" == params.get("gf_add_readonly")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
     image_path = params.get("image_path")
     gf.add_drive(image_path)
     gf.run()
@@ -1494,7 +1496,7 @@ def test_set_get_program(vm, params):
     add_ref = params.get("gf_add_ref", "disk")
     readonly = "yes" == params.get("gf_add_readonly")
 
-    gf = utils_test.libguestfs.GuestfishTools(params)
+    gf = guestfs_session.get_guestfish(params)
     image_path = params.get("image_path")
     gf.add_drive(image_path)
     gf.run()
@@ -1513,6 +1515,40 @@ def test_set_get_program(vm, params):
         raise error.TestFail("test_set_get_program failed")
 
 
+def reuse_or_prepare_image(params, image_name):
+    """
+    Reuse the image of the image format and partition type in params if it
+    exists and gf_create_img_force is no, otherwise prepare it.
+
+    :param image_name: Image name without file system and partition type
+    """
+    fs_type = params.get("fs_type")
+    image_format = params["image_format"]
+    partition_type = params["partition_type"]
+    image_dir = params.get("img_dir", data_dir.get_tmp_dir())
+    image_name_with_fs_pt = image_name + '.' + fs_type + '.' + partition_type
+    params['image_name'] = image_name_with_fs_pt
+    image_path = image_dir + '/' + image_name_with_fs_pt + '.' + image_format
+
+    if params["gf_create_img_force"] == "no" and os.path.exists(image_path):
+        params["image_path"] = image_path
+        # get mount_point
+        if partition_type == 'lvm':
+            pv_name = params.get("pv_name", "/dev/sdb")
+            vg_name = params.get("vg_name", "vol_test")
+            lv_name = params.get("lv_name", "vol_file")
+            mount_point = "/dev/%s/%s" % (vg_name, lv_name)
+        elif partition_type == "physical":
+            logging.info("create physical partition...")
+            pv_name = params.get("pv_name", "/dev/sdb")
+            mount_point = pv_name + "1"
+        params["mount_point"] = mount_point
+
+        logging.debug("Skip preparing image, " + image_path + " exists")
+    else:
+        prepare_image(params)
+
+
 def run(test, params, env):
     """
     Test of built-in fs_attr_ops related commands in guestfish.
@@ -1535,36 +1571,8 @@ def run(test, params, env):
 
     operation = params.get("guestfish_function")
     testcase = globals()["test_%s" % operation]
-    partition_types = params.get("partition_types")
-    fs_type = params.get("fs_type")
-    image_formats = params.get("image_formats")
     image_name = params.get("image_name", "gs_common")
 
-    for image_format in re.findall("\w+", image_formats):
-        params["image_format"] = image_format
-        for partition_type in re.findall("\w+", partition_types):
-            params["partition_type"] = partition_type
-            image_dir = params.get("img_dir", data_dir.get_tmp_dir())
-            image_path = image_dir + '/' + image_name + '.' + image_format
-            image_name_with_fs_pt = image_name + '.' + fs_type + '.' + partition_type
-            params['image_name'] = image_name_with_fs_pt
-            image_path = image_dir + '/' + image_name_with_fs_pt + '.' + image_format
-
-            if params["gf_create_img_force"] == "no" and os.path.exists(image_path):
-                params["image_path"] = image_path
-                # get mount_point
-                if partition_type == 'lvm':
-                    pv_name = params.get("pv_name", "/dev/sdb")
-                    vg_name = params.get("vg_name", "vol_test")
-                    lv_name = params.get("lv_name", "vol_file")
-                    mount_point = "/dev/%s/%s" % (vg_name, lv_name)
-                elif partition_type == "physical":
-                    logging.info("create physical partition...")
-                    pv_name = params.get("pv_name", "/dev/sdb")
-                    mount_point = pv_name + "1"
-                params["mount_point"] = mount_point
-
-                logging.debug("Skip preparing image, " + image_path + " exists")
-            else:
-                prepare_image(params)
-            testcase(vm, params)
+    def prepare(combination_params):
+        reuse_or_prepare_image(combination_params, image_name)
+    guestfs_utils.run_combinations(testcase, vm, params, prepare)
@@ -3,6 +3,8 @@ import re
 from autotest.client.shared import error
 from virttest import virt_vm, remote, utils_test
 
+from provider import guestfs_inspect
+
 
 def test_inspect_get(vm, params):
     """
@@ -16,14 +18,22 @@ def test_inspect_get(vm, params):
 
     params['libvirt_domain'] = vm.name
     params['gf_inspector'] = True
-    gf = utils_test.libguestfs.GuestfishTools(params)
-    roots, rootfs = gf.get_root()
-    logging.debug("Root filesystem:%s", rootfs)
-    # inspect-os will umount filesystems,reopen it later
-    gf.close_session()
-    if roots is False:
-        raise error.TestError("Can not get root filesystem "
-                              "in guestfish before test")
+    inspect_cache = guestfs_inspect.InspectionCache.from_params(params)
+    disks = guestfs_inspect.get_vm_disks(vm)
+    cached_info = inspect_cache.load(disks, required=["root"])
+    if cached_info is not None:
+        rootfs = cached_info["root"]
+        logging.debug("Cached root filesystem:%s", rootfs)
+    else:
+        gf = utils_test.libguestfs.GuestfishTools(params)
+        roots, rootfs = gf.get_root()
+        logging.debug("Root filesystem:%s", rootfs)
+        # inspect-os will umount filesystems,reopen it later
+        gf.close_session()
+        if roots is False:
+            raise error.TestError("Can not get root filesystem "
+                                  "in guestfish before test")
+        inspect_cache.save(disks, {"root": rootfs})
 
     fail_info = []
     gf = utils_test.libguestfs.GuestfishTools(params)
@@ -121,6 +131,18 @@ def test_inspect_get(vm, params):
 
     gf.close_session()
 
+    if not fail_info:
+        # Store the results before booting the guest changes its disks.
+        inspect_cache.save(disks, {
+            "arch": arch_result.stdout.strip(),
+            "distro": distro_result.stdout.strip(),
+            "hostname": hn_result.stdout.strip(),
+            "major_version": majorv_result.stdout.strip(),
+            "minor_version": minorv_result.stdout.strip(),
+            "filesystems": fs_result.stdout.split(),
+            "mountpoints": [line.split(":", 1)[1].strip() for line in
+                            rmp_result.stdout.splitlines() if ":" in line]})
+
     try:
         vm.start()
         session = vm.wait_for_login()
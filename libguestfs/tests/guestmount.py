@@ -1,7 +1,11 @@
 import logging
 import os
+import time
+import shutil
 from autotest.client.shared import error, utils
-from virttest import data_dir, utils_test
+from virttest import data_dir, utils_test, utils_misc
+
+from provider import bench_utils
 
 
 def umount_fs(mountpoint):
@@ -14,6 +18,153 @@ def umount_fs(mountpoint):
     return True
 
 
+def guestmount(vm_name, mountpoint, options, pid_file):
+    """
+    Mount the filesystems of vm_name on mountpoint with guestmount.
+    """
+    if not os.path.isdir(mountpoint):
+        os.makedirs(mountpoint)
+    utils.run("guestmount -d %s -i --rw --pid-file %s %s %s"
+              % (vm_name, pid_file, options, mountpoint))
+
+
+def guestunmount(mountpoint, pid_file, timeout=120):
+    """
+    Unmount a guestmount mountpoint and wait until guestmount exited,
+    which is when all writes are on the disk.
+    """
+    pid = None
+    if os.path.exists(pid_file):
+        pid = int(utils.read_one_line(pid_file))
+    utils.run("fusermount -u %s" % mountpoint, ignore_status=True)
+    if pid is not None:
+        proc_dir = "/proc/%d" % pid
+        if not utils_misc.wait_for(lambda: not os.path.exists(proc_dir),
+                                   timeout, step=0.5):
+            raise error.TestFail("guestmount %s did not exit in %ss"
+                                 % (pid, timeout))
+        os.remove(pid_file)
+
+
+def drop_caches():
+    """
+    Drop the host page cache, so reads go through FUSE to the appliance.
+    """
+    utils.run("sync; echo 3 > /proc/sys/vm/drop_caches", ignore_status=True)
+
+
+def bench_mount(params, mountpoint, recorder):
+    """
+    Measure throughput and rates on a mounted guest filesystem.
+
+    :return: Dict of results
+    """
+    bench_dir = os.path.join(mountpoint,
+                             params.get("gm_bench_dir", "tmp/gm_bench"))
+    file_size = int(params.get("gm_bench_file_size", "256")) * 1024 ** 2
+    block_size = int(params.get("gm_bench_block_size", "1024")) * 1024
+    file_count = int(params.get("gm_bench_file_count", "1000"))
+    small_size = int(params.get("gm_bench_small_file_size", "4096"))
+    list_repeat = int(params.get("gm_bench_list_repeat", "20"))
+    results = {}
+    if os.path.exists(bench_dir):
+        shutil.rmtree(bench_dir)
+    os.makedirs(bench_dir)
+
+    # Sequential write, fsync is part of it.
+    big_file = os.path.join(bench_dir, "big_file")
+    block = "\0" * block_size
+    start = time.time()
+    big = open(big_file, "wb")
+    try:
+        written = 0
+        while written < file_size:
+            big.write(block)
+            written += block_size
+        big.flush()
+        os.fsync(big.fileno())
+    finally:
+        big.close()
+    elapsed = time.time() - start
+    results["write_mb_per_sec"] = written / 1024.0 ** 2 / elapsed
+
+    # Sequential read of data not in the host page cache.
+    drop_caches()
+    start = time.time()
+    big = open(big_file, "rb")
+    try:
+        read = 0
+        data = big.read(block_size)
+        while data:
+            read += len(data)
+            data = big.read(block_size)
+    finally:
+        big.close()
+    elapsed = time.time() - start
+    results["read_mb_per_sec"] = read / 1024.0 ** 2 / elapsed
+
+    # Small files.
+    small_dir = os.path.join(bench_dir, "small")
+    os.mkdir(small_dir)
+    content = "x" * small_size
+    start = time.time()
+    for index in range(file_count):
+        op_start = time.time()
+        small = open(os.path.join(small_dir, "file%d" % index), "w")
+        small.write(content)
+        small.close()
+        recorder.record("create", time.time() - op_start)
+    results["create_per_sec"] = file_count / (time.time() - start)
+
+    drop_caches()
+    start = time.time()
+    for index in range(file_count):
+        op_start = time.time()
+        os.stat(os.path.join(small_dir, "file%d" % index))
+        recorder.record("stat", time.time() - op_start)
+    results["stat_per_sec"] = file_count / (time.time() - start)
+
+    for _ in range(list_repeat):
+        op_start = time.time()
+        names = os.listdir(small_dir)
+        recorder.record("listdir", time.time() - op_start)
+        if len(names) != file_count:
+            raise error.TestFail("Listed %s files instead of %s"
+                                 % (len(names), file_count))
+
+    shutil.rmtree(bench_dir)
+    return results
+
+
+def run_benchmark(test, params, vm):
+    """
+    Measure guestmount throughput for every mount mode of params.
+
+    gm_bench_modes names the modes, gm_bench_options_<mode> holds the
+    guestmount options of each, such as -o direct_io for uncached access.
+    """
+    mountpoint = os.path.join(data_dir.get_tmp_dir(), "gm_bench_mountpoint")
+    pid_file = os.path.join(data_dir.get_tmp_dir(), "gm_bench.pid")
+    report = {"modes": {}}
+    for mode in params.get("gm_bench_modes", "cached uncached").split():
+        options = params.get("gm_bench_options_%s" % mode, "")
+        recorder = bench_utils.LatencyRecorder()
+        guestmount(vm.name, mountpoint, options, pid_file)
+        try:
+            results = bench_mount(params, mountpoint, recorder)
+        finally:
+            guestunmount(mountpoint, pid_file)
+        results["options"] = options
+        results["latency"] = recorder.report()["operations"]
+        report["modes"][mode] = results
+        logging.info("guestmount %s (%s): write %.1f MB/s, read %.1f MB/s, "
+                     "%.1f creates/s, %.1f stats/s", mode, options,
+                     results["write_mb_per_sec"], results["read_mb_per_sec"],
+                     results["create_per_sec"], results["stat_per_sec"])
+        recorder.log_summary()
+    bench_utils.save_report(test, "guestmount_bench", report)
+
+
 def run(test, params, env):
     """
     Test libguestfs tool guestmount.
@@ -27,6 +178,10 @@ def run(test, params, env):
     elif vm.is_dead() and start_vm:
         vm.start()
 
+    if params.get("gm_benchmark", "no") == "yes":
+        run_benchmark(test, params, vm)
+        return
+
     # Create a file to vm with guestmount
     content = "This is file for guestmount test."
     path = params.get("gm_tempfile", "/home/gm_tmp")
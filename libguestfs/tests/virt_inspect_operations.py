@@ -4,6 +4,13 @@ import os
 from autotest.client.shared import error
 from virttest import virt_vm, remote, utils_test
 
+from provider import guestfs_inspect
+
+# Fields of get_vm_info_with_inspector() this test checks.
+INSPECTOR_FIELDS = ["release", "arch", "distro", "filesystems", "root",
+                    "hostname", "major_version", "minor_version",
+                    "mountpoints"]
+
 
 def test_inspect_get(vm, params):
     """
@@ -44,7 +51,17 @@ def test_inspect_get(vm, params):
 
     # Compare vm information
     # This is a dict include many vm information
-    vm_info = vt.get_vm_info_with_inspector()
+    inspect_cache = guestfs_inspect.InspectionCache.from_params(params)
+    disks = guestfs_inspect.get_vm_disks(vm)
+    required = INSPECTOR_FIELDS
+    if not is_redhat:
+        required = [field for field in required if field != "release"]
+    vm_info = inspect_cache.load(disks, required=required)
+    if vm_info is None:
+        vm_info = vt.get_vm_info_with_inspector()
+        # Store the results before booting the guest changes its disks.
+        inspect_cache.save(disks, dict((field, vm_info.get(field))
+                                       for field in INSPECTOR_FIELDS))
 
     # release info
     if is_redhat:
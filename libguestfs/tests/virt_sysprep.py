@@ -1,11 +1,129 @@
 import logging
 import os
+import re
+import time
 from autotest.client.shared import error
 from virttest import libvirt_vm, virsh, remote, aexpect, virt_vm, utils_test
+from virttest import data_dir, utils_misc
 from virttest.libvirt_xml import vm_xml
 import virttest.utils_libguestfs as lgf
 from autotest.client import utils
 
+from provider import bench_utils
+from provider import parallel_utils
+
+# Progress lines of virt-sysprep, such as
+# "[   4.2] Performing "logfiles" ..."
+PROGRESS_RE = re.compile(r"^\[\s*([\d.]+)\]\s+(.*?)\s*(?:\.\.\.)?$")
+PERFORMING_RE = re.compile(r'Performing "([^"]+)"')
+
+
+def parse_sysprep_progress(output, total):
+    """
+    Attribute the run time of virt-sysprep to its steps.
+
+    Each step lasts from its progress line to the next one, the last step
+    lasts until the command exited.
+
+    :param output: Output of virt-sysprep
+    :param total: Seconds virt-sysprep ran
+    :return: Dict of step to seconds, steps of --operations are named
+             by the operation, others by their message
+    """
+    steps = []
+    for line in output.splitlines():
+        mobj = PROGRESS_RE.match(line.strip())
+        if not mobj:
+            continue
+        name = mobj.group(2)
+        performing = PERFORMING_RE.search(name)
+        if performing:
+            name = performing.group(1)
+        steps.append((float(mobj.group(1)), name))
+    timing = {}
+    for index, (start, name) in enumerate(steps):
+        if index + 1 < len(steps):
+            end = steps[index + 1][0]
+        else:
+            end = max(total, start)
+        timing[name] = timing.get(name, 0) + end - start
+    return timing
+
+
+def sysprep_clone(image, options, timeout):
+    """
+    Run virt-sysprep on a cloned image, in a worker process.
+
+    :return: Dict with elapsed seconds and the timing of its steps
+    """
+    start = time.time()
+    result = lgf.virt_sysprep_cmd(image, options, ignore_status=True,
+                                  timeout=timeout)
+    elapsed = time.time() - start
+    if result.exit_status:
+        raise error.TestFail("virt-sysprep on %s failed: %s"
+                             % (image, result.stderr.strip()))
+    return {"elapsed": elapsed,
+            "steps": parse_sysprep_progress(result.stdout, elapsed)}
+
+
+def run_parallel(test, params, image, image_format):
+    """
+    Clone image N times as qcow2 overlays and run virt-sysprep on all
+    clones at once, at most sysprep_parallel_workers at a time.
+    """
+    clone_count = int(params.get("sysprep_parallel_clones", "8"))
+    workers = int(params.get("sysprep_parallel_workers", "4"))
+    timeout = int(params.get("sysprep_parallel_timeout", "1800"))
+    operations = params.get("sysprep_operations")
+    options = params.get("sysprep_parallel_options", "")
+    if operations:
+        options += " --operations %s" % operations
+    top = int(params.get("sysprep_parallel_top", "5"))
+    clone_dir = params.get("sysprep_parallel_dir", data_dir.get_tmp_dir())
+    qemu_img = utils_misc.get_qemu_img_binary(params)
+
+    clones = []
+    tasks = []
+    try:
+        for index in range(clone_count):
+            clone = os.path.join(clone_dir, "sysprep_clone%d.qcow2" % index)
+            utils.run("%s create -f qcow2 -o backing_file=%s,backing_fmt=%s "
+                      "%s" % (qemu_img, image, image_format, clone))
+            clones.append(clone)
+            tasks.append(("clone%d" % index, sysprep_clone,
+                          (clone, options, timeout)))
+        start = time.time()
+        results = parallel_utils.run_in_processes(tasks, workers, timeout)
+        wall = time.time() - start
+    finally:
+        for clone in clones:
+            if os.path.exists(clone):
+                os.remove(clone)
+    parallel_utils.raise_for_failures(results)
+
+    step_times = {}
+    for result in results:
+        for name, seconds in result["value"]["steps"].items():
+            step_times.setdefault(name, []).append(seconds)
+    steps = dict((name, bench_utils.sample_stats(values))
+                 for name, values in step_times.items())
+    slowest = sorted(steps, key=lambda name: steps[name]["mean"],
+                     reverse=True)[:top]
+    report = {"clones": clone_count, "workers": workers,
+              "options": options, "wall_seconds": wall,
+              "guests_per_minute": clone_count * 60.0 / wall,
+              "guest_seconds": bench_utils.sample_stats(
+                  [result["value"]["elapsed"] for result in results]),
+              "steps": steps, "slowest_steps": slowest}
+    logging.info("virt-sysprep on %s clones with %s workers: %.1f "
+                 "guests/minute", clone_count, workers,
+                 report["guests_per_minute"])
+    for name in slowest:
+        logging.info("  %s: mean %.2fs, max %.2fs", name,
+                     steps[name]["mean"], steps[name]["max"])
+    bench_utils.save_report(test, "virt_sysprep_parallel", report)
+
 
 def run(test, params, env):
     """
@@ -152,6 +270,11 @@ def run(test, params, env):
             raise error.TestNAError("This test case needs qcow2 format image.")
     else:
         raise error.TestError("Can not get disk of %s" % vm_name)
+    if sysprep_type == "parallel":
+        if vm.is_alive():
+            vm.destroy()
+        run_parallel(test, params, image, image_info_dict['format'])
+        return
     vt = utils_test.libguestfs.VirtTools(vm, params)
     fs_type = vt.get_primary_disk_fs_type()
     if fs_type != file_system:
@@ -1,60 +1,168 @@
+import time
+import zlib
+import Queue
+import logging
+import multiprocessing
+
 from autotest.client.shared import error
 from virttest import utils_test
 
+from provider import bench_utils
+
+
+SUB_TEST = "libvirt_bench_domstate_switch_in_loop"
+
+
+def shard_vms(vms, shard_count, strategy="index"):
+    """
+    Split vms into at most shard_count groups.
+
+    :param vms: List of vm.
+    :param shard_count: Number of groups to split into.
+    :param strategy: How to split the vms:
+                     index: round robin on the vm index,
+                     hash: crc32 of the vm name,
+                     memory: balance the total max memory of each group.
+    :return: List of non-empty vm lists.
+    """
+    shards = [[] for _ in range(shard_count)]
+    if strategy == "index":
+        for index, vm in enumerate(vms):
+            shards[index % shard_count].append(vm)
+    elif strategy == "hash":
+        for vm in vms:
+            key = zlib.crc32(vm.name) & 0xffffffff
+            shards[key % shard_count].append(vm)
+    elif strategy == "memory":
+        # Put the biggest vm into the lightest shard first.
+        loads = [0] * shard_count
+        vm_mems = [(vm.get_max_mem(), vm) for vm in vms]
+        vm_mems.sort(key=lambda item: item[0], reverse=True)
+        for mem, vm in vm_mems:
+            lightest = loads.index(min(loads))
+            shards[lightest].append(vm)
+            loads[lightest] += mem
+    else:
+        raise error.TestError("Unknown sharding strategy: %s" % strategy)
+    return [shard for shard in shards if shard]
+
+
+def run_shard(result_queue, test, params, env, shard_index):
+    """
+    Run the sub test on one shard and put its result into result_queue.
+
+    Exceptions are caught here so that a failing shard never hides the
+    results of the others.
+    """
+    vm_names = [vm.name for vm in env.get_all_vms()]
+    result = {"shard": shard_index, "vms": vm_names,
+              "status": "PASS", "detail": ""}
+    result["start"] = time.time()
+    try:
+        utils_test.run_virt_sub_test(test, params, env, SUB_TEST)
+    except error.TestNAError, detail:
+        result["status"] = "SKIP"
+        result["detail"] = str(detail)
+    except Exception, detail:
+        result["status"] = "FAIL"
+        result["detail"] = str(detail)
+    result["end"] = time.time()
+    result["elapsed"] = result["end"] - result["start"]
+    result_queue.put(result)
+
 
 def run(test, params, env):
     """
     Test steps:
 
     1) Get the params from params.
-    2) Divide vms into two groups and run sub test for each group.
-    3) clean up.
+    2) Divide vms into shards and run sub test for each shard, in a
+       thread or in a worker process per shard.
+    3) Merge the results of all shards into one report.
+    4) clean up.
     """
     # Get VMs.
     vms = env.get_all_vms()
     if len(vms) < 2:
         raise error.TestNAError("We need at least 2 vms for this test.")
-    timeout = params.get("LB_domstate_switch_loop_time", 600)
-    # Divide vms into two groups.
-    odd_group_vms = []
-    even_group_vms = []
-    for index in range(len(vms)):
-        if (index % 2):
-            even_group_vms.append(vms[index])
+    timeout = int(params.get("LB_domstate_switch_loop_time", 600))
+    shard_count = int(params.get("LB_domstate_switch_shard_count", 2))
+    strategy = params.get("LB_domstate_switch_shard_strategy", "index")
+    executor = params.get("LB_domstate_switch_shard_executor", "thread")
+    if shard_count < 1:
+        raise error.TestError("Shard count must be positive, got %s."
+                              % shard_count)
+    if executor not in ["thread", "process"]:
+        raise error.TestError("Unknown shard executor: %s" % executor)
+
+    # Divide vms into shards.
+    shards = shard_vms(vms, shard_count, strategy)
+    if executor == "process":
+        result_queue = multiprocessing.Queue()
+    else:
+        result_queue = Queue.Queue()
+    workers = []
+    test_start = time.time()
+    for shard_index, shard in enumerate(shards):
+        shard_env = env.copy()
+        # Unregister vm which does not belong to this shard.
+        shard_names = [vm.name for vm in shard]
+        for vm in vms:
+            if vm.name not in shard_names:
+                shard_env.unregister_vm(vm.name)
+        shard_params = params.copy()
+        shard_params["LB_report_suffix"] = "shard%d" % shard_index
+        logging.debug("Shard %s runs on %s.", shard_index, shard_names)
+        worker_args = [result_queue, test, shard_params, shard_env,
+                       shard_index]
+        if executor == "process":
+            worker = multiprocessing.Process(target=run_shard,
+                                             args=worker_args)
         else:
-            odd_group_vms.append(vms[index])
-
-    # Run sub test for odd_group_vms.
-    odd_env = env.copy()
-    # Unregister vm which belong to even_group from odd_env.
-    for vm in even_group_vms:
-        odd_env.unregister_vm(vm.name)
-    odd_bt = utils_test.BackgroundTest(utils_test.run_virt_sub_test,
-                                       params=[test, params, odd_env,
-                                               "libvirt_bench_domstate_switch_in_loop"])
-    odd_bt.start()
-
-    # Run sub test for even_group_vms.
-    even_env = env.copy()
-    # Unregister vm which belong to odd_group from even_env.
-    for vm in odd_group_vms:
-        even_env.unregister_vm(vm.name)
-    even_bt = utils_test.BackgroundTest(utils_test.run_virt_sub_test,
-                                        params=[test, params, even_env,
-                                                "libvirt_bench_domstate_switch_in_loop"])
-    even_bt.start()
-
-    # Wait for background_tests joining.
+            worker = utils_test.BackgroundTest(run_shard, worker_args)
+        worker.start()
+        workers.append((shard_index, shard_names, worker))
+
+    # Wait for all shards, a slow shard does not stop the others.
+    results = {}
+    deadline = time.time() + timeout * 2
+    for shard_index, shard_names, worker in workers:
+        remain = max(deadline - time.time(), 1)
+        if executor == "process":
+            worker.join(remain)
+            if worker.is_alive():
+                worker.terminate()
+                worker.join()
+        else:
+            worker.join(remain, ignore_status=True)
+    while True:
+        try:
+            result = result_queue.get(timeout=1)
+        except Queue.Empty:
+            break
+        results[result["shard"]] = result
+    for shard_index, shard_names, worker in workers:
+        if shard_index not in results:
+            results[shard_index] = {"shard": shard_index,
+                                    "vms": shard_names,
+                                    "status": "TIMEOUT",
+                                    "detail": "No result in %s seconds."
+                                              % (timeout * 2)}
+
+    report = {"executor": executor,
+              "strategy": strategy,
+              "shard_count": len(shards),
+              "elapsed": time.time() - test_start,
+              "shards": [results[index] for index in sorted(results)]}
+    bench_utils.save_report(test, "domstate_switch_by_groups", report)
+
     err_msg = ""
-    try:
-        odd_bt.join(int(timeout) * 2)
-    except error.TestFail, detail:
-        err_msg += ("Group odd_group failed to run sub test.\n"
-                    "Detail: %s." % detail)
-    try:
-        even_bt.join(int(timeout) * 2)
-    except error.TestFail, detail:
-        err_msg += ("Group even_group failed to run sub test.\n"
-                    "Detail: %s." % detail)
+    for result in report["shards"]:
+        logging.info("Shard %s (%s): %s", result["shard"],
+                     ",".join(result["vms"]), result["status"])
+        if result["status"] in ["FAIL", "TIMEOUT"]:
+            err_msg += ("Shard %s %s failed to run sub test.\n"
+                        "Detail: %s.\n" % (result["shard"], result["vms"],
+                                           result["detail"]))
     if err_msg:
         raise error.TestFail(err_msg)
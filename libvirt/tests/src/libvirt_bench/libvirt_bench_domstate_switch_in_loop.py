@@ -1,9 +1,14 @@
 import time
 import logging
+from multiprocessing.pool import ThreadPool
 
 from autotest.client.shared import error
 from virttest import virsh
 
+from provider import bench_utils
+from provider import bench_baseline
+from provider import libvirt_events
+
 
 def run(test, params, env):
     """
@@ -17,7 +22,8 @@ def run(test, params, env):
             suspend
             resume
             destroy
-    3) clean up.
+    3) Save latency histograms of each operation.
+    4) clean up.
     """
     def for_each_vm(vms, virsh_func, state_list=None):
         """
@@ -28,16 +34,24 @@ def run(test, params, env):
         :Param state_list: States to verify the result of virsh_func.
                            None means do not check the state.
         """
+        if worker_pool is not None:
+            for_each_vm_concurrent(vms, virsh_func, state_list)
+            return
         vm_names = []
         for vm in vms:
             vm_names.append(vm.name)
         for vm_name in vm_names:
-            cmd_result = virsh_func(vm_name)
+            cmd_result = recorder.time_call(
+                virsh_func.__name__, vm_name,
+                bench_utils.get_virsh_func(virsh_func, session_pool),
+                vm_name)
             if cmd_result.exit_status:
                 raise error.TestFail(cmd_result)
             if state_list is None:
                 continue
-            actual_state = virsh.domstate(vm_name).stdout.strip()
+            domstate = bench_utils.get_virsh_func(virsh.domstate,
+                                                  session_pool)
+            actual_state = domstate(vm_name).stdout.strip()
             if actual_state not in state_list:
                 raise error.TestFail("Command %s succeed, but the state is %s,"
                                      "but not %s." %
@@ -46,6 +60,75 @@ def run(test, params, env):
         logging.debug("Operation %s on %s succeed.",
                       virsh_func.__name__, vm_names)
 
+    def for_each_vm_concurrent(vms, virsh_func, state_list=None):
+        """
+        Execute the virsh_func on all vms at once with the worker pool,
+        then verify the states with a single 'virsh list --all'.
+
+        Params are the same as for_each_vm.
+        """
+        vm_names = [vm.name for vm in vms]
+
+        def run_virsh_func(vm_name):
+            return recorder.time_call(
+                virsh_func.__name__, vm_name,
+                bench_utils.get_virsh_func(virsh_func, session_pool),
+                vm_name)
+        cmd_results = worker_pool.map(run_virsh_func, vm_names)
+        err_msg = ""
+        for cmd_result in cmd_results:
+            if cmd_result.exit_status:
+                err_msg += "%s\n" % cmd_result
+        if err_msg:
+            raise error.TestFail(err_msg)
+        if state_list is not None:
+            if session_pool is None:
+                states = bench_utils.get_domstates()
+            else:
+                states = bench_utils.get_domstates(session_pool.get())
+            for vm_name in vm_names:
+                actual_state = states.get(vm_name)
+                if actual_state not in state_list:
+                    raise error.TestFail("Command %s succeed, but the state "
+                                         "of %s is %s, but not %s." %
+                                         (virsh_func.__name__, vm_name,
+                                          actual_state, str(state_list)))
+        logging.debug("Operation %s on %s succeed concurrently.",
+                      virsh_func.__name__, vm_names)
+
+    def wait_for_all(vms, wait_func):
+        """
+        Call wait_func for each vm, concurrently in concurrent mode.
+
+        :return: True if wait_func succeed for all vms.
+        """
+        if worker_pool is not None:
+            return all(worker_pool.map(wait_func, vms))
+        for vm in vms:
+            if not wait_func(vm):
+                return False
+        return True
+
+    def wait_for_login(vm):
+        """
+        Wait for login to vm and record how long it takes.
+        """
+        session = recorder.time_call("wait_for_login", vm.name,
+                                     vm.wait_for_login)
+        if not session:
+            return False
+        session.close()
+        return True
+
+    def wait_for_shutdown(vm):
+        """
+        Wait for vm to shutdown and record how long it takes.
+        The state is checked again as soon as a lifecycle event arrives.
+        """
+        return recorder.time_call("wait_for_shutdown", vm.name,
+                                  event_monitor.wait_for, vm.is_dead, 240,
+                                  domain=vm.name, event="lifecycle", step=1)
+
     # Get VMs.
     vms = env.get_all_vms()
     # Get operations from params.
@@ -65,35 +148,65 @@ def run(test, params, env):
     resume_in_loop = ("yes" == params.get("LB_domstate_switch_resume", "no"))
     resume_post_state = params.get("LB_domstate_switch_resume_post_state",
                                    "running").split(',')
+    # Run each operation on all vms at once with a bounded worker pool.
+    concurrent = ("yes" == params.get("LB_domstate_switch_concurrent", "no"))
+    workers = int(params.get("LB_domstate_switch_workers", len(vms)))
+    # Route virsh commands through one persistent session per worker.
+    persistent = ("yes" == params.get("LB_virsh_persistent", "no"))
+    # Wake up waits on domain events instead of polling.
+    event_wait = ("yes" == params.get("LB_event_wait", "yes"))
     # Get the loop_time.
     loop_time = int(params.get("LB_domstate_switch_loop_time", "600"))
     current_time = int(time.time())
     end_time = current_time + loop_time
     # Init a counter for the loop.
     loop_counter = 0
+    # Latency of each operation on each vm.
+    recorder = bench_utils.LatencyRecorder()
+    report_name = "domstate_switch_in_loop"
+    if params.get("LB_report_suffix"):
+        report_name += "_%s" % params.get("LB_report_suffix")
+    worker_pool = None
+    if concurrent:
+        worker_pool = ThreadPool(max(min(workers, len(vms)), 1))
+    session_pool = None
+    if persistent:
+        session_pool = bench_utils.VirshSessionPool()
+    virsh_operations = []
+    for in_loop, virsh_func in [(shutdown_in_loop, virsh.shutdown),
+                                (destroy_in_loop, virsh.destroy),
+                                (start_in_loop, virsh.start),
+                                (suspend_in_loop, virsh.suspend),
+                                (resume_in_loop, virsh.resume)]:
+        if in_loop:
+            virsh_operations.append(virsh_func.__name__)
+    overhead = None
+    event_monitor = libvirt_events.EventMonitor()
+    if event_wait:
+        event_monitor.start()
     try:
         try:
             # Verify the vms is all loaded completely.
             for vm in vms:
                 vm.wait_for_login()
+            # Measure the fixed cost of a virsh command.
+            overhead = bench_utils.measure_virsh_overhead()
             # Start the loop from current_time to end_time.
             while current_time < end_time:
                 if loop_counter > (len(vms) * 1000 * loop_time):
                     raise error.TestFail("Loop ")
                 if shutdown_in_loop:
                     for_each_vm(vms, virsh.shutdown, shutdown_post_state)
-                    for vm in vms:
-                        if not vm.wait_for_shutdown(count=240):
-                            raise error.TestFail("Command shutdown succeed, but "
-                                                 "failed to wait for shutdown.")
+                    if not wait_for_all(vms, wait_for_shutdown):
+                        raise error.TestFail("Command shutdown succeed, but "
+                                             "failed to wait for shutdown.")
                 if destroy_in_loop:
                     for_each_vm(vms, virsh.destroy, destroy_post_state)
                 if start_in_loop:
                     for_each_vm(vms, virsh.start, start_post_state)
-                    for vm in vms:
-                        if not vm.wait_for_login():
-                            raise error.TestFail("Command start succeed, but "
-                                                 "failed to wait for login.")
+                    if not wait_for_all(vms, wait_for_login):
+                        raise error.TestFail("Command start succeed, but "
+                                             "failed to wait for login.")
                 if suspend_in_loop:
                     for_each_vm(vms, virsh.suspend, suspend_post_state)
                 if resume_in_loop:
@@ -106,8 +219,27 @@ def run(test, params, env):
             raise error.TestFail("Succeed for %s loop, and got an error.\n"
                                  "Detail: %s." % (loop_counter, detail))
     finally:
+        # Save the latency of operations even if the loop failed.
+        recorder.log_summary()
+        report = recorder.report()
+        report["loops"] = loop_counter
+        report["vms_count"] = len(vms)
+        report["concurrent"] = concurrent
+        if overhead is not None:
+            bench_utils.split_virsh_overhead(report, overhead,
+                                             virsh_operations, persistent)
+        if worker_pool is not None:
+            worker_pool.close()
+            worker_pool.join()
+        if session_pool is not None:
+            session_pool.close()
+        event_monitor.stop()
+        bench_utils.save_report(test, report_name, report)
         # Resume vm if vm is paused.
         for vm in vms:
             if vm.is_paused():
                 vm.resume()
             vm.destroy()
+    # Compare the latency with the baseline.
+    bench_baseline.check_results(test, params,
+                                 bench_baseline.latency_metrics(report))
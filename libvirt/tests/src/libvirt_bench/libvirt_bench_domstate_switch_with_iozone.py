@@ -5,16 +5,29 @@ import logging
 from autotest.client.shared import error
 from virttest import virsh, utils_test, utils_misc
 
+from provider import bench_utils
+from provider import bench_baseline
 
-def func_in_thread(vm, timeout):
+
+VIRSH_OPERATIONS = ["dom_list", "dominfo", "nodeinfo", "domuuid", "domid",
+                    "dumpxml", "domstate", "suspend", "resume"]
+
+
+def func_in_thread(vm, timeout, recorder, session_pool=None):
     """
     Function run in thread to switch domstate.
+
+    :param recorder: LatencyRecorder to record each virsh command in
+    :param session_pool: VirshSessionPool to run virsh commands in,
+                         None means fork a new virsh for each command
     """
     def run_virsh_function(func, params):
         """
         Function to run virsh function and check the result.
         """
-        result = func(params)
+        result = recorder.time_call(
+            func.__name__, vm.name,
+            bench_utils.get_virsh_func(func, session_pool), params)
         if result.exit_status:
             raise error.TestFail(result)
     # Get current time.
@@ -47,6 +60,8 @@ def run(test, params, env):
     iozone_control_file = params.get("iozone_control_file",
                                      "iozone.control")
     timeout = int(params.get("LB_domstate_with_iozone_loop_time", "600"))
+    # Route virsh commands through one persistent session per thread.
+    persistent = ("yes" == params.get("LB_virsh_persistent", "no"))
     # Run iozone on guest.
     params["test_control_file"] = iozone_control_file
     # Fork a new process to run iozone on each guest.
@@ -74,11 +89,18 @@ def run(test, params, env):
                                     "such as gcc, tar, bzip2")
     logging.debug("Iozone is already running in VMs.")
 
+    recorder = bench_utils.LatencyRecorder()
+    session_pool = None
+    if persistent:
+        session_pool = bench_utils.VirshSessionPool()
+    overhead = bench_utils.measure_virsh_overhead()
     try:
         # Create a BackgroundTest for each vm to run test domstate_switch.
         backgroud_tests = []
         for vm in vms:
-            bt = utils_test.BackgroundTest(func_in_thread, [vm, timeout])
+            bt = utils_test.BackgroundTest(func_in_thread,
+                                           [vm, timeout, recorder,
+                                            session_pool])
             bt.start()
             backgroud_tests.append(bt)
 
@@ -89,5 +111,14 @@ def run(test, params, env):
         for vm in vms:
             vm.reboot()
     finally:
-        # Clean up.
-        logging.debug("No cleaning operation for this test.")
+        # Save the latency of virsh commands.
+        recorder.log_summary()
+        report = recorder.report()
+        bench_utils.split_virsh_overhead(report, overhead, VIRSH_OPERATIONS,
+                                         persistent)
+        bench_utils.save_report(test, "domstate_switch_with_iozone", report)
+        if session_pool is not None:
+            session_pool.close()
+    # Compare the latency with the baseline.
+    bench_baseline.check_results(test, params,
+                                 bench_baseline.latency_metrics(report))
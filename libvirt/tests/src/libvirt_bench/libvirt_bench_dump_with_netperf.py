@@ -4,6 +4,9 @@ import logging
 from autotest.client.shared import error
 from virttest import utils_test, utils_misc
 
+from provider import bench_utils
+from provider import bench_baseline
+
 
 def run(test, params, env):
     """
@@ -12,7 +15,8 @@ def run(test, params, env):
     1) Get the params from params.
     2) Run netperf on guest.
     3) Dump each VM and check result.
-    3) Clean up.
+    4) Compare the dump time with the baseline.
+    5) Clean up.
     """
     vms = env.get_all_vms()
     netperf_control_file = params.get("netperf_controle_file",
@@ -47,10 +51,11 @@ def run(test, params, env):
 
     logging.debug("Netperf is already running in VMs.")
 
+    recorder = bench_utils.LatencyRecorder()
     try:
         dump_path = os.path.join(test.tmpdir, "dump_file")
         for vm in vms:
-            vm.dump(dump_path)
+            recorder.time_call("dump", vm.name, vm.dump, dump_path)
             # Check the status after vm.dump()
             if not vm.is_alive():
                 raise error.TestFail("VM is shutoff after dump.")
@@ -64,3 +69,9 @@ def run(test, params, env):
             vm.destroy()
         for bt in guest_netperf_bts:
             bt.join(ignore_status=True)
+    # Compare the dump time with the baseline.
+    recorder.log_summary()
+    report = recorder.report()
+    bench_utils.save_report(test, "dump_with_netperf", report)
+    bench_baseline.check_results(
+        test, params, bench_baseline.latency_metrics(report, ("mean", "max")))
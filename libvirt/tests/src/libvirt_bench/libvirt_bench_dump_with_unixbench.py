@@ -4,6 +4,9 @@ import logging
 from autotest.client.shared import error
 from virttest import utils_test, utils_misc
 
+from provider import bench_utils
+from provider import bench_baseline
+
 
 def run(test, params, env):
     """
@@ -12,7 +15,8 @@ def run(test, params, env):
     1) Get the params from params.
     2) Run unixbench on guest.
     3) Dump each VM and check result.
-    3) Clean up.
+    4) Compare the dump time with the baseline.
+    5) Clean up.
     """
     vms = env.get_all_vms()
     unixbench_control_file = params.get("unixbench_controle_file",
@@ -44,10 +48,11 @@ def run(test, params, env):
 
     logging.debug("Unixbench is already running in VMs.")
 
+    recorder = bench_utils.LatencyRecorder()
     try:
         dump_path = os.path.join(test.tmpdir, "dump_file")
         for vm in vms:
-            vm.dump(dump_path)
+            recorder.time_call("dump", vm.name, vm.dump, dump_path)
             # Check the status after vm.dump()
             if not vm.is_alive():
                 raise error.TestFail("VM is shutoff after dump.")
@@ -59,3 +64,9 @@ def run(test, params, env):
         # Destroy VM.
         for vm in vms:
             vm.destroy()
+    # Compare the dump time with the baseline.
+    recorder.log_summary()
+    report = recorder.report()
+    bench_utils.save_report(test, "dump_with_unixbench", report)
+    bench_baseline.check_results(
+        test, params, bench_baseline.latency_metrics(report, ("mean", "max")))
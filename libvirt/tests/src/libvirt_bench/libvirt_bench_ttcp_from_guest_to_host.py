@@ -1,9 +1,53 @@
+import re
 import time
 import logging
+from multiprocessing.pool import ThreadPool
 
-from autotest.client import os_dep, utils
+from autotest.client import os_dep
 from autotest.client.shared import error
-from virttest import virsh, utils_net, remote, aexpect, utils_misc
+from virttest import utils_net, remote, aexpect, utils_misc
+
+from provider import bench_utils
+from provider import bench_baseline
+
+
+# Such as "ttcp-t: 65536000 bytes in 0.58 real seconds = 110344.83 KB/sec"
+TTCP_REAL_RE = re.compile(r"(\d+) bytes in ([\d.]+) real seconds = "
+                          r"([\d.]+) (\w+)/sec")
+TTCP_CPU_RE = re.compile(r"bytes in ([\d.]+) CPU seconds")
+# Factor to convert the rate units of ttcp -f into KB/sec.
+TTCP_UNITS = {"Kbit": 1 / 8.0, "KB": 1.0,
+              "Mbit": 128.0, "MB": 1024.0,
+              "Gbit": 131072.0, "GB": 1048576.0}
+
+
+def parse_ttcp_output(output):
+    """
+    Parse the transmit side output of ttcp.
+
+    :param output: Output of ttcp -t -v
+    :return: Dict with bytes, real_seconds, cpu_seconds and kb_per_sec,
+             None if output has no result line
+    """
+    mobj = TTCP_REAL_RE.search(output)
+    if not mobj or mobj.group(4) not in TTCP_UNITS:
+        return None
+    sample = {"bytes": int(mobj.group(1)),
+              "real_seconds": float(mobj.group(2)),
+              "kb_per_sec": float(mobj.group(3)) * TTCP_UNITS[mobj.group(4)]}
+    mobj = TTCP_CPU_RE.search(output)
+    if mobj:
+        sample["cpu_seconds"] = float(mobj.group(1))
+    return sample
+
+
+def set_ttcp_port(command, port):
+    """
+    Replace the -p option of a ttcp command with port.
+    """
+    if re.search(r"-p\s*\d+", command):
+        return re.sub(r"-p\s*\d+", "-p%s" % port, command)
+    return "%s -p%s" % (command, port)
 
 
 def run(test, params, env):
@@ -12,9 +56,45 @@ def run(test, params, env):
 
     1) Check the environment and get the params from params.
     2) while(loop_time < timeout):
-            ttcp command.
-    3) clean up.
+            ttcp command, for each vm in turn or for all vms at once.
+    3) Report the throughput of each vm and compare it with the baseline.
+    4) clean up.
     """
+    def run_ttcp(vm):
+        """
+        Run one ttcp transfer from vm to host.
+
+        :return: Dict of the parsed ttcp result
+        """
+        host_session = host_sessions[vm.name]
+        session = sessions[vm.name]
+        port = ports[vm.name]
+        host_session.sendline(set_ttcp_port(ttcp_server_command, port))
+        cmd = ("%s %s" % (set_ttcp_port(ttcp_client_command, port),
+                          host_ip))
+        outputs = []
+
+        def _ttcp_good():
+            status, output = session.cmd_status_output(cmd)
+            logging.debug(output)
+            outputs.append(output)
+            if status:
+                return False
+            return True
+
+        if not utils_misc.wait_for(_ttcp_good, timeout=5):
+            status, output = session.cmd_status_output(cmd)
+            if status:
+                raise error.TestFail("Failed to run ttcp command on guest.\n"
+                                     "Detail: %s." % output)
+            outputs.append(output)
+        remote.handle_prompts(host_session, None, None, r"[\#\$]\s*$")
+        sample = parse_ttcp_output(outputs[-1])
+        if sample is None:
+            raise error.TestFail("Failed to parse ttcp output of %s:\n%s"
+                                 % (vm.name, outputs[-1]))
+        return sample
+
     # Find the ttcp command.
     try:
         os_dep.command("ttcp")
@@ -22,8 +102,11 @@ def run(test, params, env):
         raise error.TestNAError("Not find ttcp command on host.")
     # Get VM.
     vms = env.get_all_vms()
+    # Login once, the login cost is not part of the measured numbers.
+    sessions = {}
     for vm in vms:
         session = vm.wait_for_login()
+        sessions[vm.name] = session
         status, _ = session.cmd_status_output("which ttcp")
         if status:
             raise error.TestNAError("Not find ttcp command on guest.")
@@ -33,35 +116,78 @@ def run(test, params, env):
                                      "ttcp -s -r -v -D -p5015")
     ttcp_client_command = params.get("LB_ttcp_client_command",
                                      "ttcp -s -t -v -D -p5015 -b65536 -l65536 -n1000 -f K")
+    concurrent = ("yes" == params.get("LB_ttcp_concurrent", "no"))
+    host_ip = utils_net.get_host_ip_address(params)
 
-    host_session = aexpect.ShellSession("sh")
+    # Each vm talks to its own ttcp server on its own port.
+    base_port = 5015
+    mobj = re.search(r"-p\s*(\d+)", ttcp_server_command)
+    if mobj:
+        base_port = int(mobj.group(1))
+    ports = {}
+    host_sessions = {}
+    for index, vm in enumerate(vms):
+        ports[vm.name] = base_port
+        if concurrent:
+            ports[vm.name] = base_port + index
+        host_sessions[vm.name] = aexpect.ShellSession("sh")
 
+    samples = dict((vm.name, []) for vm in vms)
+    round_totals = []
+    worker_pool = None
+    if concurrent:
+        worker_pool = ThreadPool(len(vms))
     try:
         current_time = int(time.time())
         end_time = current_time + timeout
         # Start the loop from current_time to end_time.
         while current_time < end_time:
-            for vm in vms:
-                session = vm.wait_for_login()
-                host_session.sendline(ttcp_server_command)
-
-                cmd = ("%s %s" % (ttcp_client_command, utils_net.get_host_ip_address(params)))
-
-                def _ttcp_good():
-                    status, output = session.cmd_status_output(cmd)
-                    logging.debug(output)
-                    if status:
-                        return False
-                    return True
-
-                if not utils_misc.wait_for(_ttcp_good, timeout=5):
-                    status, output = session.cmd_status_output(cmd)
-                    if status:
-                        raise error.TestFail("Failed to run ttcp command on guest.\n"
-                                             "Detail: %s." % output)
-                remote.handle_prompts(host_session, None, None, r"[\#\$]\s*$")
-                current_time = int(time.time())
+            if worker_pool is not None:
+                round_samples = worker_pool.map(run_ttcp, vms)
+            else:
+                round_samples = [run_ttcp(vm) for vm in vms]
+            for vm, sample in zip(vms, round_samples):
+                sample["iteration"] = len(samples[vm.name])
+                samples[vm.name].append(sample)
+            # Throughput of the host in this round, summed over vms
+            # transferring at the same time.
+            if concurrent:
+                round_totals.append(sum(sample["kb_per_sec"]
+                                        for sample in round_samples))
+            else:
+                round_totals.extend(sample["kb_per_sec"]
+                                    for sample in round_samples)
+            current_time = int(time.time())
     finally:
         # Clean up.
-        host_session.close()
-        session.close()
+        if worker_pool is not None:
+            worker_pool.close()
+            worker_pool.join()
+        for host_session in host_sessions.values():
+            host_session.close()
+        for session in sessions.values():
+            session.close()
+
+    report = {"concurrent": concurrent, "vms": {}}
+    for vm_name, vm_samples in samples.items():
+        report["vms"][vm_name] = {
+            "samples": vm_samples,
+            "kb_per_sec": bench_utils.sample_stats(
+                [sample["kb_per_sec"] for sample in vm_samples])}
+    report["aggregate"] = {
+        "kb_per_sec": bench_utils.sample_stats(
+            [sample["kb_per_sec"] for vm_samples in samples.values()
+             for sample in vm_samples]),
+        "host_kb_per_sec": bench_utils.sample_stats(round_totals)}
+    for vm_name in sorted(report["vms"]):
+        logging.info("ttcp throughput of %s: %s", vm_name,
+                     report["vms"][vm_name]["kb_per_sec"])
+    host_stats = report["aggregate"]["host_kb_per_sec"]
+    logging.info("ttcp throughput of host: %s", host_stats)
+
+    bench_utils.save_report(test, "ttcp_from_guest_to_host", report)
+    # Compare the throughput with the baseline.
+    metrics = {"host_kb_per_sec": host_stats.get("mean"),
+               "vm_kb_per_sec": report["aggregate"]["kb_per_sec"].get("mean")}
+    bench_baseline.check_results(test, params, metrics,
+                                 higher_is_better=metrics.keys())
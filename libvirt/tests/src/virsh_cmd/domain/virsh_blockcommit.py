@@ -8,6 +8,8 @@ from virttest.libvirt_xml import vm_xml
 from virttest.utils_test import libvirt
 from virttest.libvirt_xml.devices.disk import Disk
 from provider import libvirt_version
+from provider import bench_utils
+from provider import blockjob_bench
 
 
 def check_chain_xml(disk_xml, chain_lst):
@@ -92,6 +94,18 @@ def run(test, params, env):
                 raise error.TestFail("Touch file in vm failed. %s" % output)
             snapshot_flag_files.append(file_path)
 
+            if fill_mb:
+                # Give the job fill_mb MiB of clusters in this layer. The
+                # file is removed again, its clusters stay allocated.
+                fill_path = "/var/tmp/%s.fill" % os.path.basename(file_path)
+                status, output = session.cmd_status_output(
+                    "dd if=/dev/urandom of=%s bs=1M count=%s conv=fsync && "
+                    "rm -f %s && sync" % (fill_path, fill_mb, fill_path),
+                    timeout=300)
+                if status:
+                    raise error.TestFail("Fill data in vm failed. %s"
+                                         % output)
+
     # MAIN TEST CODE ###
     # Process cartesian parameters
     vm_name = params.get("main_vm")
@@ -108,6 +122,12 @@ def run(test, params, env):
     snap_in_mirror = "yes" == params.get("snap_in_mirror", "no")
     snap_in_mirror_err = "yes" == params.get("snap_in_mirror_err", "no")
     virsh_dargs = {'debug': True}
+    # Sample the progress of the commit and check its --bandwidth limit
+    benchmark = "yes" == params.get("blockjob_benchmark", "no")
+    bandwidth = params.get("blockjob_bandwidth")
+    # MiB written in the guest after every snapshot, so the job has data
+    # to copy at its bandwidth limit
+    fill_mb = int(params.get("blockjob_fill_mb", "0"))
 
     # Process domain disk device parameters
     disk_type = params.get("disk_type")
@@ -218,13 +238,37 @@ def run(test, params, env):
             if pivot_opt:
                 blockcommit_options += " --pivot"
 
+        if bandwidth:
+            blockcommit_options += " --bandwidth %s" % bandwidth
+
         if vm_state == "shut off":
             vm.shutdown()
 
+        sampler = None
+        if benchmark:
+            sampler = blockjob_bench.BlockJobSampler(
+                vm_name, blk_target,
+                float(params.get("blockjob_sample_interval", "0.1")),
+                blockjob_bench.image_virtual_size(blk_source))
+            sampler.start()
+
         # Run test case
         result = virsh.blockcommit(vm_name, blk_target,
                                    blockcommit_options, **virsh_dargs)
 
+        if sampler is not None:
+            report = sampler.stop()
+            report.update({"options": blockcommit_options,
+                           "bandwidth_limit": bandwidth})
+            bench_utils.save_report(test, "blockjob_blockcommit", report)
+            if bandwidth and not result.exit_status:
+                err = blockjob_bench.check_bandwidth(
+                    report, int(bandwidth),
+                    float(params.get("blockjob_bandwidth_tolerance", "0.1")),
+                    strict=bool(fill_mb))
+                if err:
+                    raise error.TestFail(err)
+
         # Check status_error
         libvirt.check_exit_status(result, status_error)
         if result.exit_status and status_error:
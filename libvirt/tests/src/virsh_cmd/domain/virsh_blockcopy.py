@@ -2,7 +2,7 @@ import logging
 import os
 import time
 import re
-from autotest.client.shared import error
+from autotest.client.shared import error, utils
 from virttest import utils_libvirtd
 from virttest import utils_config
 from virttest import virsh
@@ -13,6 +13,9 @@ from virttest import utils_misc
 from virttest.libvirt_xml import vm_xml
 from virttest.utils_test import libvirt as utl
 from provider import libvirt_version
+from provider import libvirt_events
+from provider import bench_utils
+from provider import blockjob_bench
 
 
 class JobTimeout(Exception):
@@ -124,16 +127,13 @@ def finish_job(vm_name, target, timeout):
     :param target: Domain disk target dev
     :param timeout: Timeout value of this function
     """
-    job_time = 0
-    while job_time < timeout:
-        if utl.check_blockjob(vm_name, target, "progress", "100"):
-            logging.debug("Block job progress up to 100%.")
-            break
-        else:
-            job_time += 2
-            time.sleep(2)
-    if job_time >= timeout:
+    def _job_finished():
+        return utl.check_blockjob(vm_name, target, "progress", "100")
+    # Check again as soon as a block job event of the domain arrives.
+    if not libvirt_events.wait_for(_job_finished, timeout, domain=vm_name,
+                                   event="block-job", step=2):
         raise JobTimeout(timeout)
+    logging.debug("Block job progress up to 100%.")
 
 
 def chk_libvirtd_log(file_path, pattern, log_type):
@@ -152,6 +152,122 @@ def chk_libvirtd_log(file_path, pattern, log_type):
     return False
 
 
+def bench_copy(vm_name, target, dest_path, options, size, params):
+    """
+    Run one block copy while sampling its progress, then abort it.
+
+    :return: Report of BlockJobSampler.stop() with the size of the copy
+    """
+    interval = float(params.get("blockjob_sample_interval", "0.1"))
+    duration = int(params.get("blockjob_bench_duration", "300"))
+    sampler = blockjob_bench.BlockJobSampler(vm_name, target, interval, size)
+    sampler.start()
+    result = virsh.blockcopy(vm_name, target, dest_path, options,
+                             ignore_status=True, debug=True)
+    if result.exit_status:
+        sampler.stop()
+        raise error.TestFail("blockcopy %s failed: %s"
+                             % (options, result.stderr.strip()))
+    completed = sampler.wait_done(duration)
+    report = sampler.stop()
+    # Leave the source disk in use, the copy is only measured.
+    virsh.blockjob(vm_name, target, "--abort", ignore_status=True)
+
+    def _job_gone():
+        output = virsh.blockjob(vm_name, target, "--info",
+                                ignore_status=True).stdout
+        return blockjob_bench.parse_blockjob_info(output) is None
+    if not utils_misc.wait_for(_job_gone, 60):
+        raise error.TestError("Block copy job of %s did not end" % target)
+    report["completed"] = completed
+    if os.path.exists(dest_path):
+        report["dest_allocated_bytes"] = os.stat(dest_path).st_blocks * 512
+        os.remove(dest_path)
+    return report
+
+
+def run_benchmark(test, params, env):
+    """
+    Measure block copy throughput for every combination of destination
+    format, copy mode and bandwidth limit, and check the limits hold.
+
+    Modes are full, shallow and reuse_external. shallow needs a backing
+    chain, so the disk is first moved onto an external snapshot; all modes
+    copy the same chain.
+    """
+    vm_name = params.get("main_vm")
+    vm = env.get_vm(vm_name)
+    target = params.get("target_disk", "vda")
+    formats = params.get("blockjob_bench_formats", "raw qcow2").split()
+    modes = params.get("blockjob_bench_modes",
+                       "full shallow reuse_external").split()
+    bandwidths = [int(bandwidth) for bandwidth in
+                  params.get("blockjob_bench_bandwidths", "0 50").split()]
+    tolerance = float(params.get("blockjob_bandwidth_tolerance", "0.1"))
+    tmp_dir = data_dir.get_tmp_dir()
+    snap_path = os.path.join(tmp_dir, "%s.bench.snap" % vm_name)
+    original_xml = vm.backup_xml()
+    results = []
+    fail_info = []
+    try:
+        # Block copy needs a transient domain before libvirt 1.2.8.
+        if vm.is_persistent():
+            vm.undefine()
+        if vm.is_dead():
+            vm.start()
+        vm.wait_for_login().close()
+        if "shallow" in modes:
+            snap_opt = ("--disk-only --atomic --no-metadata "
+                        "%s,snapshot=external,file=%s" % (target, snap_path))
+            ret = virsh.snapshot_create_as(vm_name, snap_opt,
+                                           ignore_status=True, debug=True)
+            utl.check_exit_status(ret)
+        source = vm.get_disk_devices()[target]["source"]
+        size = blockjob_bench.image_virtual_size(source)
+        for dest_format in formats:
+            for mode in modes:
+                if mode == "shallow" and dest_format == "raw":
+                    logging.info("Skip shallow copy to raw, it can not "
+                                 "have a backing file")
+                    continue
+                for bandwidth in bandwidths:
+                    dest_path = os.path.join(tmp_dir, "bench-copy.%s"
+                                             % dest_format)
+                    if dest_format == "raw":
+                        options = "--raw"
+                    else:
+                        options = "--format %s" % dest_format
+                    if mode == "shallow":
+                        options += " --shallow"
+                    elif mode == "reuse_external":
+                        utils.run("qemu-img create -f %s %s %s"
+                                  % (dest_format, dest_path, size))
+                        options += " --reuse-external"
+                    if bandwidth:
+                        options += " --bandwidth %s" % bandwidth
+                    report = bench_copy(vm_name, target, dest_path, options,
+                                        size, params)
+                    report.update({"dest_format": dest_format, "mode": mode,
+                                   "bandwidth_limit": bandwidth or None})
+                    results.append(report)
+                    if bandwidth:
+                        err = blockjob_bench.check_bandwidth(report,
+                                                             bandwidth,
+                                                             tolerance)
+                        if err:
+                            fail_info.append("%s: %s" % (options, err))
+    finally:
+        if vm.is_alive():
+            vm.destroy(gracefully=False)
+        virsh.define(original_xml)
+        if os.path.exists(snap_path):
+            os.remove(snap_path)
+        bench_utils.save_report(test, "blockjob_blockcopy",
+                                {"target": target, "copies": results})
+    if fail_info:
+        raise error.TestFail("\n".join(fail_info))
+
+
 def run(test, params, env):
     """
     Test command: virsh blockcopy.
@@ -167,6 +283,10 @@ def run(test, params, env):
         2.3 Do block copy for a persistent domain.
     """
 
+    if params.get("blockjob_benchmark", "no") == "yes":
+        run_benchmark(test, params, env)
+        return
+
     vm_name = params.get("main_vm")
     vm = env.get_vm(vm_name)
     target = params.get("target_disk", "")
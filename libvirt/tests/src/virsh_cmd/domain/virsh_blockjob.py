@@ -7,6 +7,7 @@ from virttest import utils_libvirtd
 from virttest.libvirt_xml import vm_xml
 from virttest.utils_test import libvirt as utl
 from virttest import virsh
+from provider import libvirt_events
 
 
 def finish_job(vm_name, target, timeout):
@@ -17,16 +18,13 @@ def finish_job(vm_name, target, timeout):
     :param target: Domain disk target dev
     :param timeout: Timeout value
     """
-    job_time = 0
-    while job_time < timeout:
-        if utl.check_blockjob(vm_name, target, "progress", "100"):
-            logging.debug("Block job progress up to 100%.")
-            break
-        else:
-            job_time += 2
-            time.sleep(2)
-    if job_time >= timeout:
+    def _job_finished():
+        return utl.check_blockjob(vm_name, target, "progress", "100")
+    # Check again as soon as a block job event of the domain arrives.
+    if not libvirt_events.wait_for(_job_finished, timeout, domain=vm_name,
+                                   event="block-job", step=2):
         raise error.TestFail("Blockjob timeout in %s sec.", timeout)
+    logging.debug("Block job progress up to 100%.")
 
 
 def get_disk(vm_name):
@@ -4,6 +4,8 @@ import tempfile
 from autotest.client.shared import error
 from virttest import virsh, data_dir
 from virttest.libvirt_xml import vm_xml
+from provider import bench_utils
+from provider import blockjob_bench
 
 
 def run(test, params, env):
@@ -53,6 +55,18 @@ def run(test, params, env):
                 raise error.TestFail("Touch file in vm failed. %s" % output)
             snapshot_flag_files.append(file_path)
 
+            if fill_mb:
+                # Give the job fill_mb MiB of clusters in this layer. The
+                # file is removed again, its clusters stay allocated.
+                fill_path = "/var/tmp/%s.fill" % os.path.basename(file_path)
+                status, output = session.cmd_status_output(
+                    "dd if=/dev/urandom of=%s bs=1M count=%s conv=fsync && "
+                    "rm -f %s && sync" % (fill_path, fill_mb, fill_path),
+                    timeout=300)
+                if status:
+                    raise error.TestFail("Fill data in vm failed. %s"
+                                         % output)
+
     # MAIN TEST CODE ###
     # Process cartesian parameters
     vm_name = params.get("main_vm")
@@ -63,6 +77,12 @@ def run(test, params, env):
     status_error = ("yes" == params.get("status_error", "no"))
     base_option = params.get("base_option", "none")
     virsh_dargs = {'debug': True}
+    # Sample the progress of the pull and check its --bandwidth limit
+    benchmark = "yes" == params.get("blockjob_benchmark", "no")
+    bandwidth = params.get("blockjob_bandwidth")
+    # MiB written in the guest after every snapshot, so the job has data
+    # to copy at its bandwidth limit
+    fill_mb = int(params.get("blockjob_fill_mb", "0"))
 
     # A backup of original vm
     vmxml_backup = vm_xml.VMXML.new_from_inactive_dumpxml(vm_name)
@@ -103,11 +123,35 @@ def run(test, params, env):
         if base_option != "none":
             blockpull_options += " --base %s" % base_image
 
+        if bandwidth:
+            blockpull_options += " --bandwidth %s" % bandwidth
+
+        sampler = None
+        if benchmark:
+            sampler = blockjob_bench.BlockJobSampler(
+                vm_name, first_disk['target'],
+                float(params.get("blockjob_sample_interval", "0.1")),
+                blockjob_bench.image_virtual_size(first_disk['source']))
+            sampler.start()
+
         # Run test case
         result = virsh.blockpull(vm_name, first_disk['target'],
                                  blockpull_options, **virsh_dargs)
         status = result.exit_status
 
+        if sampler is not None:
+            report = sampler.stop()
+            report.update({"options": blockpull_options,
+                           "bandwidth_limit": bandwidth})
+            bench_utils.save_report(test, "blockjob_blockpull", report)
+            if bandwidth and not status:
+                err = blockjob_bench.check_bandwidth(
+                    report, int(bandwidth),
+                    float(params.get("blockjob_bandwidth_tolerance", "0.1")),
+                    strict=bool(fill_mb))
+                if err:
+                    raise error.TestFail(err)
+
         # Check status_error
         if status_error and status == 0:
             raise error.TestFail("Expect fail, but run successfully!")
@@ -1,12 +1,25 @@
+import os
 import logging
 import subprocess
 import time
 from autotest.client.shared import error
 from autotest.client.shared import utils
 from autotest.client.shared import ssh_key
-from virttest import virsh, utils_misc
+from virttest import virsh, utils_misc, data_dir
 from virttest.utils_test import libvirt as utlv
 
+from provider import bench_utils
+from provider import migration_utils
+
+# Guest program rewriting one byte of every page of a buffer in a loop,
+# the small deltas XBZRLE compresses best.
+DIRTY_MEMORY_SCRIPT = ("import time\n"
+                       "buf = bytearray(%(size)d)\n"
+                       "while True:\n"
+                       "    for offset in range(0, %(size)d, 4096):\n"
+                       "        buf[offset] = (buf[offset] + 1) %% 256\n"
+                       "    time.sleep(%(pause)s)\n")
+
 
 def get_page_size():
     """
@@ -23,6 +36,140 @@ def get_page_size():
         return 4096
 
 
+def parse_size(size):
+    """
+    Convert a size such as 64M or 1G to bytes.
+    """
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+    size = size.strip()
+    if size[-1:].upper() in units:
+        return int(float(size[:-1]) * units[size[-1:].upper()])
+    return int(size)
+
+
+def start_workload(vm, params):
+    """
+    Start the dirty memory workload of compcache_workload in vm.
+
+    dirty: DIRTY_MEMORY_SCRIPT on compcache_dirty_size_mb of memory,
+           sleeping compcache_dirty_pause seconds after every pass
+    duplicate_pages: duplicate_pages.py of the shared scripts, as
+                     virsh_migrate_stress runs it
+    Anything else is run as a command in the guest.
+    """
+    workload = params.get("compcache_workload", "dirty")
+    session = vm.wait_for_login()
+    try:
+        if workload == "dirty":
+            script = DIRTY_MEMORY_SCRIPT % {
+                "size": int(params.get("compcache_dirty_size_mb",
+                                       "256")) * 1048576,
+                "pause": params.get("compcache_dirty_pause", "0.1")}
+            local_script = os.path.join(data_dir.get_tmp_dir(),
+                                        "dirty_memory.py")
+            script_file = open(local_script, "w")
+            try:
+                script_file.write(script)
+            finally:
+                script_file.close()
+            vm.copy_files_to(local_script, "/tmp")
+            command = "python /tmp/dirty_memory.py"
+        elif workload == "duplicate_pages":
+            shared_dir = os.path.dirname(data_dir.get_data_dir())
+            vm.copy_files_to(os.path.join(shared_dir, "scripts",
+                                          "duplicate_pages.py"), "/tmp")
+            command = "cd /tmp; python duplicate_pages.py"
+        else:
+            command = workload
+        logging.info("Start workload in %s: %s", vm.name, command)
+        session.cmd("nohup sh -c '%s' > /dev/null 2>&1 &" % command)
+    finally:
+        session.close()
+
+
+def run_sweep(test, params, env):
+    """
+    Migrate a vm running a dirty memory workload with --compressed, once
+    for every compression cache size of compcache_sweep_sizes, and report
+    migration time, downtime, bytes sent and cache miss rate per size.
+    """
+    vm_name = params.get("migrate_main_vm")
+    vm = env.get_vm(vm_name)
+    remote_uri = params.get("compcache_remote_uri")
+    remote_host = params.get("migrate_dest_host")
+    if remote_host.count("EXAMPLE"):
+        raise error.TestNAError("The migrate_dest_host '%s' is invalid"
+                                % remote_host)
+    sizes = params.get("compcache_sweep_sizes", "64M 256M 1G").split()
+    options = params.get("compcache_migrate_options",
+                         "--live --compressed --unsafe")
+    warmup = float(params.get("compcache_workload_warmup", "10"))
+    interval = float(params.get("migrate_jobinfo_interval", "1"))
+    ssh_key.setup_ssh_key(remote_host, params.get("migrate_dest_user",
+                                                  "root"),
+                          params.get("migrate_dest_pwd"), port=22)
+    src_uri = vm.connect_uri
+
+    results = []
+    try:
+        for size in sizes:
+            if vm.is_dead():
+                vm.start()
+            start_workload(vm, params)
+            # Let the workload fill its memory before migrating.
+            time.sleep(warmup)
+            cache_bytes = parse_size(size)
+            result = virsh.migrate_compcache(vm_name, size=cache_bytes)
+            if result.exit_status:
+                raise error.TestFail("Setting compression cache to %s "
+                                     "failed:\n%s" % (size, result))
+            sampler = migration_utils.JobInfoSampler([vm_name], interval)
+            sampler.start()
+            start = time.time()
+            result = vm.migrate(remote_uri, options, "", True, True)
+            seconds = time.time() - start
+            series = sampler.stop().get(vm_name, {})
+            if result.exit_status:
+                raise error.TestFail("Migration with %s of compression "
+                                     "cache failed:\n%s" % (size, result))
+            info = {}
+            for uri in [remote_uri, src_uri]:
+                info = migration_utils.get_domjobinfo(vm_name,
+                                                      completed=True,
+                                                      uri=uri)
+                if info:
+                    break
+            pages = info.get("compressed_pages", 0)
+            misses = info.get("compression_cache_misses", 0)
+            miss_rate = None
+            if pages + misses:
+                miss_rate = misses / float(pages + misses)
+            step = {"size": size, "cache_bytes": cache_bytes,
+                    "seconds": seconds,
+                    "time_elapsed_ms": info.get("time_elapsed"),
+                    "downtime_ms": info.get("total_downtime"),
+                    "transferred_bytes":
+                        migration_utils.get_transferred(info),
+                    "compressed_bytes": info.get("compressed_data"),
+                    "cache_miss_rate": miss_rate,
+                    "iterations": info.get("iteration"),
+                    "convergence": series.get("summary")}
+            logging.info("Compression cache %s: migrated in %.1fs, "
+                         "downtime %s ms, cache miss rate %s", size,
+                         seconds, step["downtime_ms"], miss_rate)
+            results.append(step)
+            utlv.MigrationTest().cleanup_dest_vm(vm, src_uri, remote_uri)
+    finally:
+        utlv.MigrationTest().cleanup_dest_vm(vm, src_uri, remote_uri)
+        if vm.is_alive():
+            vm.destroy()
+        bench_utils.save_report(test, "migrate_compcache_sweep",
+                                {"options": options,
+                                 "workload": params.get("compcache_workload",
+                                                        "dirty"),
+                                 "sizes": results})
+
+
 def run(test, params, env):
     """
     Test command: migrate-compcache <domain> [--size <number>]
@@ -43,6 +190,10 @@ def run(test, params, env):
         raise error.TestNAError("This version of libvirt does not support "
                                 "virsh command migrate-compcache")
 
+    if params.get("compcache_sweep", "no") == "yes":
+        run_sweep(test, params, env)
+        return
+
     # Prepare the VM state if it's not correct.
     if start_vm and not vm.is_alive():
         vm.start()
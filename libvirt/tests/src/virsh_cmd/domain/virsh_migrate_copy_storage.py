@@ -1,9 +1,15 @@
 import os
+import time
 import logging
+import threading
 from autotest.client import lv_utils
-from autotest.client.shared import error, ssh_key
-from virttest import utils_test, remote, libvirt_vm
+from autotest.client.shared import error, ssh_key, utils
+from virttest import utils_test, remote, libvirt_vm, virsh
 from virttest.utils_test import libvirt as utlv
+from virttest.libvirt_xml import vm_xml
+
+from provider import bench_utils
+from provider import migration_utils
 
 
 def copied_migration(vms, params):
@@ -47,6 +53,267 @@ def copied_migration(vms, params):
         raise error.TestFail("Check IP failed:%s", check_ip_failures)
 
 
+def disk_allocation(path):
+    """
+    Get the apparent and allocated bytes of a disk image, which differ
+    for sparse images.
+    """
+    if not os.path.exists(path):
+        return {"apparent_bytes": None, "allocated_bytes": None}
+    stat = os.stat(path)
+    return {"apparent_bytes": stat.st_size,
+            "allocated_bytes": stat.st_blocks * 512}
+
+
+def fill_disks(vm, targets, timeout):
+    """
+    Write random data over the whole of the disks targets from inside vm,
+    so their images are fully allocated whatever their format.
+    """
+    session = vm.wait_for_login()
+    try:
+        for target in targets:
+            # dd fails with "No space left" at the end of the device.
+            session.cmd_status("dd if=/dev/urandom of=/dev/%s bs=1M "
+                               "oflag=direct" % target, timeout=timeout)
+            logging.debug("Filled /dev/%s of %s", target, vm.name)
+    finally:
+        session.close()
+
+
+def image_format(path):
+    """
+    Get the format of a disk image from qemu-img info.
+    """
+    output = utils.run("qemu-img info %s" % path).stdout
+    for line in output.splitlines():
+        if line.startswith("file format:"):
+            return line.split(":", 1)[1].strip()
+    return "raw"
+
+
+def make_overlay(vm, target, base, overlay):
+    """
+    Move target of vm onto a qcow2 overlay of base with an external
+    disk-only snapshot, after which base is no longer written to.
+
+    :return: Format of base
+    """
+    base_format = image_format(base)
+    options = ("copy-inc copy-inc-desc --disk-only --atomic --no-metadata "
+               "%s,snapshot=external,file=%s" % (target, overlay))
+    result = virsh.snapshot_create_as(vm.name, options, ignore_status=True,
+                                      debug=True)
+    if result.exit_status:
+        raise error.TestError("Failed to make overlay %s: %s"
+                              % (overlay, result.stderr))
+    return base_format
+
+
+def create_remote_overlay(base, base_format, overlay, runner):
+    """
+    Create an empty overlay of base on the destination.
+    """
+    runner.run("qemu-img create -f qcow2 -o backing_file=%s,backing_fmt=%s "
+               "%s" % (base, base_format, overlay))
+
+
+def split_phases(columns):
+    """
+    Split the time of a storage migration job into the storage phase,
+    until QEMU starts sending memory after the disks are mirrored, and the
+    memory phase.
+
+    :param columns: Columns of the job from JobInfoSampler
+    :return: Dict with storage_seconds and memory_seconds, None if the
+             samples do not show the switch
+    """
+    times = columns.get("time", [])
+    phases = {"storage_seconds": None, "memory_seconds": None}
+    if not times:
+        return phases
+    for stamp, memory in zip(times, columns.get("memory_processed", [])):
+        if memory:
+            phases["storage_seconds"] = stamp - times[0]
+            phases["memory_seconds"] = times[-1] - stamp
+            break
+    return phases
+
+
+def disk_progress(columns, size):
+    """
+    Get the bytes copied over time of one disk, from its blockjob --info
+    progress sampled by JobInfoSampler.
+
+    :param size: Bytes of the disk
+    :return: Dict with copied bytes per sample, seconds to reach 100% and
+             the copy rate in MB/s
+    """
+    times = columns.get("time", [])
+    percents = columns.get("progress_percent", [])
+    progress = {"time": times,
+                "copied_bytes": [int(percent * size / 100)
+                                 for percent in percents],
+                "copy_seconds": None, "mb_per_sec": None}
+    for stamp, percent in zip(times, percents):
+        if percent >= 100:
+            progress["copy_seconds"] = stamp - times[0]
+            if progress["copy_seconds"]:
+                progress["mb_per_sec"] = (size / 1048576.0 /
+                                          progress["copy_seconds"])
+            break
+    return progress
+
+
+def measured_copy_migration(vm, dest_uri, options, disk_sizes, params):
+    """
+    Migrate vm with storage copied while sampling its migration job and
+    the mirror jobs of its disks.
+
+    :param disk_sizes: Dict of disk image path to bytes
+    :return: Report of the migration and every disk
+    """
+    interval = float(params.get("migrate_jobinfo_interval", "1"))
+    timeout = int(params.get("thread_timeout", 1200))
+    targets = dict((disk["source"], target) for target, disk in
+                   vm.get_disk_devices().items() if disk.get("source"))
+    disks = {}
+    for path, size in disk_sizes.items():
+        disks[targets.get(path, path)] = dict(disk_allocation(path),
+                                              path=path, bytes=size)
+    sampler = migration_utils.JobInfoSampler(
+        [vm.name], interval,
+        block_disks=[(vm.name, target) for target in targets.values()])
+    src_uri = vm.connect_uri
+    migration = {}
+
+    def migrate():
+        migration["result"] = vm.migrate(dest_uri, options, "", True, True)
+    migration_thread = threading.Thread(target=migrate)
+    sampler.start()
+    start = time.time()
+    migration_thread.start()
+    migration_thread.join(timeout)
+    seconds = time.time() - start
+    series = sampler.stop()
+    if migration_thread.isAlive():
+        raise error.TestFail("Migration with %s timed out" % options)
+    if migration["result"].exit_status:
+        raise error.TestFail("Migration with %s failed: %s"
+                             % (options, migration["result"].stderr))
+    info = {}
+    for uri in [dest_uri, src_uri]:
+        info = migration_utils.get_domjobinfo(vm.name, completed=True,
+                                              uri=uri)
+        if info:
+            break
+    columns = series.get(vm.name, {}).get("columns", {})
+    for target, disk in disks.items():
+        disk_columns = series.get("%s/%s" % (vm.name, target), {})
+        disk.update(disk_progress(disk_columns.get("columns", {}),
+                                  disk["bytes"]))
+    report = {"options": options, "seconds": seconds,
+              "file_processed": info.get("file_processed"),
+              "memory_processed": info.get("memory_processed"),
+              "transferred_bytes": migration_utils.get_transferred(info),
+              "disks": disks, "jobinfo": columns}
+    report.update(split_phases(columns))
+    logging.info("Migration with %s took %.1fs, storage phase %ss",
+                 options, seconds, report["storage_seconds"])
+    return report
+
+
+def run_measurement(test, vm, params, all_disks, rdm, file_path):
+    """
+    Migrate vm once for every option of copy_storage_compare_options and
+    report the throughput of every disk in copy_storage_throughput.json.
+
+    With copy_storage_backing_chain = yes the primary disk is first moved
+    onto an overlay whose base is copied to the destination, so full and
+    incremental copy run on the same backing chain. With
+    copy_storage_allocation = full the added disks are filled with random
+    data first, sparse leaves them as created.
+    """
+    dest_uri = params.get("migrate_dest_uri")
+    disk_type = params.get("copy_storage_type", "file")
+    vgname = params.get("sm_vg_name", "SMTEST")
+    option_list = params.get("copy_storage_compare_options",
+                             params.get("copy_storage_option", "")).split()
+    allocation = params.get("copy_storage_allocation", "sparse")
+    chained = "yes" == params.get("copy_storage_backing_chain", "no")
+    remote_host = params.get("migrate_dest_host")
+    remote_user = params.get("migrate_dest_user", "root")
+    remote_passwd = params.get("migrate_dest_pwd")
+    runner = remote.RemoteRunner(host=remote_host, username=remote_user,
+                                 password=remote_passwd)
+    primary_target = vm.get_first_disk_devices()["target"]
+    src_uri = vm.connect_uri
+    backup_xml = vm_xml.VMXML.new_from_inactive_dumpxml(vm.name)
+    # Bytes of every disk the migration copies, added disks are sized in
+    # GiB strings such as "0.1"
+    disk_sizes = dict((path, int(float(size) * 1073741824))
+                      for path, size in all_disks.items())
+    overlay = None
+    results = []
+    try:
+        if vm.is_dead():
+            vm.start()
+        vm.wait_for_login()
+        # The size of the primary disk in all_disks is floored to GiB.
+        disk_sizes[file_path] = int(vm.get_device_size(primary_target)[1])
+        if allocation == "full":
+            targets = [target for target, disk in
+                       vm.get_disk_devices().items()
+                       if disk.get("source") in all_disks and
+                       disk.get("source") != file_path]
+            fill_disks(vm, targets, int(params.get("thread_timeout", 1200)))
+        if chained:
+            overlay = "%s.copy-inc.qcow2" % file_path
+            base_format = make_overlay(vm, primary_target, file_path,
+                                       overlay)
+            # The guest writes to the overlay now, so the base is frozen
+            # and the destination gets the same one with its own overlay.
+            remote.copy_files_to(remote_host, "scp", remote_user,
+                                 remote_passwd, 22, file_path, file_path)
+            create_remote_overlay(file_path, base_format, overlay, runner)
+            disk_sizes[overlay] = disk_sizes.pop(file_path)
+        for options in option_list:
+            if vm.is_dead():
+                vm.start()
+            vm.wait_for_login()
+            report = measured_copy_migration(vm, dest_uri,
+                                             "--live %s" % options,
+                                             disk_sizes, params)
+            report["allocation"] = allocation
+            report["backing_chain"] = chained
+            results.append(report)
+            utlv.MigrationTest().cleanup_dest_vm(vm, src_uri, dest_uri)
+            # The next migration needs empty images on the destination.
+            for disk in all_disks:
+                if disk == file_path:
+                    if not chained:
+                        rdm.create_image("file", disk, all_disks[disk],
+                                         None, None)
+                else:
+                    rdm.create_image(disk_type, disk, all_disks[disk],
+                                     vgname, os.path.basename(disk))
+            if overlay:
+                rdm.remove_path("file", overlay)
+                create_remote_overlay(file_path, base_format, overlay,
+                                      runner)
+    finally:
+        utlv.MigrationTest().cleanup_dest_vm(vm, src_uri, dest_uri)
+        if vm.is_alive():
+            vm.destroy()
+        backup_xml.sync()
+        if overlay:
+            rdm.remove_path("file", overlay)
+            if os.path.exists(overlay):
+                os.remove(overlay)
+        bench_utils.save_report(test, "copy_storage_throughput",
+                                {"migrations": results})
+
+
 def run(test, params, env):
     """
     Test migration with option --copy-storage-all or --copy-storage-inc.
@@ -127,6 +394,10 @@ def run(test, params, env):
                     rdm.create_image(disk_type, disk, size, vgname,
                                      os.path.basename(disk))
 
+        if "yes" == params.get("copy_storage_measure", "no"):
+            run_measurement(test, vm, params, all_disks, rdm, file_path)
+            return
+
         fail_flag = False
         try:
             logging.debug("Start migration...")
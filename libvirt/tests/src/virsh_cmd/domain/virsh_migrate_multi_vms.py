@@ -5,6 +5,7 @@ import commands
 import shutil
 import threading
 import time
+import urlparse
 from autotest.client.shared import error
 from autotest.client.shared import utils
 from autotest.client.shared import ssh_key
@@ -12,6 +13,10 @@ from virttest import libvirt_vm
 from virttest import virsh
 from virttest import remote
 
+from provider import bench_utils
+from provider import downtime_probe
+from provider import migration_utils
+
 
 # To get result in thread, using global parameters
 # Result of virsh migrate command
@@ -81,6 +86,12 @@ class MigrationHelper(object):
         self.migration_cmd = None
         self.virsh_migrate_timeout = int(params.get("virsh_migrate_timeout", 60))
         self.vm_ip = None
+        # DowntimeProbe while migrating and its result
+        self.probe = None
+        self.downtime = None
+        # Duration and error of the last migration of a scaling step
+        self.migration_time = None
+        self.migration_error = None
 
     def __str__(self):
         return "Migration VM %s, Command '%s'" % (self.vm_name,
@@ -163,6 +174,53 @@ def thread_func_ping(lrunner, rrunner, vm_ip, tolerable=5):
             break   # Got enough information, leaving thread anyway
 
 
+def set_max_downtime(vm_name, downtime, migration_thread):
+    """
+    Set the maximum downtime of a running migration, retrying until its
+    job started.
+
+    :param downtime: Maximum downtime in milliseconds
+    :return: True if it was set before the migration ended
+    """
+    while migration_thread.isAlive():
+        result = virsh.migrate_setmaxdowntime(vm_name, downtime)
+        if not result.exit_status:
+            logging.info("Set max downtime of %s to %s ms", vm_name,
+                         downtime)
+            return True
+        time.sleep(0.1)
+    logging.error("Migration of %s ended before setting max downtime",
+                  vm_name)
+    return False
+
+
+def start_probes(helpers, interval):
+    """
+    Start a DowntimeProbe for every vm of helpers.
+    """
+    for helper in helpers:
+        helper.probe = downtime_probe.DowntimeProbe(helper.vm_ip, interval)
+        helper.probe.start()
+
+
+def stop_probes(helpers, grace=1.0):
+    """
+    Stop the probes of helpers, grace seconds after the last migration
+    ended so the replies of migrated vms are seen.
+    """
+    probed = [helper for helper in helpers if helper.probe is not None]
+    if not probed:
+        return
+    time.sleep(grace)
+    for helper in probed:
+        helper.downtime = helper.probe.stop()
+        helper.probe = None
+        logging.info("Downtime of %s: %.3fs (%s probes lost, "
+                     "recovered: %s)", helper.vm_name,
+                     helper.downtime["blackout"], helper.downtime["lost"],
+                     helper.downtime["recovered"])
+
+
 def thread_func_jobabort(vm):
     global ret_jobabort
     if not vm.domjobabort():
@@ -170,13 +228,19 @@ def thread_func_jobabort(vm):
 
 
 def multi_migration(helpers, simultaneous=False, jobabort=False,
-                    lrunner=None, rrunner=None, timeout=60):
+                    lrunner=None, rrunner=None, timeout=60,
+                    probe_interval=None, max_downtime=None, probe_grace=1.0):
     """
     Migrate multiple vms simultaneously or not.
     If jobabort is True, run "virsh domjobabort vm_name" during migration.
 
     :param helper: A MigrationHelper class instance
     :param timeout: thread's timeout
+    :param probe_interval: Seconds between downtime probes of each vm,
+                           None to not probe
+    :param max_downtime: Maximum downtime in milliseconds to set for each
+                         migration, None to keep the default
+    :param probe_grace: Seconds to go on probing after migration
     """
     migration_threads = []
     for helper in helpers:
@@ -188,8 +252,14 @@ def multi_migration(helpers, simultaneous=False, jobabort=False,
 
     if simultaneous:
         logging.info("Migrate vms simultaneously.")
+        if probe_interval:
+            start_probes(helpers, probe_interval)
         for migration_thread in migration_threads:
             migration_thread.start()
+        if max_downtime is not None:
+            for helper, migration_thread in zip(helpers, migration_threads):
+                set_max_downtime(helper.vm_name, max_downtime,
+                                 migration_thread)
         if jobabort:
             # Confirm Migration has been executed.
             time.sleep(1)
@@ -207,6 +277,7 @@ def multi_migration(helpers, simultaneous=False, jobabort=False,
             if migration_thread.isAlive():
                 logging.error("Migrate %s timeout.", migration_thread)
                 ret_migration = False
+        stop_probes(helpers, probe_grace)
     else:
         logging.info("Migrate vms orderly.")
         for helper in helpers:
@@ -214,20 +285,224 @@ def multi_migration(helpers, simultaneous=False, jobabort=False,
             cmd = helper.migration_cmd
             migration_thread = threading.Thread(target=thread_func_migration,
                                                 args=(inst, cmd))
-            ping_thread = threading.Thread(target=thread_func_ping,
-                                           args=(lrunner, rrunner,
-                                                 helper.vm_ip))
+            if probe_interval:
+                start_probes([helper], probe_interval)
             migration_thread.start()
+            if max_downtime is not None:
+                set_max_downtime(helper.vm_name, max_downtime,
+                                 migration_thread)
             migration_thread.join(timeout)
             if migration_thread.isAlive():
                 logging.error("Migrate %s timeout.", migration_thread)
                 ret_migration = False
+            stop_probes([helper], probe_grace)
+
+
+def thread_func_timed_migration(helper):
+    """
+    Thread for one migration of a scaling step, recording its duration
+    and error on helper.
+    """
+    start = time.time()
+    try:
+        helper.virsh_instance.command(helper.migration_cmd,
+                                      ignore_status=False)
+    except error.CmdError, detail:
+        helper.migration_error = str(detail)
+    helper.migration_time = time.time() - start
+
+
+def migrate_step(helpers, timeout):
+    """
+    Migrate the vms of helpers at the same time.
+
+    :param timeout: Seconds to wait for all migrations
+    :return: Seconds from the first start to the last end
+    """
+    threads = []
+    for helper in helpers:
+        helper.migration_time = None
+        helper.migration_error = None
+        threads.append(threading.Thread(target=thread_func_timed_migration,
+                                        args=(helper,)))
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    deadline = start + timeout
+    for helper, thread in zip(helpers, threads):
+        thread.join(max(deadline - time.time(), 0))
+        if thread.isAlive():
+            helper.migration_error = "Migration timed out"
+    return time.time() - start
+
+
+def get_migration_stats(helper, srcuri, desturi):
+    """
+    Get the statistics of the completed migration of helper, from the
+    destination or else from the source.
+    """
+    for uri in [desturi, srcuri]:
+        info = migration_utils.get_domjobinfo(helper.vm_name, completed=True,
+                                              uri=uri)
+        if info:
+            return info
+    return {}
+
+
+def find_saturation(steps, min_gain):
+    """
+    Find the first step whose aggregate throughput grew less than min_gain
+    over the step before.
+
+    :return: Number of vms of that step, None if throughput kept growing
+    """
+    for previous, step in zip(steps, steps[1:]):
+        before = previous["aggregate_mb_per_sec"]
+        after = step["aggregate_mb_per_sec"]
+        if before and after is not None and after < before * (1 + min_gain):
+            return step["vms"]
+    return None
+
+
+def run_scaling(test, params, env):
+    """
+    Migrate 1, 2, 4, ... N vms at the same time and report how the time,
+    downtime and throughput of migration scale with the number of vms.
+
+    1. Start the vms of a step, each with its own virsh session
+    2. Migrate them all at once to the destination
+    3. Record the time of every migration, its downtime and the bytes it
+       sent from domjobinfo, and the aggregate throughput of the step
+    4. Remove the vms on the destination and start them again here
+    """
+    vm_names = params.get("migrate_vms").split()
+    steps = params.get("migrate_scaling_steps")
+    if steps:
+        steps = [int(count) for count in steps.split()]
+    else:
+        steps = []
+        count = 1
+        while count < len(vm_names):
+            steps.append(count)
+            count *= 2
+        steps.append(len(vm_names))
+    if max(steps) > len(vm_names):
+        raise error.TestNAError("Scaling to %s vms needs as many in "
+                                "migrate_vms" % max(steps))
+    method = params.get("virsh_migrate_method")
+    options = params.get("virsh_migrate_options", "live")
+    timeout = int(params.get("migrate_scaling_timeout", "600"))
+    min_gain = float(params.get("migrate_scaling_min_gain", "0.1"))
+    probe_downtime = "yes" == params.get("migrate_downtime_probe", "no")
+    probe_interval = float(params.get("migrate_probe_interval", "0.01"))
+    probe_grace = float(params.get("migrate_probe_grace", "1"))
+    sample_jobs = "yes" == params.get("migrate_jobinfo_sample", "no")
+    sample_interval = float(params.get("migrate_jobinfo_interval", "1"))
+    desturi = params.get("migrate_scaling_dest_uri")
+    if not desturi:
+        desturi = libvirt_vm.get_uri_with_transport(
+            transport="ssh", dest_ip=params.get("remote_host",
+                                                "DEST_HOSTNAME.EXAMPLE.COM"))
+    if desturi.count('EXAMPLE'):
+        raise error.TestNAError("The desturi '%s' is invalid" % desturi)
+    dest = urlparse.urlparse(desturi)
+    if dest.scheme.endswith("+ssh"):
+        # Also for qemu+ssh://localhost, virsh must log in unattended.
+        ssh_key.setup_ssh_key(dest.hostname, params.get("host_user", "root"),
+                              params.get("host_password"), port=22)
+
+    helpers = []
+    for vm_name in vm_names[:max(steps)]:
+        helper = MigrationHelper(vm_name, test, params, env)
+        helper.set_virsh_instance()
+        helper.set_migration_cmd(options, method, desturi)
+        helpers.append(helper)
+    srcuri = helpers[0].vm.connect_uri
+
+    results = []
+    failures = []
+    try:
+        for count in steps:
+            step_helpers = helpers[:count]
+            for helper in step_helpers:
+                if helper.vm.is_dead():
+                    helper.vm.start()
+                helper.vm.wait_for_login()
+                helper.vm_ip = helper.vm.get_address()
+            logging.info("Migrate %s vms at the same time", count)
+            if probe_downtime:
+                start_probes(step_helpers, probe_interval)
+            sampler = None
+            if sample_jobs:
+                sampler = migration_utils.JobInfoSampler(
+                    [helper.vm_name for helper in step_helpers],
+                    sample_interval)
+                sampler.start()
+            wall = migrate_step(step_helpers, timeout)
+            stop_probes(step_helpers, probe_grace)
+
+            step = {"vms": count, "wall_seconds": wall, "per_vm": {}}
+            if sampler is not None:
+                step["jobinfo"] = sampler.stop()
+            total_bytes = 0
+            for helper in step_helpers:
+                if helper.migration_error:
+                    failures.append("%s vms, %s: %s"
+                                    % (count, helper.vm_name,
+                                       helper.migration_error))
+                    continue
+                info = get_migration_stats(helper, srcuri, desturi)
+                transferred = migration_utils.get_transferred(info)
+                total_bytes += transferred
+                vm_result = {"seconds": helper.migration_time,
+                             "time_elapsed_ms": info.get("time_elapsed"),
+                             "downtime_ms": info.get("total_downtime"),
+                             "transferred_bytes": transferred,
+                             "mb_per_sec": (transferred / 1048576.0 /
+                                            helper.migration_time)}
+                if helper.downtime is not None:
+                    vm_result["probed_downtime_ms"] = (
+                        helper.downtime["blackout"] * 1000)
+                step["per_vm"][helper.vm_name] = vm_result
+            rates = [result["mb_per_sec"]
+                     for result in step["per_vm"].values()]
+            step["aggregate_mb_per_sec"] = None
+            if rates and total_bytes:
+                step["aggregate_mb_per_sec"] = total_bytes / 1048576.0 / wall
+                step["fairness"] = bench_utils.jain_fairness(rates)
+            step["migration_seconds"] = bench_utils.sample_stats(
+                [result["seconds"] for result in step["per_vm"].values()])
+            logging.info("%s vms migrated in %.1fs, %s MB/s aggregate",
+                         count, wall, step["aggregate_mb_per_sec"])
+            results.append(step)
+            for helper in step_helpers:
+                helper.cleanup_vm(srcuri, desturi)
+            if failures:
+                break
+    finally:
+        for helper in helpers:
+            helper.virsh_instance.close_session()
+            helper.cleanup_vm(srcuri, desturi)
+
+    first = results and results[0]["aggregate_mb_per_sec"]
+    for step in results:
+        step["speedup"] = None
+        if first and step["aggregate_mb_per_sec"] is not None:
+            step["speedup"] = step["aggregate_mb_per_sec"] / first
+    report = {"dest_uri": desturi, "options": options, "steps": results,
+              "saturated_at": find_saturation(results, min_gain)}
+    bench_utils.save_report(test, "migration_scaling", report)
+    if failures:
+        raise error.TestFail("Migration failed:\n%s" % "\n".join(failures))
 
 
 def run(test, params, env):
     """
     Test migration of multi vms.
     """
+    if "yes" == params.get("migrate_scaling", "no"):
+        return run_scaling(test, params, env)
+
     vm_names = params.get("migrate_vms").split()
     if len(vm_names) < 2:
         raise error.TestNAError("No multi vms provided.")
@@ -238,6 +513,15 @@ def run(test, params, env):
     jobabort = "yes" == params.get("virsh_migrate_jobabort", "no")
     options = params.get("virsh_migrate_options", "")
     status_error = "yes" == params.get("status_error", "no")
+    # Probe every vm at this interval to measure its downtime.
+    probe_downtime = "yes" == params.get("migrate_downtime_probe", "no")
+    probe_interval = float(params.get("migrate_probe_interval", "0.01"))
+    max_downtime = params.get("virsh_migrate_maxdowntime")
+    if max_downtime is not None:
+        max_downtime = int(max_downtime)
+    check_downtime = "yes" == params.get("migrate_downtime_check", "yes")
+    downtime_slack = int(params.get("migrate_downtime_slack", "0"))
+    probe_grace = float(params.get("migrate_probe_grace", "1"))
     #remote_migration = "yes" == params.get("remote_migration", "no")
     remote_host = params.get("remote_host", "DEST_HOSTNAME.EXAMPLE.COM")
     local_host = params.get("local_host", "SOURCE_HOSTNAME.EXAMPLE.COM")
@@ -281,7 +565,9 @@ def run(test, params, env):
 
     try:
         multi_migration(helpers, simultaneous=False, jobabort=False,
-                        lrunner=localrunner, rrunner=remoterunner)
+                        lrunner=localrunner, rrunner=remoterunner,
+                        probe_interval=probe_downtime and probe_interval,
+                        max_downtime=max_downtime, probe_grace=probe_grace)
     finally:
         for helper in helpers:
             helper.virsh_instance.close_session()
@@ -298,3 +584,24 @@ def run(test, params, env):
                 raise error.TestFail("Abort migration failed.")
         if not ret_downtime_tolerable:
             raise error.TestFail("Downtime during migration is intolerable.")
+
+    if probe_downtime:
+        report = {"max_downtime_ms": max_downtime, "vms": {}}
+        over_target = []
+        for helper in helpers:
+            if helper.downtime is None:
+                continue
+            report["vms"][helper.vm_name] = helper.downtime
+            blackout_ms = helper.downtime["blackout"] * 1000
+            if not helper.downtime["recovered"]:
+                over_target.append("%s did not answer after migration"
+                                   % helper.vm_name)
+            elif (max_downtime is not None and
+                  blackout_ms > max_downtime + downtime_slack):
+                over_target.append("%s was down %.0f ms, max downtime is "
+                                   "%s ms" % (helper.vm_name, blackout_ms,
+                                              max_downtime))
+        bench_utils.save_report(test, "migration_downtime", report)
+        if over_target and check_downtime:
+            raise error.TestFail("Downtime target not met:\n%s"
+                                 % "\n".join(over_target))
@@ -1,8 +1,11 @@
+import time
 import logging
 from autotest.client.shared import error, utils
 from autotest.client.shared import ssh_key
 from virttest import virsh, libvirt_vm, utils_test
 from provider import libvirt_version
+from provider import bench_utils
+from provider import migration_utils
 from virttest.utils_test import libvirt as utlv
 
 UINT32_MAX = (1 << 32) - 1
@@ -22,6 +25,27 @@ UINT64_MiB = UINT64_MAX / (1024 * 1024)
 DEFAULT = INT64_MiB
 
 
+def achieved_rates(columns, skip=1):
+    """
+    Get the transfer rate between every two samples of a migration job.
+
+    :param columns: Columns of the job from JobInfoSampler
+    :param skip: Samples to skip at the start, while the job sets up
+    :return: List of rates in MiB/s
+    """
+    samples = [(stamp, processed) for stamp, processed in
+               zip(columns.get("time", []),
+                   columns.get("data_processed", []))
+               if processed is not None][skip:]
+    rates = []
+    for (stamp, processed), (next_stamp, next_processed) in zip(samples,
+                                                                samples[1:]):
+        if next_stamp > stamp:
+            rates.append((next_processed - processed) / 1048576.0 /
+                         (next_stamp - stamp))
+    return rates
+
+
 def run(test, params, env):
     """
     Test command: virsh migrate-setspeed <domain> <bandwidth>
@@ -43,6 +67,7 @@ def run(test, params, env):
     virsh_dargs = {'debug': True}
     # Checking uris for migration
     twice_migration = "yes" == params.get("twice_migration", "no")
+    achieved_bandwidth = "yes" == params.get("achieved_bandwidth", "no")
     if twice_migration:
         src_uri = params.get("migrate_src_uri",
                              "qemu+ssh://EXAMPLE/system")
@@ -227,11 +252,90 @@ def run(test, params, env):
         if len(fail_info):
             raise error.TestFail(fail_info)
 
+    def verify_achieved_bandwidth(test, params, env):
+        """
+        Migrate at every speed of bandwidth_list while sampling domjobinfo
+        and check the achieved rate stays within bandwidth_tolerance of
+        the limit.
+        """
+        vm = env.get_vm(vm_name)
+        src_uri = vm.connect_uri
+        dest_uri = params.get("migrate_dest_uri",
+                              "qemu+ssh://EXAMPLE/system")
+        if dest_uri.count('///') or dest_uri.count('EXAMPLE'):
+            raise error.TestNAError("The dest_uri '%s' is invalid"
+                                    % dest_uri)
+        ssh_key.setup_ssh_key(params.get("migrate_dest_host"),
+                              params.get("migrate_dest_user", "root"),
+                              params.get("migrate_dest_pwd"), port=22)
+        speeds = [int(speed) for speed in
+                  params.get("bandwidth_list", "8 32 128").split()]
+        tolerance = float(params.get("bandwidth_tolerance", "0.15"))
+        interval = float(params.get("migrate_jobinfo_interval", "0.5"))
+        min_samples = int(params.get("bandwidth_min_samples", "3"))
+        check_undershoot = "yes" == params.get("bandwidth_check_undershoot",
+                                               "yes")
+        options = params.get("virsh_migrate_options", "--live --unsafe")
+
+        results = []
+        fail_info = []
+        for speed in speeds:
+            if vm.is_dead():
+                vm.start()
+            vm.wait_for_login()
+            set_get_speed(vm_name, speed, **virsh_dargs)
+            sampler = migration_utils.JobInfoSampler([vm_name], interval)
+            sampler.start()
+            start = time.time()
+            try:
+                result = vm.migrate(dest_uri, options, "", True, True)
+            finally:
+                seconds = time.time() - start
+                columns = sampler.stop().get(vm_name, {}).get("columns", {})
+            utlv.MigrationTest().cleanup_dest_vm(vm, src_uri, dest_uri)
+            if result.exit_status:
+                fail_info.append("Migration at %s MiB/s failed: %s"
+                                 % (speed, result.stderr))
+                continue
+
+            rates = achieved_rates(columns)
+            # Ratio of achieved to configured rate, above 1 overshoots.
+            ratios = [rate / speed for rate in rates]
+            step = {"limit_mib_per_sec": speed, "seconds": seconds,
+                    "rates": rates,
+                    "rate_stats": bench_utils.sample_stats(rates),
+                    "ratio_stats": bench_utils.sample_stats(ratios),
+                    "overshoot_samples": len([ratio for ratio in ratios
+                                              if ratio > 1 + tolerance]),
+                    "undershoot_samples": len([ratio for ratio in ratios
+                                               if ratio < 1 - tolerance])}
+            results.append(step)
+            if len(rates) < min_samples:
+                logging.warning("Migration at %s MiB/s ended after %s "
+                                "samples, too few to check its rate",
+                                speed, len(rates))
+                continue
+            mean = step["rate_stats"]["mean"]
+            logging.info("Limit %s MiB/s, achieved %.1f MiB/s", speed, mean)
+            if mean > speed * (1 + tolerance):
+                fail_info.append("Migration at %s MiB/s overshot to %.1f "
+                                 "MiB/s" % (speed, mean))
+            elif check_undershoot and mean < speed * (1 - tolerance):
+                fail_info.append("Migration at %s MiB/s only reached %.1f "
+                                 "MiB/s" % (speed, mean))
+
+        bench_utils.save_report(test, "migrate_setspeed_achieved",
+                                {"tolerance": tolerance, "speeds": results})
+        if fail_info:
+            raise error.TestFail("\n".join(fail_info))
+
     # Run test case
     try:
         set_get_speed(vm_name, expected_value, status_error,
                       options_extra, **virsh_dargs)
-        if twice_migration:
+        if achieved_bandwidth:
+            verify_achieved_bandwidth(test, params, env)
+        elif twice_migration:
             verify_migration_speed(test, params, env)
         else:
             set_get_speed(vm_name, expected_value, status_error,
@@ -239,6 +343,10 @@ def run(test, params, env):
     finally:
         #restore bandwidth to default
         virsh.migrate_setspeed(vm_name, orig_value)
+        if achieved_bandwidth:
+            vm = env.get_vm(vm_name)
+            if vm.is_alive():
+                vm.destroy(gracefully=False)
         if twice_migration:
             for vm in env.get_all_vms():
                 utlv.MigrationTest().cleanup_dest_vm(vm, src_uri, dest_uri)
@@ -9,6 +9,9 @@ from virttest import utils_test, remote, data_dir
 from virttest.utils_test import libvirt as utlv
 from virttest.libvirt_xml import vm_xml
 
+from provider import bench_utils
+from provider import migration_utils
+
 
 def set_cpu_memory(vm_name, cpu, memory):
     """
@@ -133,6 +136,9 @@ def run(test, params, env):
     username = params.get("migrate_dest_user", "root")
     password = params.get("migrate_dest_pwd")
     prompt = params.get("shell_prompt", r"[\#\$]")
+    # Poll domjobinfo of the migrating vms every interval seconds
+    sample_jobs = "yes" == params.get("migrate_jobinfo_sample", "no")
+    sample_interval = float(params.get("migrate_jobinfo_interval", "1"))
 
     # Set vm_bytes for start_cmd
     mem_total = utils_memory.memtotal()
@@ -161,8 +167,19 @@ def run(test, params, env):
         # Config ssh autologin for remote host
         ssh_key.setup_ssh_key(remote_host, username, password, port=22)
 
-        do_stress_migration(vms, src_uri, dest_uri, stress_type,
-                            migration_type, params, thread_timeout)
+        sampler = None
+        if sample_jobs:
+            sampler = migration_utils.JobInfoSampler(vm_names,
+                                                     sample_interval)
+            sampler.start()
+        try:
+            do_stress_migration(vms, src_uri, dest_uri, stress_type,
+                                migration_type, params, thread_timeout)
+        finally:
+            if sampler is not None:
+                # Also on failure, the series show why it did not converge.
+                bench_utils.save_report(test, "migration_jobinfo",
+                                        sampler.stop())
         # Check network of vms on destination
         if start_migration_vms and migration_type != "cross":
             for vm in vms:
@@ -1,12 +1,17 @@
 import os
+import time
 import logging
 import string
 import hashlib
 from autotest.client.shared import utils, error
 from virttest import virsh
 from virttest.utils_test import libvirt as utlv
+from provider import bench_utils
 from provider import libvirt_version
 
+# Bytes read or written at once, large enough for multi GiB volumes.
+BUFFER_SIZE = 4 * 1024 * 1024
+
 
 def digest(path, offset, length):
     """
@@ -23,7 +28,7 @@ def digest(path, offset, length):
     hash_md = hashlib.md5()
     done = 0
     while True:
-        want = 1024
+        want = BUFFER_SIZE
         if length and length - done < want:
             want = length - done
         outstr = read_fd.read(want)
@@ -50,6 +55,46 @@ def write_file(path):
     write_fd.close()
 
 
+def write_data(path, size, hash_offset=0, hash_length=0):
+    """
+    Write size bytes of test data to path and hash a window of it while it
+    is generated, so the data is never read back for its digest.
+
+    Every block starts with its index, so data written to the wrong
+    offset does not match.
+
+    :param path: file absolute path to write
+    :param size: number of bytes to write
+    :param hash_offset: offset of the window to hash
+    :param hash_length: length of the window to hash, 0 for up to the end
+    :return: md5 of the window in hex
+    """
+    logging.info("write %s bytes of data into file %s", size, path)
+    datastr = ''.join(string.lowercase + string.uppercase
+                      + string.digits + '.' + '\n')
+    base = (datastr * (BUFFER_SIZE // len(datastr) + 1))[:BUFFER_SIZE]
+    hash_end = size
+    if hash_length:
+        hash_end = min(hash_offset + hash_length, size)
+    hash_md = hashlib.md5()
+    write_fd = open(path, 'wb')
+    try:
+        pos = 0
+        index = 0
+        while pos < size:
+            block = ("%016x" % index + base[16:])[:size - pos]
+            write_fd.write(block)
+            start = max(hash_offset, pos)
+            end = min(hash_end, pos + len(block))
+            if start < end:
+                hash_md.update(block[start - pos:end - pos])
+            pos += len(block)
+            index += 1
+    finally:
+        write_fd.close()
+    return hash_md.hexdigest()
+
+
 def run(test, params, env):
     """
     Do test for vol-download and vol-upload
@@ -77,6 +122,9 @@ def run(test, params, env):
     frmt = params.get("vol_download_upload_format")
     operation = params.get("vol_download_upload_operation")
     create_vol = ("yes" == params.get("vol_download_upload_create_vol", "yes"))
+    # Large mode writes size_mb of generated data instead of 1M.
+    large = ("yes" == params.get("vol_download_upload_large", "no"))
+    data_size = int(params.get("vol_download_upload_size_mb", "1")) * 1048576
 
     # libvirt acl polkit related params
     uri = params.get("virsh_uri")
@@ -123,13 +171,18 @@ def run(test, params, env):
         logging.debug("%s options are %s", operation, options)
 
         if operation == "upload":
-            # write date to file
-            write_file(file_path)
-
             # Set length for calculate the offset + length in the following
             # func get_pre_post_digest() and digest()
-            if length == 0:
-                length = 1048576
+            if large:
+                # Upload exactly the window, hashed while it is written.
+                if length == 0:
+                    length = data_size - offset
+                ori_digest = write_data(file_path, length)
+            else:
+                # write date to file
+                write_file(file_path)
+                if length == 0:
+                    length = 1048576
 
             def get_pre_post_digest():
                 """
@@ -152,17 +205,22 @@ def run(test, params, env):
 
             # Get pre and post digest before operation for compare
             (ori_pre_digest, ori_post_digest) = get_pre_post_digest()
-            ori_digest = digest(file_path, 0, 0)
-            logging.debug("ori digest read from %s is %s", file_path,
-                          ori_digest)
+            if not large:
+                ori_digest = digest(file_path, 0, 0)
+            logging.debug("ori digest of %s is %s", file_path, ori_digest)
 
             if params.get('setup_libvirt_polkit') == 'yes':
                 utils.run("chmod 666 %s" % file_path)
 
             # Do volume upload
+            start = time.time()
             result = virsh.vol_upload(vol_name, file_path, options,
                                       unprivileged_user=unpri_user,
                                       uri=uri, debug=True)
+            elapsed = time.time() - start
+            transferred = os.path.getsize(file_path)
+            if length:
+                transferred = min(length, transferred)
             if result.exit_status == 0:
                 # Get digest after operation
                 (aft_pre_digest, aft_post_digest) = get_pre_post_digest()
@@ -182,11 +240,13 @@ def run(test, params, env):
             # Write date to volume
             if pool_type == "disk":
                 utils.run("mkfs.ext3 -F %s" % vol_path)
-            write_file(vol_path)
-
-            # Record the digest value before operation
-            ori_digest = digest(vol_path, offset, length)
-            logging.debug("original digest read from %s is %s", vol_path,
+            if large:
+                ori_digest = write_data(vol_path, data_size, offset, length)
+            else:
+                write_file(vol_path)
+                # Record the digest value before operation
+                ori_digest = digest(vol_path, offset, length)
+            logging.debug("original digest of %s is %s", vol_path,
                           ori_digest)
 
             utils.run("touch %s" % file_path)
@@ -194,9 +254,12 @@ def run(test, params, env):
                 utils.run("chmod 666 %s" % file_path)
 
             # Do volume download
+            start = time.time()
             result = virsh.vol_download(vol_name, file_path, options,
                                         unprivileged_user=unpri_user,
                                         uri=uri, debug=True)
+            elapsed = time.time() - start
+            transferred = os.path.getsize(file_path)
             if result.exit_status == 0:
                 # Get digest after operation
                 aft_digest = digest(file_path, 0, 0)
@@ -207,6 +270,16 @@ def run(test, params, env):
             raise error.TestFail("Fail to %s volume: %s" %
                                  (operation, result.stderr))
 
+        mb_per_sec = transferred / 1048576.0 / elapsed
+        logging.info("%s of %s bytes took %.2fs, %.1f MB/s", operation,
+                     transferred, elapsed, mb_per_sec)
+        bench_utils.save_report(test, "vol_%s" % operation,
+                                {"direction": operation,
+                                 "pool_type": pool_type,
+                                 "offset": offset, "length": length,
+                                 "bytes": transferred, "seconds": elapsed,
+                                 "mb_per_sec": mb_per_sec})
+
         # Compare the change part on volume and file
         if ori_digest == aft_digest:
             logging.info("file digests match, volume %s suceed", operation)
@@ -0,0 +1,140 @@
+import os
+import time
+import logging
+from multiprocessing.pool import ThreadPool
+
+from autotest.client.shared import utils, error
+from virttest import virsh
+from virttest.utils_test import libvirt as utlv
+
+from provider import bench_utils
+
+
+def get_daemon_pid(name):
+    """
+    Get the pid of the libvirt daemon serving the streams.
+    """
+    result = utils.run("pidof %s" % name, ignore_status=True)
+    if result.exit_status or not result.stdout.strip():
+        raise error.TestNAError("%s is not running" % name)
+    return int(result.stdout.split()[0])
+
+
+def run(test, params, env):
+    """
+    Stress libvirtd with many concurrent vol-upload and vol-download
+    streams on one pool.
+
+    1. Create a pool and N volumes in it
+    2. Run M uploads and downloads at once, stream i on volume i % N
+    3. Sample CPU and RSS of the daemon during the transfer
+    4. Report aggregate throughput and fairness between streams
+    """
+    pool_type = params.get("vol_stream_pool_type", "dir")
+    pool_name = params.get("vol_stream_pool_name", "stream-pool")
+    pool_target = params.get("vol_stream_pool_target", "stream-pool")
+    if not os.path.dirname(pool_target):
+        pool_target = os.path.join(test.tmpdir, pool_target)
+    emulated_image = params.get("vol_stream_emulated_image", "stream-img")
+    image_size = params.get("vol_stream_image_size", "20G")
+    vol_count = int(params.get("vol_stream_volumes", "8"))
+    vol_format = params.get("vol_stream_vol_format", "raw")
+    stream_size = int(params.get("vol_stream_size_mb", "256")) * 1048576
+    uploads = int(params.get("vol_stream_uploads", "4"))
+    downloads = int(params.get("vol_stream_downloads", "4"))
+    daemon = params.get("vol_stream_daemon", "libvirtd")
+    interval = float(params.get("vol_stream_sample_interval", "1"))
+
+    streams = ["upload"] * uploads + ["download"] * downloads
+    if not streams:
+        raise error.TestError("No streams to run")
+    if vol_count < len(streams):
+        logging.warning("%s streams share %s volumes", len(streams),
+                        vol_count)
+
+    pvt = utlv.PoolVolumeTest(test, params)
+    source_file = os.path.join(test.tmpdir, "stream-source")
+    download_files = []
+    try:
+        pvt.pre_pool(pool_name, pool_type, pool_target, emulated_image,
+                     image_size=image_size)
+        vol_names = ["stream-vol%d" % index for index in range(vol_count)]
+        for vol_name in vol_names:
+            pvt.pre_vol(vol_name, vol_format, str(stream_size),
+                        str(stream_size), pool_name)
+        # All uploads send the same file, the volumes downloaded get it
+        # too, so both directions move stream_size bytes.
+        utils.run("dd if=/dev/urandom of=%s bs=1M count=%d"
+                  % (source_file, stream_size // 1048576))
+        for index, stream in enumerate(streams):
+            if stream == "download":
+                virsh.vol_upload(vol_names[index % vol_count], source_file,
+                                 "--pool %s" % pool_name,
+                                 ignore_status=False)
+
+        def transfer(index):
+            """
+            Run stream index.
+
+            :return: Dict with direction, volume, bytes and seconds
+            """
+            direction = streams[index]
+            vol_name = vol_names[index % vol_count]
+            options = "--pool %s" % pool_name
+            start = time.time()
+            if direction == "upload":
+                result = virsh.vol_upload(vol_name, source_file, options)
+            else:
+                target = os.path.join(test.tmpdir, "stream-download%d"
+                                      % index)
+                download_files.append(target)
+                result = virsh.vol_download(vol_name, target, options)
+            elapsed = time.time() - start
+            if result.exit_status:
+                raise error.TestFail("vol-%s of %s failed: %s"
+                                     % (direction, vol_name,
+                                        result.stderr.strip()))
+            return {"direction": direction, "volume": vol_name,
+                    "bytes": stream_size, "seconds": elapsed,
+                    "mb_per_sec": stream_size / 1048576.0 / elapsed}
+
+        sampler = bench_utils.ProcessSampler(get_daemon_pid(daemon),
+                                             interval)
+        worker_pool = ThreadPool(len(streams))
+        sampler.start()
+        start = time.time()
+        try:
+            results = worker_pool.map(transfer, range(len(streams)))
+        finally:
+            wall = time.time() - start
+            daemon_usage = sampler.stop()
+            worker_pool.close()
+            worker_pool.join()
+    finally:
+        pvt.cleanup_pool(pool_name, pool_type, pool_target, emulated_image)
+        for path in [source_file] + download_files:
+            if os.path.isfile(path):
+                os.remove(path)
+
+    report = {"pool_type": pool_type, "volumes": vol_count,
+              "stream_bytes": stream_size, "wall_seconds": wall,
+              "streams": results, "directions": {},
+              "daemon": dict(daemon_usage, name=daemon)}
+    for direction in ["upload", "download"]:
+        rates = [result["mb_per_sec"] for result in results
+                 if result["direction"] == direction]
+        if not rates:
+            continue
+        report["directions"][direction] = {
+            "mb_per_sec": bench_utils.sample_stats(rates),
+            "fairness": bench_utils.jain_fairness(rates)}
+    rates = [result["mb_per_sec"] for result in results]
+    report["aggregate_mb_per_sec"] = (stream_size * len(results) /
+                                      1048576.0 / wall)
+    report["fairness"] = bench_utils.jain_fairness(rates)
+    logging.info("%s streams on %s volumes: %.1f MB/s aggregate, fairness "
+                 "%.3f, %s CPU %s%%, RSS %s kB", len(results), vol_count,
+                 report["aggregate_mb_per_sec"], report["fairness"], daemon,
+                 daemon_usage["cpu_percent"].get("mean"),
+                 daemon_usage["rss_kb"].get("max"))
+    bench_utils.save_report(test, "vol_stream_stress", report)
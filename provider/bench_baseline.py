@@ -0,0 +1,332 @@
+"""
+Shared code for benchmark tests that need to check their results against
+a baseline
+
+Results are kept in JSON files, one file per host fingerprint, libvirt
+version and test variant, so a run is compared with earlier runs of the
+same test on the same kind of host and libvirt. Until a new libvirt
+version has enough runs of its own, its runs are compared with those of
+the libvirt version last recorded for the same host and variant, which
+is what catches the regressions of an upgrade.
+"""
+
+import os
+import json
+import time
+import socket
+import hashlib
+import logging
+import platform
+import multiprocessing
+
+from autotest.client.shared import error
+from virttest import data_dir
+
+from provider import bench_utils
+from provider import libvirt_version
+
+
+def _read_proc_field(path, field):
+    """
+    Get the value of the first 'field: value' line of a /proc file.
+    """
+    try:
+        proc_file = open(path)
+    except IOError:
+        return ""
+    try:
+        for line in proc_file:
+            if line.startswith(field):
+                return line.split(":", 1)[1].strip()
+    finally:
+        proc_file.close()
+    return ""
+
+
+def host_fingerprint():
+    """
+    Describe the hardware and kernel of the host.
+
+    :return: Dict of the host properties and their sha1 as 'id'
+    """
+    host = {"hostname": socket.gethostname(),
+            "cpu_model": _read_proc_field("/proc/cpuinfo", "model name"),
+            "cpu_count": multiprocessing.cpu_count(),
+            "mem_total": _read_proc_field("/proc/meminfo", "MemTotal"),
+            "kernel": platform.release()}
+    host["id"] = hashlib.sha1(json.dumps(host, sort_keys=True)).hexdigest()
+    return host
+
+
+def make_key(params):
+    """
+    Get the baseline key of a test run.
+
+    :param params: Test params, LB_report_suffix is added to the variant
+                   to tell apart sub tests of the same variant
+    :return: Dict with host, libvirt and variant
+    """
+    version = libvirt_version.get_lib_version()
+    variant = params.get("shortname", params.get("name", "unknown"))
+    if params.get("LB_report_suffix"):
+        variant += ".%s" % params.get("LB_report_suffix")
+    return {"host": host_fingerprint()["id"],
+            "libvirt": "%d.%d.%d" % (version // 1000000,
+                                     version // 1000 % 1000,
+                                     version % 1000),
+            "variant": variant}
+
+
+class BaselineStore(object):
+
+    """
+    File backed store of benchmark results keyed by make_key().
+    """
+
+    def __init__(self, store_dir, keep=20):
+        """
+        :param store_dir: Directory of the baseline files
+        :param keep: Number of recorded runs kept for each key
+        """
+        self.store_dir = store_dir
+        self.keep = keep
+        if not os.path.isdir(store_dir):
+            os.makedirs(store_dir)
+
+    def _path(self, key):
+        digest = hashlib.sha1(json.dumps(key, sort_keys=True)).hexdigest()
+        return os.path.join(self.store_dir, "%s.json" % digest)
+
+    def load(self, key):
+        """
+        Get the recorded runs of key, oldest first.
+
+        :return: List of dicts with 'time' and 'metrics'
+        """
+        path = self._path(key)
+        if not os.path.exists(path):
+            return []
+        store_file = open(path)
+        try:
+            try:
+                return json.load(store_file)["runs"]
+            except (ValueError, KeyError), detail:
+                logging.warning("Ignore broken baseline %s: %s", path, detail)
+                return []
+        finally:
+            store_file.close()
+
+    def latest_key(self, key):
+        """
+        Find the key of another libvirt version with the same host and
+        variant as key, the one with the most recently recorded run.
+
+        :return: Key dict, None if there is none
+        """
+        latest, latest_time = None, None
+        for name in os.listdir(self.store_dir):
+            if not name.endswith(".json"):
+                continue
+            try:
+                store_file = open(os.path.join(self.store_dir, name))
+            except IOError:
+                continue
+            try:
+                try:
+                    stored = json.load(store_file)
+                    other, runs = stored["key"], stored["runs"]
+                except (ValueError, KeyError):
+                    continue
+            finally:
+                store_file.close()
+            if (other.get("host") != key["host"] or
+                    other.get("variant") != key["variant"] or
+                    other.get("libvirt") == key["libvirt"] or not runs):
+                continue
+            if latest_time is None or runs[-1]["time"] > latest_time:
+                latest, latest_time = other, runs[-1]["time"]
+        return latest
+
+    def reset(self, key):
+        """
+        Forget the recorded runs of key.
+        """
+        path = self._path(key)
+        if os.path.exists(path):
+            os.remove(path)
+
+    def record(self, key, metrics):
+        """
+        Record the metrics of a run under key.
+
+        :param metrics: Dict of metric name to value
+        """
+        runs = self.load(key)
+        runs.append({"time": time.time(), "metrics": metrics})
+        runs = runs[-self.keep:]
+        path = self._path(key)
+        # Write to a temporary file first, so a broken run does not
+        # destroy the history.
+        tmp_path = "%s.tmp" % path
+        store_file = open(tmp_path, "w")
+        try:
+            json.dump({"key": key, "runs": runs}, store_file, indent=4,
+                      sort_keys=True)
+        finally:
+            store_file.close()
+        os.rename(tmp_path, path)
+
+
+def compare(runs, metrics, tolerance=10.0, sigma=3.0, min_runs=3,
+            higher_is_better=()):
+    """
+    Compare metrics with recorded runs.
+
+    A metric regresses when it is more than tolerance percent worse than
+    the mean of recorded runs and more than sigma standard deviations away
+    from that mean. With fewer than min_runs recorded runs there is no
+    telling noise from a regression, such a change is only marked as
+    'unchecked' in its comparison.
+
+    :param runs: Recorded runs returned by BaselineStore.load()
+    :param metrics: Dict of metric name to value of this run
+    :param tolerance: Allowed change in percent
+    :param sigma: Standard deviations a regression must exceed
+    :param min_runs: Recorded runs needed to report a regression
+    :param higher_is_better: Names of metrics such as throughput, others
+                             are taken as costs such as latency
+    :return: Tuple of (comparison dict per metric, list of regressions)
+    """
+    comparison = {}
+    regressions = []
+    for name, value in metrics.items():
+        history = [run["metrics"][name] for run in runs
+                   if run["metrics"].get(name) is not None]
+        if value is None or not history:
+            continue
+        stats = bench_utils.sample_stats(history)
+        mean = stats["mean"]
+        if not mean:
+            continue
+        change = (value - mean) * 100.0 / mean
+        worse = -change if name in higher_is_better else change
+        result = {"value": value, "baseline": mean,
+                  "stddev": stats["stddev"], "runs": stats["count"],
+                  "change": change, "regression": False}
+        if worse > tolerance:
+            if stats["count"] < min_runs:
+                result["unchecked"] = True
+                comparison[name] = result
+                continue
+            significant = True
+            if stats["stddev"]:
+                zscore = abs(value - mean) / stats["stddev"]
+                result["zscore"] = zscore
+                significant = zscore > sigma
+            if significant:
+                result["regression"] = True
+                regressions.append("%s is %.1f%% worse than the baseline "
+                                   "(%s vs %s over %s runs)"
+                                   % (name, worse, value, mean,
+                                      stats["count"]))
+        comparison[name] = result
+    return comparison, regressions
+
+
+def latency_metrics(report, percentiles=("p50", "p90")):
+    """
+    Get baseline metrics from a LatencyRecorder report.
+
+    :param report: Dict returned by LatencyRecorder.report()
+    :param percentiles: Summary fields of each operation to use
+    :return: Dict such as {"start.p50": 1.2, ...}
+    """
+    metrics = {}
+    for operation, data in report["operations"].items():
+        for percentile in percentiles:
+            if data.get(percentile) is not None:
+                metrics["%s.%s" % (operation, percentile)] = data[percentile]
+    return metrics
+
+
+def check_results(test, params, metrics, higher_is_better=()):
+    """
+    Compare the metrics of a benchmark run with its baseline, record them
+    and fail or warn on regressions, as configured by params:
+
+    LB_baseline: yes to use the baseline store
+    LB_baseline_dir: Directory of the store, default in the data dir
+    LB_baseline_tolerance: Allowed change in percent
+    LB_baseline_sigma: Standard deviations a regression must exceed
+    LB_baseline_min_runs: Recorded runs needed to report a regression,
+                          changes with less history are only warned about
+    LB_baseline_action: fail or warn on regressions
+    LB_baseline_record: yes to record runs without regression
+    LB_baseline_reset: yes to forget the history of this host, libvirt
+                       version and variant and record this run as the new
+                       baseline, when performance changed on purpose
+
+    Until min_runs runs of the libvirt version are recorded, the history
+    of the version last recorded for the host and variant is used if it
+    is longer. The version compared with is reported as
+    'baseline_libvirt'.
+
+    :param metrics: Dict of metric name to value of this run
+    :param higher_is_better: Names of metrics where higher is better
+    :return: Comparison dict per metric
+    """
+    if params.get("LB_baseline", "no") != "yes":
+        return {}
+    store_dir = params.get("LB_baseline_dir",
+                           os.path.join(data_dir.get_data_dir(),
+                                        "libvirt_bench", "baselines"))
+    tolerance = float(params.get("LB_baseline_tolerance", "10"))
+    sigma = float(params.get("LB_baseline_sigma", "3"))
+    min_runs = int(params.get("LB_baseline_min_runs", "3"))
+    action = params.get("LB_baseline_action", "fail")
+    record = params.get("LB_baseline_record", "yes") == "yes"
+    reset = params.get("LB_baseline_reset", "no") == "yes"
+
+    store = BaselineStore(store_dir)
+    key = make_key(params)
+    name = "baseline_%s" % key["variant"].replace("/", "_")
+    if reset:
+        logging.info("Reset baseline of %s", key)
+        store.reset(key)
+        store.record(key, metrics)
+        bench_utils.save_report(test, name, {"key": key, "metrics": metrics,
+                                             "comparison": {}, "reset": True})
+        return {}
+    baseline_key = key
+    runs = store.load(key)
+    if len(runs) < min_runs:
+        # Just upgraded, the previous version tells more.
+        other = store.latest_key(key)
+        other_runs = other and store.load(other) or []
+        if len(other_runs) > len(runs):
+            logging.info("%s runs of libvirt %s recorded, compare with "
+                         "libvirt %s", len(runs), key["libvirt"],
+                         other["libvirt"])
+            baseline_key, runs = other, other_runs
+    comparison, regressions = compare(runs, metrics, tolerance, sigma,
+                                      min_runs, higher_is_better)
+    bench_utils.save_report(test, name,
+                            {"key": key, "metrics": metrics,
+                             "baseline_libvirt": baseline_key["libvirt"],
+                             "comparison": comparison})
+    unchecked = sorted(metric for metric, result in comparison.items()
+                       if result.get("unchecked"))
+    if unchecked:
+        logging.warning("Worse than the baseline of libvirt %s, not "
+                        "checked with fewer than %s recorded runs: %s",
+                        baseline_key["libvirt"], min_runs,
+                        ", ".join(unchecked))
+    if record and not regressions:
+        store.record(key, metrics)
+    if regressions:
+        msg = ("Regressions against the baseline of libvirt %s:\n%s"
+               % (baseline_key["libvirt"], "\n".join(regressions)))
+        if action == "fail":
+            raise error.TestFail(msg)
+        logging.warning(msg)
+    return comparison
@@ -0,0 +1,463 @@
+"""
+Shared code for tests that need to record and report benchmark results
+"""
+
+import os
+import math
+import time
+import json
+import logging
+import threading
+
+from virttest import virsh
+
+
+def get_report_dir(test):
+    """
+    Get the directory benchmark reports are written to, creating it
+    if needed.
+
+    :param test: Test object
+    :return: Path of the report directory
+    """
+    report_dir = getattr(test, "resultsdir", None) or test.tmpdir
+    if not os.path.isdir(report_dir):
+        os.makedirs(report_dir)
+    return report_dir
+
+
+def save_report(test, name, report):
+    """
+    Write a benchmark report as JSON next to the test results.
+
+    :param test: Test object
+    :param name: Base name of the report file, without extension
+    :param report: JSON serializable report data
+    :return: Path of the written report
+    """
+    report_path = os.path.join(get_report_dir(test), "%s.json" % name)
+    report_file = open(report_path, "w")
+    try:
+        json.dump(report, report_file, indent=4, sort_keys=True)
+    finally:
+        report_file.close()
+    logging.info("Benchmark report saved to %s", report_path)
+    return report_path
+
+
+def get_domstates(virsh_instance=virsh):
+    """
+    Get the state of all domains with a single 'virsh list --all'.
+
+    :param virsh_instance: virsh module or a Virsh instance to run with
+    :return: Dict of domain name to state, such as "running"
+    """
+    result = virsh_instance.dom_list("--all", ignore_status=True)
+    if result.exit_status:
+        logging.error("Failed to list domains: %s", result.stderr)
+        return {}
+    states = {}
+    # Skip the header and separator lines.
+    for line in result.stdout.strip().splitlines()[2:]:
+        fields = line.split(None, 2)
+        if len(fields) == 3:
+            states[fields[1]] = fields[2].strip()
+    return states
+
+
+class LatencyHistogram(object):
+
+    """
+    Log-linear latency histogram in the style of HdrHistogram.
+
+    Values are stored in microseconds and rounded down to precision_bits
+    significant bits, so every reported percentile has a relative error
+    below 2 ** -precision_bits while memory stays bounded.
+    """
+
+    def __init__(self, precision_bits=7):
+        self.precision_bits = precision_bits
+        self.counts = {}
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def _bucket(self, value):
+        shift = max(value.bit_length() - self.precision_bits, 0)
+        return (value >> shift) << shift
+
+    def _highest_equivalent(self, bucket):
+        shift = max(bucket.bit_length() - self.precision_bits, 0)
+        return bucket + (1 << shift) - 1
+
+    def record(self, seconds):
+        """
+        Record one latency sample.
+
+        :param seconds: Latency in seconds
+        """
+        value = max(int(round(seconds * 1000000)), 0)
+        bucket = self._bucket(value)
+        self.counts[bucket] = self.counts.get(bucket, 0) + 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        """
+        Add all samples of another histogram into this one.
+        """
+        for bucket, count in other.counts.items():
+            bucket = self._bucket(bucket)
+            self.counts[bucket] = self.counts.get(bucket, 0) + count
+        self.count += other.count
+        self.total += other.total
+        for value in (other.min, other.max):
+            if value is None:
+                continue
+            if self.min is None or value < self.min:
+                self.min = value
+            if self.max is None or value > self.max:
+                self.max = value
+
+    def percentile(self, percent):
+        """
+        Get the latency in seconds below which percent of samples fall.
+
+        :param percent: Percentile between 0 and 100
+        :return: Latency in seconds, None if there is no sample
+        """
+        if not self.count:
+            return None
+        rank = max(int(math.ceil(percent / 100.0 * self.count)), 1)
+        running = 0
+        for bucket in sorted(self.counts):
+            running += self.counts[bucket]
+            if running >= rank:
+                value = min(self._highest_equivalent(bucket), self.max)
+                return value / 1000000.0
+        return self.max / 1000000.0
+
+    def summary(self):
+        """
+        Get count, min, mean, p50, p90, p99 and max of the samples.
+        Latencies are in seconds.
+        """
+        if not self.count:
+            return {"count": 0}
+        return {"count": self.count,
+                "min": self.min / 1000000.0,
+                "mean": self.total / 1000000.0 / self.count,
+                "p50": self.percentile(50),
+                "p90": self.percentile(90),
+                "p99": self.percentile(99),
+                "max": self.max / 1000000.0}
+
+    def to_dict(self):
+        """
+        Get the summary together with the raw buckets, as
+        [[bucket_usec, count], ...].
+        """
+        data = self.summary()
+        data["buckets"] = [[bucket, self.counts[bucket]]
+                           for bucket in sorted(self.counts)]
+        return data
+
+
+class LatencyRecorder(object):
+
+    """
+    Keep one LatencyHistogram per operation, and per vm of an operation.
+    """
+
+    def __init__(self):
+        self.operations = {}
+        self.vms = {}
+        self.lock = threading.Lock()
+
+    def record(self, operation, seconds, vm_name=None):
+        """
+        Record the latency of an operation, optionally done on vm_name.
+        It is safe to call from several threads.
+        """
+        self.lock.acquire()
+        try:
+            if operation not in self.operations:
+                self.operations[operation] = LatencyHistogram()
+            self.operations[operation].record(seconds)
+            if vm_name is None:
+                return
+            vm_ops = self.vms.setdefault(vm_name, {})
+            if operation not in vm_ops:
+                vm_ops[operation] = LatencyHistogram()
+            vm_ops[operation].record(seconds)
+        finally:
+            self.lock.release()
+
+    def time_call(self, operation, vm_name, func, *args, **kwargs):
+        """
+        Call func(*args, **kwargs) and record how long it takes.
+
+        :return: Return value of func
+        """
+        start = time.time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.record(operation, time.time() - start, vm_name)
+
+    def report(self):
+        """
+        Get the histograms of all operations and the per vm summary.
+        """
+        per_vm = {}
+        for vm_name, vm_ops in self.vms.items():
+            per_vm[vm_name] = dict((operation, histogram.summary())
+                                   for operation, histogram
+                                   in vm_ops.items())
+        return {"operations": dict((operation, histogram.to_dict())
+                                   for operation, histogram
+                                   in self.operations.items()),
+                "vms": per_vm}
+
+    def log_summary(self):
+        """
+        Log p50/p90/p99/max of each operation.
+        """
+        for operation in sorted(self.operations):
+            summary = self.operations[operation].summary()
+            logging.info("%s: count=%s p50=%.3fs p90=%.3fs p99=%.3fs "
+                         "max=%.3fs", operation, summary["count"],
+                         summary["p50"], summary["p90"], summary["p99"],
+                         summary["max"])
+
+
+class VirshSessionPool(object):
+
+    """
+    Hand out one VirshPersistent session per worker thread, so that virsh
+    commands are sent to a running virsh instead of forking a new virsh
+    and connecting to libvirtd every time.
+    """
+
+    def __init__(self, **dargs):
+        """
+        :param dargs: Arguments for each VirshPersistent instance
+        """
+        self.dargs = dargs
+        self.sessions = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def get(self):
+        """
+        Get the session of the calling thread, creating it if needed.
+        """
+        session = getattr(self.local, "session", None)
+        if session is None:
+            session = virsh.VirshPersistent(**self.dargs)
+            self.local.session = session
+            self.lock.acquire()
+            try:
+                self.sessions.append(session)
+            finally:
+                self.lock.release()
+        return session
+
+    def close(self):
+        """
+        Close all sessions of the pool.
+        """
+        self.lock.acquire()
+        try:
+            for session in self.sessions:
+                session.close_session()
+            self.sessions = []
+        finally:
+            self.lock.release()
+
+
+def get_virsh_func(virsh_func, session_pool=None):
+    """
+    Get the function to run a virsh module function with.
+
+    :param virsh_func: Function in virsh module, such as virsh.start
+    :param session_pool: VirshSessionPool to route the command through,
+                         None means fork a new virsh
+    :return: virsh_func itself or the same function of the session
+    """
+    if session_pool is None:
+        return virsh_func
+    return getattr(session_pool.get(), virsh_func.__name__)
+
+
+def measure_virsh_overhead(repeat=10):
+    """
+    Measure the fixed cost of a virsh command by timing the no-op
+    'virsh uri', once forking a new virsh every time and once through
+    a VirshPersistent session.
+
+    :param repeat: Times to run the command in each mode
+    :return: Dict with the 'fork' and 'persistent' latency summaries and
+             'fork_connect', the mean fork and connect overhead in seconds
+    """
+    fork_noop = LatencyHistogram()
+    persistent_noop = LatencyHistogram()
+    session = virsh.VirshPersistent()
+    try:
+        for _ in range(repeat):
+            start = time.time()
+            virsh.command("uri", ignore_status=True)
+            fork_noop.record(time.time() - start)
+            start = time.time()
+            session.command("uri", ignore_status=True)
+            persistent_noop.record(time.time() - start)
+    finally:
+        session.close_session()
+    overhead = {"fork": fork_noop.summary(),
+                "persistent": persistent_noop.summary()}
+    overhead["fork_connect"] = max(overhead["fork"]["mean"] -
+                                   overhead["persistent"]["mean"], 0)
+    logging.info("virsh fork and connect overhead: %.3fs",
+                 overhead["fork_connect"])
+    return overhead
+
+
+def split_virsh_overhead(report, overhead, operations, persistent=False):
+    """
+    Split the mean latency of virsh operations in a LatencyRecorder report
+    into the fixed virsh overhead and the domain operation itself.
+
+    :param report: Dict returned by LatencyRecorder.report()
+    :param overhead: Dict returned by measure_virsh_overhead()
+    :param operations: Names of the operations run by virsh
+    :param persistent: Whether the operations ran in persistent sessions
+    """
+    mode = "fork"
+    if persistent:
+        mode = "persistent"
+    fixed = overhead[mode]["mean"]
+    for operation in operations:
+        data = report["operations"].get(operation)
+        if not data or not data["count"]:
+            continue
+        data["virsh_overhead"] = min(fixed, data["mean"])
+        data["domain_operation"] = data["mean"] - data["virsh_overhead"]
+    report["virsh_overhead"] = dict(overhead, mode=mode)
+
+
+def sample_stats(values):
+    """
+    Get count, mean, stddev, min, median and max of samples.
+
+    :param values: List of numbers
+    :return: Dict of the statistics, only count if values is empty
+    """
+    if not values:
+        return {"count": 0}
+    values = sorted(values)
+    count = len(values)
+    mean = sum(values) / float(count)
+    variance = sum((value - mean) ** 2 for value in values) / count
+    if count % 2:
+        median = values[count // 2]
+    else:
+        median = (values[count // 2 - 1] + values[count // 2]) / 2.0
+    return {"count": count,
+            "mean": mean,
+            "stddev": math.sqrt(variance),
+            "min": values[0],
+            "median": median,
+            "max": values[-1]}
+
+
+def jain_fairness(values):
+    """
+    Get Jain's fairness index of values, such as the throughput of
+    streams: 1 when all are equal, 1/n when one gets everything.
+    """
+    if not values or not sum(values):
+        return None
+    return float(sum(values)) ** 2 / (len(values) *
+                                      sum(value ** 2 for value in values))
+
+
+class ProcessSampler(object):
+
+    """
+    Sample CPU usage and RSS of a process from /proc in a thread.
+    """
+
+    def __init__(self, pid, interval=1.0):
+        """
+        :param pid: Process to sample
+        :param interval: Seconds between samples
+        """
+        self.pid = pid
+        self.interval = interval
+        self.samples = []
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.ticks = os.sysconf(os.sysconf_names["SC_CLK_TCK"])
+
+    def _cpu_seconds(self):
+        stat_file = open("/proc/%d/stat" % self.pid)
+        try:
+            # Fields after the command name, which may hold spaces.
+            fields = stat_file.read().rsplit(")", 1)[1].split()
+        finally:
+            stat_file.close()
+        # utime and stime are fields 14 and 15 of stat.
+        return (int(fields[11]) + int(fields[12])) / float(self.ticks)
+
+    def _rss_kb(self):
+        status_file = open("/proc/%d/status" % self.pid)
+        try:
+            for line in status_file:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+        finally:
+            status_file.close()
+        return 0
+
+    def _run(self):
+        last_time = time.time()
+        last_cpu = self._cpu_seconds()
+        while not self.stop_event.wait(self.interval):
+            try:
+                now, cpu = time.time(), self._cpu_seconds()
+                rss = self._rss_kb()
+            except (IOError, OSError, IndexError, ValueError), detail:
+                logging.warning("Stop sampling process %s: %s", self.pid,
+                                detail)
+                return
+            self.samples.append({"time": now,
+                                 "cpu_percent": (cpu - last_cpu) * 100.0 /
+                                                (now - last_time),
+                                 "rss_kb": rss})
+            last_time, last_cpu = now, cpu
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stop sampling.
+
+        :return: Dict with cpu_percent and rss_kb statistics and the
+                 samples
+        """
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+        return {"cpu_percent": sample_stats([sample["cpu_percent"]
+                                             for sample in self.samples]),
+                "rss_kb": sample_stats([sample["rss_kb"]
+                                        for sample in self.samples]),
+                "samples": self.samples}
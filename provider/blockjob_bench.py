@@ -0,0 +1,229 @@
+"""
+Shared code for block job tests that measure how fast a job copies data
+
+A BlockJobSampler polls virsh blockjob --info of one disk over a
+persistent virsh session, so samples can be taken every 100 ms, while
+blockcopy, blockpull or blockcommit runs. Its report has the bytes done
+over time, the rate between samples and the mean rate of the job, which
+check_bandwidth() compares with the --bandwidth limit of the job.
+"""
+
+import re
+import time
+import logging
+import threading
+
+from autotest.client.shared import utils
+from virttest import virsh
+
+from provider import bench_utils
+from provider import migration_utils
+
+# "Block Copy: [ 1048576 of 10737418240 bytes]" of blockjob --bytes
+BYTES_RE = re.compile(r"^(.+?):\s*\[\s*(\d+) of (\d+) bytes\s*\]")
+# "Bandwidth limit: 1048576 bytes/s (1.000 MiB/s)" or "... 1 MiB/s"
+BANDWIDTH_RE = re.compile(r"Bandwidth limit:\s*(\d+)\s*(bytes/s|MiB/s)")
+
+
+def image_virtual_size(path):
+    """
+    Get the virtual size in bytes of a disk image from qemu-img info.
+    """
+    output = utils.run("qemu-img info %s" % path).stdout
+    mobj = re.search(r"virtual size:.*\((\d+) bytes\)", output)
+    if not mobj:
+        return None
+    return int(mobj.group(1))
+
+
+def parse_blockjob_info(output, size=None):
+    """
+    Parse the output of virsh blockjob --info, with or without --bytes.
+
+    :param size: Bytes of the job, to convert a progress in percent
+    :return: Dict with job_type, cur and end bytes, percent and bandwidth
+             limit in bytes/s, None if there is no job
+    """
+    info = None
+    for line in output.strip().splitlines():
+        line = line.strip()
+        mobj = BYTES_RE.match(line)
+        if mobj:
+            cur, end = int(mobj.group(2)), int(mobj.group(3))
+            info = {"job_type": mobj.group(1), "cur": cur, "end": end,
+                    "percent": end and cur * 100.0 / end or 0.0}
+            continue
+        mobj = migration_utils.BLOCKJOB_RE.match(line)
+        if mobj:
+            percent = float(mobj.group(2))
+            info = {"job_type": mobj.group(1), "percent": percent,
+                    "cur": None, "end": size}
+            if size:
+                info["cur"] = int(size * percent / 100)
+            continue
+        mobj = BANDWIDTH_RE.search(line)
+        if mobj and info is not None:
+            limit = int(mobj.group(1))
+            if mobj.group(2) == "MiB/s":
+                limit *= 1048576
+            info["bandwidth"] = limit
+    return info
+
+
+class BlockJobSampler(object):
+
+    """
+    Sample the progress of the block job of one disk in a thread.
+    """
+
+    def __init__(self, vm_name, target, interval=0.1, size=None):
+        """
+        :param vm_name: Name of the domain
+        :param target: Target of the disk, such as vda
+        :param interval: Seconds between samples
+        :param size: Bytes the job copies, used when virsh has no
+                     blockjob --bytes
+        """
+        self.vm_name = vm_name
+        self.target = target
+        self.interval = interval
+        self.size = size
+        self.samples = []
+        self.seen_job = False
+        self.done = threading.Event()
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.virsh_instance = None
+        self.options = "--info --bytes"
+        self.start_time = None
+
+    def _poll(self):
+        result = self.virsh_instance.blockjob(self.vm_name, self.target,
+                                              self.options,
+                                              ignore_status=True)
+        if (result.exit_status and self.options.count("--bytes") and
+                "bytes" in result.stderr):
+            # No --bytes before libvirt 1.2.9, use the percent.
+            logging.debug("blockjob --bytes failed, poll the percent")
+            self.options = "--info"
+            return self._poll()
+        return parse_blockjob_info(result.stdout, self.size)
+
+    def _run(self):
+        while not self.stop_event.is_set():
+            now = time.time() - self.start_time
+            try:
+                info = self._poll()
+            except Exception, detail:
+                logging.warning("Stop sampling block job of %s: %s",
+                                self.target, detail)
+                break
+            if info is None:
+                if self.seen_job:
+                    # The job ended between two samples.
+                    self.done.set()
+            else:
+                self.seen_job = True
+                info["time"] = now
+                self.samples.append(info)
+                if info["percent"] >= 100:
+                    self.done.set()
+            self.stop_event.wait(self.interval)
+        self.done.set()
+
+    def start(self):
+        self.virsh_instance = virsh.VirshPersistent()
+        self.start_time = time.time()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def wait_done(self, timeout):
+        """
+        Wait until the job reached 100%, which mirroring jobs stay at
+        until pivot or abort, or ended.
+
+        :return: True if it did within timeout
+        """
+        self.done.wait(timeout)
+        return self.done.is_set()
+
+    def stop(self):
+        """
+        Stop sampling.
+
+        :return: Dict with job type, seconds from the first to the last
+                 sample, bytes done, mean rate and rate between samples in
+                 MiB/s, bandwidth limit in MiB/s and the samples by column
+        """
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+        if self.virsh_instance is not None:
+            self.virsh_instance.close_session()
+        samples = [sample for sample in self.samples
+                   if sample["cur"] is not None]
+        report = {"job_type": None, "seconds": None, "bytes": None,
+                  "mib_per_sec": None, "bandwidth_mib": None,
+                  "rate_stats": {"count": 0},
+                  "columns": {"time": [sample["time"]
+                                       for sample in self.samples],
+                              "cur": [sample["cur"]
+                                      for sample in self.samples],
+                              "percent": [sample["percent"]
+                                          for sample in self.samples]}}
+        if self.samples:
+            report["job_type"] = self.samples[-1]["job_type"]
+            limit = self.samples[-1].get("bandwidth")
+            if limit:
+                report["bandwidth_mib"] = limit / 1048576.0
+        # The rate while copying, up to the first sample at 100%.
+        copying = []
+        for sample in samples:
+            copying.append(sample)
+            if sample["percent"] >= 100:
+                break
+        rates = []
+        for sample, next_sample in zip(copying, copying[1:]):
+            elapsed = next_sample["time"] - sample["time"]
+            if elapsed > 0:
+                rates.append((next_sample["cur"] - sample["cur"]) /
+                             1048576.0 / elapsed)
+        report["rates"] = rates
+        report["rate_stats"] = bench_utils.sample_stats(rates)
+        if len(copying) > 1:
+            elapsed = copying[-1]["time"] - copying[0]["time"]
+            report["seconds"] = elapsed
+            report["bytes"] = copying[-1]["cur"] - copying[0]["cur"]
+            if elapsed > 0:
+                report["mib_per_sec"] = report["bytes"] / 1048576.0 / elapsed
+        logging.info("Block job of %s: %s MiB/s over %s samples",
+                     self.target, report["mib_per_sec"], len(self.samples))
+        return report
+
+
+def check_bandwidth(report, limit, tolerance=0.1, min_samples=3,
+                    strict=False):
+    """
+    Check a block job did not copy faster than its bandwidth limit.
+
+    :param report: Value of BlockJobSampler.stop()
+    :param limit: Bandwidth limit in MiB/s
+    :param tolerance: Allowed ratio above the limit
+    :param min_samples: Fewer rates than this are not checked
+    :param strict: Treat too few rates as an error, for jobs that were
+                   given enough data to copy at the limit
+    :return: Error message, None if the limit was honoured or there were
+             too few samples and strict is False
+    """
+    if report["rate_stats"]["count"] < min_samples:
+        msg = ("Only %s rate samples of the block job, too few to check "
+               "its bandwidth" % report["rate_stats"]["count"])
+        if strict:
+            return msg
+        logging.warning(msg)
+        return None
+    if report["mib_per_sec"] > limit * (1 + tolerance):
+        return ("Block job copied %.1f MiB/s with a limit of %s MiB/s"
+                % (report["mib_per_sec"], limit))
+    return None
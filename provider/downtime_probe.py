@@ -0,0 +1,121 @@
+"""
+Shared code for migration tests that need to measure the downtime of a
+guest
+
+A DowntimeProbe pings the guest every interval seconds, such as every
+10 ms, with timestamps on the replies. The longest gap between replies
+is the blackout window of the guest, with a resolution of one interval.
+"""
+
+import os
+import re
+import time
+import signal
+import logging
+import tempfile
+import subprocess
+
+# Reply line of ping -D, such as
+# "[1400000000.123456] 64 bytes from 10.0.0.2: icmp_seq=12 ttl=64 ..."
+REPLY_RE = re.compile(r"^\[(\d+\.\d+)\].*icmp_[rs]eq=(\d+)")
+
+
+def parse_ping_output(output):
+    """
+    Get the replies of ping -D output.
+
+    :return: List of (icmp_seq, timestamp) ordered by icmp_seq
+    """
+    replies = {}
+    for line in output.splitlines():
+        mobj = REPLY_RE.match(line.strip())
+        if mobj:
+            # Duplicated replies keep the first timestamp.
+            replies.setdefault(int(mobj.group(2)), float(mobj.group(1)))
+    return sorted(replies.items())
+
+
+def compute_blackout(replies, interval, end_time=None):
+    """
+    Find the longest window without replies.
+
+    :param replies: Value of parse_ping_output()
+    :param interval: Seconds between probes
+    :param end_time: Time probing stopped, a guest that did not reply
+                     since its last reply is down until then
+    :return: Dict with blackout seconds, its start and end time, lost
+             probes in it and in total, and whether the guest recovered
+    """
+    result = {"blackout": 0.0, "start": None, "end": None,
+              "lost": 0, "total_lost": 0, "recovered": True,
+              "replies": len(replies)}
+    if not replies:
+        result["recovered"] = False
+        return result
+    for (seq, stamp), (next_seq, next_stamp) in zip(replies, replies[1:]):
+        lost = next_seq - seq - 1
+        result["total_lost"] += lost
+        if lost <= 0:
+            continue
+        # The guest was last seen at stamp and next seen at next_stamp,
+        # the probes in between were sent one interval apart.
+        blackout = max(next_stamp - stamp - interval, 0.0)
+        if blackout > result["blackout"]:
+            result.update({"blackout": blackout, "start": stamp,
+                           "end": next_stamp, "lost": lost})
+    last_stamp = replies[-1][1]
+    if end_time is not None and end_time - last_stamp > 10 * interval + 1:
+        # No reply at the end, the guest did not come back.
+        result.update({"blackout": end_time - last_stamp,
+                       "start": last_stamp, "end": None,
+                       "recovered": False})
+    return result
+
+
+class DowntimeProbe(object):
+
+    """
+    Ping a guest at a fixed interval in the background.
+    """
+
+    def __init__(self, address, interval=0.01):
+        """
+        :param address: IP address of the guest
+        :param interval: Seconds between probes, below 0.2 needs root
+        """
+        self.address = address
+        self.interval = interval
+        self.process = None
+        self.output_file = None
+        self.start_time = None
+
+    def start(self):
+        self.output_file = tempfile.TemporaryFile()
+        # Write to a file, a full pipe would stall ping and lose probes.
+        self.process = subprocess.Popen(["ping", "-D", "-n", "-i",
+                                         str(self.interval), self.address],
+                                        stdout=self.output_file,
+                                        stderr=subprocess.STDOUT)
+        self.start_time = time.time()
+        logging.debug("Probe %s every %ss, ping pid %s", self.address,
+                      self.interval, self.process.pid)
+
+    def stop(self):
+        """
+        Stop probing.
+
+        :return: Value of compute_blackout() with the interval and the
+                 seconds probed
+        """
+        end_time = time.time()
+        if self.process.poll() is None:
+            os.kill(self.process.pid, signal.SIGINT)
+        self.process.wait()
+        self.output_file.seek(0)
+        output = self.output_file.read()
+        self.output_file.close()
+        result = compute_blackout(parse_ping_output(output), self.interval,
+                                  end_time)
+        result["interval"] = self.interval
+        result["probed"] = end_time - self.start_time
+        return result
@@ -0,0 +1,163 @@
+"""
+Shared code for guestfish tests that run a fixed sequence of commands
+
+A test case queues its commands on a GuestfishBatch, calls execute() and
+then checks the result of every command. With gf_batch = yes the whole
+sequence is sent to one guestfish process as a script, instead of waiting
+for the prompt after every command, and the output is split up by
+markers echoed between the commands. Otherwise the commands run one by
+one on a guestfish session as before, so a test case is written once for
+both modes.
+"""
+
+import re
+import time
+import logging
+
+from autotest.client.shared import error, utils
+
+from provider import guestfs_session
+
+# Echoed before every command of a script, followed by its index.
+MARKER = "@@gf-batch@@"
+# Lines guestfish prints when a command fails.
+ERROR_RE = re.compile(r"^(libguestfs: error:|guestfish: (?!warning))")
+
+
+def quote_arg(arg):
+    """
+    Quote an argument for a guestfish script.
+    """
+    arg = str(arg)
+    if arg and not re.search(r"[\s\"'\\#]", arg):
+        return arg
+    return '"%s"' % arg.replace("\\", "\\\\").replace('"', '\\"')
+
+
+def format_command(name, args, dargs):
+    """
+    Get the guestfish script line of a GuestfishTools style call, such as
+    add_drive_opts("a.img", readonly="yes") -> add-drive-opts a.img
+    readonly:true
+    """
+    words = [name.replace("_", "-")]
+    words.extend(quote_arg(arg) for arg in args)
+    for key, value in sorted(dargs.items()):
+        if value in [True, "yes"]:
+            value = "true"
+        elif value in [False, "no"]:
+            value = "false"
+        words.append(quote_arg("%s:%s" % (key, value)))
+    return " ".join(words)
+
+
+def parse_script_output(output, results):
+    """
+    Split the output of a batch script and fill in results.
+
+    :param output: Output of guestfish, stdout and stderr in order
+    :param results: CmdResult of every command of the script, in order
+    """
+    parts = re.split(r"(?m)^%s(\d+)\s*$" % re.escape(MARKER), output)
+    # parts is [before, index, output, index, output, ...]
+    seen = set()
+    for index, part in zip(parts[1::2], parts[2::2]):
+        index = int(index)
+        if index >= len(results):
+            continue
+        seen.add(index)
+        lines = part.strip("\n").splitlines()
+        errors = [line for line in lines if ERROR_RE.search(line)]
+        results[index].stdout = "\n".join(line for line in lines
+                                          if line not in errors)
+        results[index].stderr = "\n".join(errors)
+        results[index].exit_status = int(bool(errors))
+    for index, result in enumerate(results):
+        if index not in seen:
+            # guestfish exited before it got to this command.
+            result.stderr = "Not run, guestfish exited before"
+            result.exit_status = -1
+
+
+class GuestfishBatch(object):
+
+    """
+    Queue of guestfish commands of a test case.
+
+    Every GuestfishTools method can be called on a batch and gives a
+    CmdResult, whose stdout and exit_status are known after execute().
+    """
+
+    def __init__(self, params):
+        self.params = params
+        self.script_mode = params.get("gf_batch", "no") == "yes"
+        self.results = []
+        self.images = []
+        self.gf = None
+        if not self.script_mode:
+            self.gf = guestfs_session.get_guestfish(params)
+
+    def _call(self, name, *args, **dargs):
+        if name in ["add_drive", "add_drive_opts", "add_drive_ro"] and args:
+            self.images.append(args[0])
+        if self.gf is not None:
+            result = getattr(self.gf, name)(*args, **dargs)
+            if result is None:
+                result = utils.CmdResult(name, exit_status=0)
+        else:
+            result = utils.CmdResult(format_command(name, args, dargs))
+        self.results.append(result)
+        return result
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+
+        def _command(*args, **dargs):
+            return self._call(name, *args, **dargs)
+        return _command
+
+    def _run_script(self, timeout):
+        lines = []
+        for index, result in enumerate(self.results):
+            lines.append("echo %s%d" % (MARKER, index))
+            # A leading - lets guestfish go on after a failed command.
+            lines.append("-%s" % result.command)
+        script = "\n".join(lines) + "\n"
+        logging.debug("guestfish batch script:\n%s", script)
+        # Idle appliances of the session pool may hold the images.
+        guestfs_session.POOL.discard(self.images)
+        # Line buffered stdout keeps the order of output and errors.
+        cmd = "stdbuf -oL %s 2>&1" % self.params.get("gf_binary", "guestfish")
+        start = time.time()
+        output = utils.run(cmd, timeout=timeout, ignore_status=True,
+                           stdin=script).stdout
+        duration = time.time() - start
+        parse_script_output(output, self.results)
+        for result in self.results:
+            result.duration = duration
+        logging.info("Ran %s guestfish commands as one script in %.1fs",
+                     len(self.results), duration)
+
+    def execute(self, ignore_status=False, timeout=600):
+        """
+        Run the queued commands, or finish the session they ran on.
+
+        :param ignore_status: Do not raise when a command fails, for test
+                              cases that expect failures
+        :param timeout: Seconds the script may run
+        :return: CmdResult of every command, in order
+        :raise error.TestFail: If a command failed, naming the command
+        """
+        if self.gf is not None:
+            self.gf.close_session()
+        else:
+            self._run_script(timeout)
+        if not ignore_status:
+            for index, result in enumerate(self.results):
+                if result.exit_status:
+                    raise error.TestFail("guestfish command %s '%s' failed:"
+                                         "\n%s" % (index, result.command,
+                                                   result.stderr or
+                                                   result.stdout))
+        return self.results
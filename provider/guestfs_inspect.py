@@ -0,0 +1,180 @@
+"""
+Shared code for libguestfs tests that inspect the OS of a guest image
+
+Inspection boots the appliance and probes every filesystem, which takes
+seconds. Its results are stored by the identity of the disk images, so
+another test inspecting the same unmodified images can take them from
+the cache. guestfs_* and virt_* tests use the same fields: root, arch,
+distro, hostname, major_version, minor_version, release, filesystems and
+mountpoints.
+"""
+
+import os
+import json
+import hashlib
+import logging
+
+from virttest import data_dir
+
+# Blocks read for the sampled content hash of an image.
+SAMPLE_BLOCKS = 16
+SAMPLE_SIZE = 64 * 1024
+
+
+def _sample_hash(path):
+    """
+    Hash SAMPLE_BLOCKS blocks spread evenly over the file.
+    """
+    size = os.path.getsize(path)
+    digest = hashlib.sha1()
+    image = open(path, "rb")
+    try:
+        for index in range(SAMPLE_BLOCKS):
+            image.seek(size * index // SAMPLE_BLOCKS)
+            digest.update(image.read(SAMPLE_SIZE))
+    finally:
+        image.close()
+    return digest.hexdigest()
+
+
+def disk_identity(paths, sample_hash=False):
+    """
+    Describe disk images so that a change to them changes the result.
+
+    By default the size, mtime and inode of the images are used, so any
+    write changes the identity. With sample_hash, only the size and a hash
+    of SAMPLE_BLOCKS blocks of SAMPLE_SIZE bytes are used, so results are
+    kept for images that are opened or booted without their content
+    changing. That is unsafe for images written to: most writes, such as
+    installing packages or sysprep edits, miss the sampled blocks and do
+    not change the size, and the stale identity is kept.
+
+    :param paths: Paths of the disk images of a guest
+    :param sample_hash: Use the sample hash instead of mtime and inode,
+                        only for images that are never written to
+    :return: List of dicts with path, size and either mtime and inode or
+             sample_hash, None if an image does not exist
+    """
+    identity = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        disk = {"path": os.path.realpath(path), "size": stat.st_size}
+        if sample_hash:
+            disk["sample_hash"] = _sample_hash(path)
+        else:
+            disk.update({"mtime": stat.st_mtime, "inode": stat.st_ino})
+        identity.append(disk)
+    return identity
+
+
+def get_vm_disks(vm):
+    """
+    Get the paths of the disk images of vm.
+    """
+    return [disk["source"] for disk in vm.get_disk_devices().values()
+            if disk.get("source")]
+
+
+class InspectionCache(object):
+
+    """
+    Inspection results stored as JSON files named by the sha1 of the
+    disk_identity() of the inspected images.
+    """
+
+    def __init__(self, cache_dir, enabled=True, sample_hash=False):
+        """
+        :param cache_dir: Directory of the cache files
+        :param enabled: False to never return results, they are still
+                        stored for later runs
+        :param sample_hash: Passed to disk_identity()
+        """
+        self.cache_dir = cache_dir
+        self.enabled = enabled
+        self.sample_hash = sample_hash
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    @classmethod
+    def from_params(cls, params):
+        """
+        Get the cache configured by params:
+
+        gf_inspect_cache: yes to take results from the cache
+        gf_inspect_cache_dir: Directory of the cache, default in data dir
+        gf_inspect_cache_hash: yes to identify images by sampled content
+        """
+        cache_dir = params.get("gf_inspect_cache_dir",
+                               os.path.join(data_dir.get_data_dir(),
+                                            "libguestfs", "inspect_cache"))
+        return cls(cache_dir,
+                   params.get("gf_inspect_cache", "no") == "yes",
+                   params.get("gf_inspect_cache_hash", "no") == "yes")
+
+    def _path(self, disks):
+        identity = disk_identity(disks, self.sample_hash)
+        if not identity:
+            return None
+        digest = hashlib.sha1(json.dumps(identity, sort_keys=True))
+        return os.path.join(self.cache_dir, "%s.json" % digest.hexdigest())
+
+    def _read(self, path):
+        try:
+            cache_file = open(path)
+        except IOError:
+            return {}
+        try:
+            try:
+                return json.load(cache_file)
+            except ValueError:
+                return {}
+        finally:
+            cache_file.close()
+
+    def load(self, disks, required=()):
+        """
+        Get the cached inspection results of disks.
+
+        :param disks: Paths of the disk images
+        :param required: Fields the results must have
+        :return: Dict of results, None if the cache is disabled, there are
+                 no results or some required field is missing
+        """
+        if not self.enabled:
+            return None
+        path = self._path(disks)
+        if path is None:
+            return None
+        info = self._read(path)
+        missing = [field for field in required if info.get(field) is None]
+        if not info or missing:
+            logging.debug("No cached inspection of %s, missing %s",
+                          disks, missing or "all")
+            return None
+        logging.info("Use cached inspection of %s", disks)
+        return info
+
+    def save(self, disks, info):
+        """
+        Merge info into the cached results of disks.
+
+        Must be called before anything writes to the images, such as
+        starting the guest, or the results are stored for images that
+        no longer have this content.
+        """
+        path = self._path(disks)
+        if path is None:
+            return
+        cached = self._read(path)
+        cached.update(dict((field, value) for field, value in info.items()
+                           if value is not None))
+        tmp_path = "%s.%s" % (path, os.getpid())
+        cache_file = open(tmp_path, "w")
+        try:
+            json.dump(cached, cache_file, indent=4, sort_keys=True)
+        finally:
+            cache_file.close()
+        os.rename(tmp_path, path)
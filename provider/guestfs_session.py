@@ -0,0 +1,246 @@
+"""
+Shared code for guestfish tests that want to reuse launched appliances
+
+Launching the appliance takes several seconds and most test cases only
+run a handful of commands on it. With gf_session_reuse = yes,
+get_guestfish() gives a handle that, once launched on a set of drives,
+is kept alive by close_session() and handed to the next test case adding
+the same drives with the same HANDLE_PARAMS, after unmounting everything
+it left mounted. The handle then works with the params of that test
+case.
+"""
+
+import os
+import atexit
+import logging
+
+from virttest import utils_test
+
+
+class GuestfishPool(object):
+
+    """
+    Launched guestfish handles that are not in use, keyed by their drives.
+    """
+
+    def __init__(self, size=4):
+        """
+        :param size: Number of idle handles kept alive
+        """
+        self.size = size
+        self.pid = os.getpid()
+        # List of (key, identity, handle), least recently used first.
+        self.idle = []
+
+    def _check_pid(self):
+        # A forked worker must not drive the sessions of its parent.
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.idle = []
+
+    def take(self, key, identity):
+        """
+        Take the idle handle launched on key, if the drives have not been
+        changed since it was released.
+
+        :param key: Tuple of run mode, image paths, drive options and values
+                of HANDLE_PARAMS
+        :param identity: Value of _drive_identity() for the drives
+        :return: Tuple of (handle, result of pinging its daemon), handle
+                 is None if there is no usable one
+        """
+        self._check_pid()
+        for item in list(self.idle):
+            if item[0] != key:
+                continue
+            self.idle.remove(item)
+            handle = item[2]
+            if item[1] != identity:
+                logging.debug("Drives of guestfish session changed, "
+                              "close it")
+                handle.close_session()
+                return None, None
+            result = handle.inner_cmd("ping-daemon")
+            if result.exit_status:
+                logging.debug("Guestfish session is gone: %s", result)
+                handle.close_session()
+                return None, None
+            return handle, result
+        # Image locking keeps a new appliance from opening images an idle
+        # one still holds.
+        self.discard(key[1])
+        return None, None
+
+    def discard(self, images):
+        """
+        Close the idle handles using any of images.
+        """
+        self._check_pid()
+        for item in list(self.idle):
+            if set(item[0][1]) & set(images):
+                self.idle.remove(item)
+                item[2].close_session()
+
+    def release(self, key, identity, handle):
+        """
+        Keep handle alive for the next user of key.
+        """
+        self._check_pid()
+        self.idle.append((key, identity, handle))
+        while len(self.idle) > self.size:
+            self.idle.pop(0)[2].close_session()
+
+    def close(self):
+        """
+        Close all idle handles, such as before their images are prepared
+        again.
+        """
+        self._check_pid()
+        while self.idle:
+            self.idle.pop()[2].close_session()
+
+
+POOL = GuestfishPool()
+atexit.register(POOL.close)
+
+
+def _drive_identity(drives):
+    """
+    Get the inode, size and mtime of every drive image, so a handle is not
+    reused on an image that was recreated or written by someone else.
+    """
+    identity = []
+    for _, args, _ in drives:
+        try:
+            stat = os.stat(args[0])
+            identity.append((stat.st_ino, stat.st_size, stat.st_mtime))
+        except (IndexError, OSError):
+            identity.append(None)
+    return tuple(identity)
+
+
+# Params GuestfishTools sets up the guestfish process with, handles are
+# only shared by test cases that agree on them.
+HANDLE_PARAMS = ("gf_run_mode", "gf_inspector", "mount_options")
+
+
+# Commands that change settings or state of the handle or its appliance
+# beyond what umount-all resets, such as set-trace, set-autosync,
+# add-drive-ro or aug-init. A handle they ran on is not pooled.
+STATEFUL_PREFIXES = ("set_", "add_", "config", "setenv", "umask", "aug_",
+                     "hivex_", "journal_", "inotify_", "lvm_set_filter",
+                     "lvm_clear_filter", "mount_local", "debug", "sh",
+                     "internal_")
+
+
+def _changes_state(command):
+    """
+    Check whether a guestfish command or GuestfishTools method changes
+    the handle, see STATEFUL_PREFIXES.
+    """
+    name = command.strip().split(" ", 1)[0].replace("-", "_")
+    return name.startswith(STATEFUL_PREFIXES)
+
+
+class PooledGuestfish(object):
+
+    """
+    Stand in for GuestfishTools that reuses launched appliances of POOL.
+
+    Drives added before run() are recorded. On run() a handle launched on
+    the same drives is taken from the pool, or a new one is launched.
+    Calling any other method before run() gives a plain handle that is
+    never pooled, and so does calling one that changes settings of the
+    handle after run(), as the next test case would inherit them.
+    """
+
+    def __init__(self, params):
+        self._params = params
+        self._drives = []
+        self._key = None
+        self._handle = None
+
+    def _replay(self):
+        handle = utils_test.libguestfs.GuestfishTools(self._params)
+        for method, args, dargs in self._drives:
+            getattr(handle, method)(*args, **dargs)
+        return handle
+
+    def _add(self, method, args, dargs):
+        if self._handle is not None:
+            # The handle no longer matches its key.
+            self._key = None
+            return getattr(self._handle, method)(*args, **dargs)
+        self._drives.append((method, args, dargs))
+
+    def add_drive(self, *args, **dargs):
+        return self._add("add_drive", args, dargs)
+
+    def add_drive_opts(self, *args, **dargs):
+        return self._add("add_drive_opts", args, dargs)
+
+    def run(self):
+        if self._handle is not None:
+            return self._handle.run()
+        key = (self._params.get("gf_run_mode", "interactive"),
+               tuple(args[0] for _, args, _ in self._drives if args),
+               repr(self._drives),
+               tuple(self._params.get(name) for name in HANDLE_PARAMS))
+        identity = _drive_identity(self._drives)
+        handle, result = POOL.take(key, identity)
+        if handle is not None:
+            logging.debug("Reuse guestfish session on %s", key[2])
+            # Its methods read the params of the test case using it.
+            handle.params = self._params
+            self._handle = handle
+            self._key = key
+            return result
+        self._handle = self._replay()
+        result = self._handle.run()
+        self._key = key
+        return result
+
+    def close_session(self):
+        handle, key, drives = self._handle, self._key, self._drives
+        # The test case may add drives and run again.
+        self._handle, self._key, self._drives = None, None, []
+        if handle is None:
+            return
+        if key is None:
+            handle.close_session()
+            return
+        # Leave the appliance as a new one would be: nothing mounted and
+        # all writes on the images.
+        handle.inner_cmd("umount-all")
+        result = handle.inner_cmd("sync")
+        if result.exit_status:
+            handle.close_session()
+            return
+        POOL.release(key, _drive_identity(drives), handle)
+
+    def inner_cmd(self, command):
+        if self._handle is None:
+            self._handle = self._replay()
+        elif _changes_state(command):
+            self._key = None
+        return self._handle.inner_cmd(command)
+
+    def __getattr__(self, name):
+        if self._handle is None:
+            self._handle = self._replay()
+        elif _changes_state(name):
+            self._key = None
+        return getattr(self._handle, name)
+
+
+def get_guestfish(params):
+    """
+    Get a guestfish handle for a test case.
+
+    :return: PooledGuestfish with gf_session_reuse = yes, GuestfishTools
+             otherwise
+    """
+    if params.get("gf_session_reuse", "no") == "yes":
+        POOL.size = int(params.get("gf_session_pool_size", "4"))
+        return PooledGuestfish(params)
+    return utils_test.libguestfs.GuestfishTools(params)
@@ -0,0 +1,355 @@
+"""
+Shared code for libguestfs tests that run a test case on every image
+format and partition type of their params
+"""
+
+import os
+import re
+import json
+import time
+import fcntl
+import shutil
+import hashlib
+import logging
+import tempfile
+
+from autotest.client.shared import utils
+from virttest import data_dir
+
+from provider import guestfs_session
+from provider import parallel_utils
+
+
+def get_combinations(params):
+    """
+    Get all (image_format, partition_type) pairs of params.
+    """
+    return [(image_format, partition_type)
+            for image_format in re.findall(r"\w+", params.get("image_formats"))
+            for partition_type in re.findall(r"\w+",
+                                             params.get("partition_types"))]
+
+
+def clone_image(base_path, clone_path):
+    """
+    Copy base_path to clone_path in the same format, sharing extents with
+    it where the filesystem can and keeping holes elsewhere, so test cases
+    see the image as prepared, without a backing file, and never write to
+    the base.
+
+    :return: Path of the clone
+    """
+    utils.run("cp --reflink=auto --sparse=always %s %s"
+              % (base_path, clone_path))
+    return clone_path
+
+
+# Params that decide the content of a prepared image, see GoldenImageCache.
+CACHE_KEY_PARAMS = ["image_format", "image_size", "partition_type",
+                    "fs_type", "pv_name", "vg_name", "lv_name",
+                    "tarball_file"]
+
+
+class GoldenImageCache(object):
+
+    """
+    Content addressed cache of prepared images.
+
+    An image is built once for each distinct set of CACHE_KEY_PARAMS and
+    kept as <sha1>.<image_format> with a <sha1>.json entry beside it. Test
+    cases never see the cached image itself, only a clone of it, so it is
+    never written to. Least recently used images are removed once the
+    cache grows beyond max_size bytes, except the ones some process holds
+    a shared lock on through <sha1>.lock, see get().
+    """
+
+    def __init__(self, cache_dir, max_size):
+        """
+        :param cache_dir: Directory of the cached images
+        :param max_size: Total size in bytes the images may use on disk
+        """
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    @staticmethod
+    def make_key(params):
+        """
+        Get the key of the image params describe.
+
+        :return: Tuple of (key dict, sha1 of the key)
+        """
+        key = dict((name, params.get(name)) for name in CACHE_KEY_PARAMS)
+        digest = hashlib.sha1(json.dumps(key, sort_keys=True)).hexdigest()
+        return key, digest
+
+    def _entry_path(self, digest):
+        return os.path.join(self.cache_dir, "%s.json" % digest)
+
+    def _lock_path(self, digest):
+        return os.path.join(self.cache_dir, "%s.lock" % digest)
+
+    def _load_entry(self, digest):
+        try:
+            entry_file = open(self._entry_path(digest))
+        except IOError:
+            return None
+        try:
+            try:
+                entry = json.load(entry_file)
+            except ValueError:
+                return None
+        finally:
+            entry_file.close()
+        if not os.path.exists(entry.get("image_path", "")):
+            return None
+        return entry
+
+    def _save_entry(self, digest, entry):
+        path = self._entry_path(digest)
+        tmp_path = "%s.%s" % (path, os.getpid())
+        entry_file = open(tmp_path, "w")
+        try:
+            json.dump(entry, entry_file, indent=4, sort_keys=True)
+        finally:
+            entry_file.close()
+        os.rename(tmp_path, path)
+
+    def _build(self, params, prepare, key, digest):
+        """
+        Prepare the image in a scratch directory and move it into the cache.
+        """
+        build_dir = tempfile.mkdtemp(prefix="build.", dir=self.cache_dir)
+        build_params = params.copy()
+        build_params["img_dir"] = build_dir
+        build_params["image_name"] = digest
+        build_params["gf_create_img_force"] = "yes"
+        try:
+            logging.info("Prepare golden image %s: %s", digest, key)
+            prepare(build_params)
+            image_path = os.path.join(self.cache_dir, "%s.%s"
+                                      % (digest, params["image_format"]))
+            os.rename(build_params["image_path"], image_path)
+        finally:
+            shutil.rmtree(build_dir, ignore_errors=True)
+        return {"key": key, "image_path": image_path,
+                "image_format": params["image_format"],
+                "mount_point": build_params.get("mount_point")}
+
+    def _disk_usage(self, entry):
+        try:
+            return os.stat(entry["image_path"]).st_blocks * 512
+        except OSError:
+            return 0
+
+    def evict(self, keep=None):
+        """
+        Remove least recently used images until the cache fits max_size.
+
+        :param keep: Digest of an image that is never removed
+        """
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(".json"):
+                continue
+            digest = name[:-len(".json")]
+            entry = self._load_entry(digest)
+            if entry is not None:
+                entries.append((entry.get("last_used", 0), digest, entry))
+        total = sum(self._disk_usage(entry) for _, _, entry in entries)
+        for _, digest, entry in sorted(entries):
+            if total <= self.max_size:
+                break
+            if digest == keep:
+                continue
+            lock_file = open(self._lock_path(digest), "a")
+            try:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except IOError:
+                    logging.debug("Golden image %s is in use, keep it",
+                                  entry["image_path"])
+                    continue
+                total -= self._disk_usage(entry)
+                logging.info("Evict golden image %s", entry["image_path"])
+                for path in [self._entry_path(digest), entry["image_path"],
+                             self._lock_path(digest)]:
+                    if os.path.exists(path):
+                        os.remove(path)
+            finally:
+                lock_file.close()
+
+    def get(self, params, prepare):
+        """
+        Get the cached image params describe, preparing it on a miss.
+
+        The image is returned with a shared lock held on it, which keeps
+        other processes from evicting it until the returned lock file is
+        closed.
+
+        :param prepare: Function taking params, which prepares an image
+                        and sets params["image_path"] and mount_point
+        :return: Tuple of (cache entry dict with image_path, image_format
+                 and mount_point, lock file)
+        """
+        key, digest = self.make_key(params)
+        # Hold the lock while building, so parallel workers that need the
+        # same image wait for one build instead of doing their own.
+        lock_file = open(os.path.join(self.cache_dir, ".lock"), "w")
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            entry = self._load_entry(digest)
+            if entry is None:
+                entry = self._build(params, prepare, key, digest)
+            else:
+                logging.debug("Reuse golden image %s", entry["image_path"])
+            entry["last_used"] = time.time()
+            self._save_entry(digest, entry)
+            # Taken before the cache lock is released, evict() only runs
+            # under it.
+            hold_file = open(self._lock_path(digest), "a")
+            fcntl.flock(hold_file, fcntl.LOCK_SH)
+            self.evict(keep=digest)
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+            lock_file.close()
+        return entry, hold_file
+
+
+# Clone path to the lock file holding its golden image in the cache.
+_GOLDEN_HOLDS = {}
+
+
+def cached_prepare(prepare):
+    """
+    Wrap prepare so that it gives a clone of a cached golden image, as
+    configured by params:
+
+    gf_image_cache_dir: Directory of the cache, default in the data dir
+    gf_image_cache_size: Total size of cached images in MB
+
+    The clone is created in img_dir and its path kept in
+    params["gf_image_clone"], remove it with remove_clone(). The golden
+    image is not evicted while the clone exists.
+    """
+    def _prepare(params):
+        cache_dir = params.get("gf_image_cache_dir",
+                               os.path.join(data_dir.get_data_dir(),
+                                            "libguestfs", "image_cache"))
+        max_size = int(params.get("gf_image_cache_size", "10240")) * 1024 ** 2
+        cache = GoldenImageCache(cache_dir, max_size)
+        entry, hold_file = cache.get(params, prepare)
+        img_dir = params.get("img_dir", data_dir.get_tmp_dir())
+        clone_path = os.path.join(img_dir, "%s.%s.clone.%s"
+                                  % (params.get("image_name", "image"),
+                                     params["partition_type"],
+                                     params["image_format"]))
+        try:
+            if os.path.exists(clone_path):
+                os.remove(clone_path)
+            clone_image(entry["image_path"], clone_path)
+        except Exception:
+            hold_file.close()
+            raise
+        _GOLDEN_HOLDS[clone_path] = hold_file
+        params["image_path"] = clone_path
+        params["mount_point"] = entry["mount_point"]
+        params["gf_image_clone"] = clone_path
+    return _prepare
+
+
+def remove_clone(params):
+    """
+    Remove the image test cases worked on in place of the prepared one,
+    if any.
+    """
+    clone_path = params.pop("gf_image_clone", None)
+    if clone_path and os.path.exists(clone_path):
+        os.remove(clone_path)
+    hold_file = _GOLDEN_HOLDS.pop(clone_path, None)
+    if hold_file is not None:
+        hold_file.close()
+
+
+def _run_combination(testcase, vm, params, prepare):
+    """
+    Prepare the image of one combination, then run testcase on a clone of
+    it. Runs in a worker process.
+    """
+    prepare(params)
+    # The image cache already gives a clone.
+    if "gf_image_clone" not in params:
+        base_path = params["image_path"]
+        root, ext = os.path.splitext(base_path)
+        clone_path = clone_image(base_path, "%s.clone%s" % (root, ext))
+        params["image_path"] = clone_path
+        params["gf_image_clone"] = clone_path
+    try:
+        testcase(vm, params)
+    finally:
+        remove_clone(params)
+
+
+def run_combinations(testcase, vm, params, prepare):
+    """
+    Run testcase for every image format and partition type of params.
+
+    By default the combinations run in turn, as before. With
+    gf_parallel_workers greater than 1 they run in that many worker
+    processes. Every combination then uses its own image directory below
+    img_dir, so scratch files of test cases do not collide, and test cases
+    work on a clone of the prepared image in the same format, so the
+    prepared image stays untouched and workers never share writable
+    state.
+
+    With gf_image_cache = yes, prepared images are kept in a
+    GoldenImageCache and test cases work on clones of them, so the image
+    of a combination is only prepared once across runs.
+
+    :param testcase: Function taking (vm, params)
+    :param prepare: Function taking the params of a combination, which
+                    prepares its image and sets params["image_path"]
+    """
+    if params.get("gf_image_cache", "no") == "yes":
+        prepare = cached_prepare(prepare)
+    if params.get("gf_create_img_force", "yes") != "no":
+        # Images are created again, appliances kept alive on the old ones
+        # are of no use and may hold image locks.
+        guestfs_session.POOL.close()
+    combinations = get_combinations(params)
+    workers = int(params.get("gf_parallel_workers", "1"))
+    if workers <= 1:
+        for image_format, partition_type in combinations:
+            params["image_format"] = image_format
+            params["partition_type"] = partition_type
+            prepare(params)
+            try:
+                testcase(vm, params)
+            finally:
+                remove_clone(params)
+        return
+
+    img_dir = params.get("img_dir", data_dir.get_tmp_dir())
+    timeout = params.get("gf_parallel_timeout")
+    if timeout is not None:
+        timeout = int(timeout)
+    tasks = []
+    for image_format, partition_type in combinations:
+        name = "%s.%s" % (image_format, partition_type)
+        combination_dir = os.path.join(img_dir, name)
+        if not os.path.isdir(combination_dir):
+            os.makedirs(combination_dir)
+        combination_params = params.copy()
+        combination_params["image_format"] = image_format
+        combination_params["partition_type"] = partition_type
+        combination_params["img_dir"] = combination_dir
+        tasks.append((name, _run_combination,
+                      (testcase, vm, combination_params, prepare)))
+    logging.info("Run %s combinations in %s worker processes",
+                 len(tasks), workers)
+    results = parallel_utils.run_in_processes(tasks, workers, timeout)
+    for result in results:
+        logging.info("%s: %s in %.1fs %s", result["name"], result["status"],
+                     result["elapsed"], result["detail"])
+    parallel_utils.raise_for_failures(results)
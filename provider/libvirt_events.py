@@ -0,0 +1,200 @@
+"""
+Shared code for tests that need to wait for domain events
+
+Waits watch the output of 'virsh event --all --loop' and check their
+condition again as soon as a matching event arrives, instead of sleeping
+a fixed interval between checks. If virsh can not report events, waits
+fall back to polling.
+"""
+
+import re
+import time
+import logging
+import threading
+import subprocess
+from collections import deque
+
+from virttest import virsh
+
+# Such as "event 'lifecycle' for domain vm1: Stopped Shutdown", newer
+# virsh may print a timestamp before it.
+EVENT_RE = re.compile(r"event '(?P<event>[\w-]+)' for domain "
+                      r"(?P<domain>.+?): (?P<detail>.*)$")
+
+
+def events_supported(uri=None):
+    """
+    Check whether virsh can report events of all types.
+
+    :param uri: Connect uri of virsh
+    """
+    result = virsh.command("event --list", uri=uri, ignore_status=True)
+    return result.exit_status == 0
+
+
+class EventMonitor(object):
+
+    """
+    Run 'virsh event --all --loop' in background and keep recent events.
+    """
+
+    def __init__(self, uri=None, history=1000):
+        """
+        :param uri: Connect uri of virsh
+        :param history: Number of recent events to keep
+        """
+        self.uri = uri
+        self.events = deque(maxlen=history)
+        self.seq = 0
+        self.cond = threading.Condition()
+        self.process = None
+        self.reader = None
+
+    def start(self):
+        """
+        Start watching events.
+
+        :return: True if events are watched, False means waits will poll
+        """
+        if not events_supported(self.uri):
+            logging.warning("virsh event is not supported, waits will "
+                            "poll instead.")
+            return False
+        cmd = [virsh.VIRSH_EXEC]
+        if self.uri:
+            cmd += ["-c", self.uri]
+        cmd += ["event", "--all", "--loop"]
+        self.process = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                        stderr=subprocess.STDOUT)
+        self.reader = threading.Thread(target=self._read_events)
+        self.reader.daemon = True
+        self.reader.start()
+        return True
+
+    def stop(self):
+        """
+        Stop watching events.
+        """
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+            self.process.wait()
+        if self.reader is not None:
+            self.reader.join(5)
+        self.process = None
+        self.reader = None
+
+    def is_alive(self):
+        """
+        Whether events are being watched.
+        """
+        return self.process is not None and self.process.poll() is None
+
+    def _read_events(self):
+        for line in iter(self.process.stdout.readline, ''):
+            mobj = EVENT_RE.search(line.strip())
+            if not mobj:
+                continue
+            event = mobj.groupdict()
+            event["time"] = time.time()
+            self.cond.acquire()
+            try:
+                self.seq += 1
+                event["seq"] = self.seq
+                self.events.append(event)
+                self.cond.notifyAll()
+            finally:
+                self.cond.release()
+        # Wake up waiters so they start polling.
+        self.cond.acquire()
+        try:
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
+
+    def find(self, since=0, domain=None, event=None, detail=None):
+        """
+        Find the first kept event after sequence number since.
+
+        :param since: Only look at events with a greater sequence number
+        :param domain: Domain name of the event, None means any
+        :param event: Regex the event type must match, such as "block-job"
+        :param detail: Regex the event detail must contain
+        :return: Dict of the event, or None
+        """
+        for item in list(self.events):
+            if item["seq"] <= since:
+                continue
+            if domain is not None and item["domain"] != domain:
+                continue
+            if event is not None and not re.match(event, item["event"]):
+                continue
+            if detail is not None and not re.search(detail, item["detail"]):
+                continue
+            return item
+        return None
+
+    def wait_for(self, condition, timeout, domain=None, event=None,
+                 detail=None, step=2.0, recheck=30.0):
+        """
+        Wait until condition() returns True.
+
+        condition is checked at once, then each time a matching event
+        arrives. Without events it is checked every step seconds.
+
+        :param condition: Function returning True when the wait is over
+        :param timeout: Timeout in seconds
+        :param domain, event, detail: Events to react on, see find()
+        :param step: Polling interval in seconds when there is no event
+        :param recheck: Longest time to trust events without checking
+        :return: True if condition is met, False on timeout
+        """
+        end_time = time.time() + timeout
+        while True:
+            since = self.seq
+            if condition():
+                return True
+            remain = end_time - time.time()
+            if remain <= 0:
+                return False
+            if not self.is_alive():
+                time.sleep(min(step, remain))
+                continue
+            wake_time = time.time() + min(recheck, remain)
+            self.cond.acquire()
+            try:
+                # Other events also wake us up, keep waiting for ours.
+                while (self.is_alive() and
+                       self.find(since, domain, event, detail) is None):
+                    left = wake_time - time.time()
+                    if left <= 0:
+                        break
+                    self.cond.wait(left)
+            finally:
+                self.cond.release()
+
+
+def wait_for(condition, timeout, domain=None, event=None, detail=None,
+             step=2.0, uri=None, monitor=None):
+    """
+    Wait until condition() returns True, waking up on domain events.
+
+    :param monitor: Running EventMonitor to use, None means start one
+                    for this wait only
+    :param uri: Connect uri of virsh, used when monitor is None
+    :return: True if condition is met, False on timeout
+
+    Other params are the same as EventMonitor.wait_for().
+    """
+    if monitor is not None:
+        return monitor.wait_for(condition, timeout, domain, event, detail,
+                                step)
+    monitor = EventMonitor(uri)
+    monitor.start()
+    try:
+        # virsh does not tell when it has registered for events, one that
+        # comes before is lost. Check every step seconds anyway, so a lost
+        # event costs no more than polling.
+        return monitor.wait_for(condition, timeout, domain, event, detail,
+                                step, recheck=step)
+    finally:
+        monitor.stop()
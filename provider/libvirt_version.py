@@ -1,13 +1,191 @@
 """
 Shared code for tests that need to get the libvirt version
+
+'virsh version' is run once and every component it reports is parsed:
+the library virsh was compiled against, the library in use, the API,
+the hypervisor and the daemon. The result is cached in memory and on
+disk, so later test processes do not fork virsh again. The disk cache
+is keyed by the inode and mtime of the virsh, libvirtd and qemu binaries,
+so it is invalidated as soon as any of them is upgraded.
 """
 
 from virttest import virsh
+from virttest import data_dir
+import os
 import re
+import json
 import logging
+import platform
 
 LIBVIRT_LIB_VERSION = 0
 
+# Parsed versions of this process, see get_versions().
+VERSIONS = {}
+
+# Patterns of the 'virsh version' lines, keyed by component.
+VERSION_PATTERNS = {
+    "compiled": r'[Cc]ompiled\s*against\s*[Ll]ibrary:\s*[Ll]ibvirt\s*',
+    "library": r'[Uu]sing\s*[Ll]ibrary:\s*[Ll]ibvirt\s*',
+    "api": r'[Uu]sing\s*API:\s*(?P<name>\S+)\s*',
+    "hypervisor": r'[Rr]unning\s*hypervisor:\s*(?P<name>\S+)\s*',
+    "daemon": r'[Rr]unning\s*against\s*daemon:\s*'}
+VERSION_NUMBER = r'(?P<major>\d+)\.(?P<minor>\d+)(?:\.(?P<update>\d+))?'
+
+CACHE_FILE = "libvirt_version.json"
+QEMU_BINARIES = ["/usr/libexec/qemu-kvm", "qemu-kvm",
+                 "qemu-system-%s" % platform.machine()]
+
+
+def _find_binary(name):
+    """
+    Get the path of an executable, searching PATH for bare names.
+    """
+    if os.path.isabs(name):
+        if os.path.exists(name):
+            return name
+        return None
+    for path_dir in os.environ.get("PATH", "").split(os.pathsep):
+        path = os.path.join(path_dir, name)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def _cache_key():
+    """
+    Get the key of the disk cache: the connect uri and the inode and
+    mtime of the binaries reporting the versions.
+    """
+    key = {"uri": os.environ.get("LIBVIRT_DEFAULT_URI", "")}
+    for name in [virsh.VIRSH_EXEC, "libvirtd"] + QEMU_BINARIES:
+        path = _find_binary(name)
+        if path is None:
+            continue
+        stat = os.stat(path)
+        key[path] = "%s:%s" % (stat.st_ino, int(stat.st_mtime))
+    return key
+
+
+def _cache_path():
+    return os.path.join(data_dir.get_tmp_dir(), CACHE_FILE)
+
+
+def _load_cache(key):
+    """
+    Get the versions in the disk cache, if they are for key.
+    """
+    try:
+        cache_file = open(_cache_path())
+    except IOError:
+        return None
+    try:
+        try:
+            cache = json.load(cache_file)
+        except ValueError:
+            return None
+    finally:
+        cache_file.close()
+    if cache.get("key") != key:
+        return None
+    return cache.get("versions")
+
+
+def _save_cache(key, versions):
+    """
+    Save versions in the disk cache, ignoring errors.
+    """
+    path = _cache_path()
+    tmp_path = "%s.%s" % (path, os.getpid())
+    try:
+        cache_file = open(tmp_path, "w")
+        try:
+            json.dump({"key": key, "versions": versions}, cache_file)
+        finally:
+            cache_file.close()
+        # Rename is atomic, so parallel test processes never read
+        # a partly written cache.
+        os.rename(tmp_path, path)
+    except (IOError, OSError), detail:
+        logging.debug("Failed to cache libvirt version: %s", detail)
+
+
+def parse_versions(output):
+    """
+    Parse the output of 'virsh version'.
+
+    :param output: Output of 'virsh version'
+    :return: Dict of component to version as major * 1000000 +
+             minor * 1000 + update, with api_name and hypervisor_name
+    """
+    versions = {}
+    for component, pattern in VERSION_PATTERNS.items():
+        mobj = re.search(pattern + VERSION_NUMBER, output)
+        if not mobj:
+            continue
+        versions[component] = (int(mobj.group("major")) * 1000000 +
+                               int(mobj.group("minor")) * 1000 +
+                               int(mobj.group("update") or 0))
+        if "name" in mobj.groupdict():
+            versions["%s_name" % component] = mobj.group("name")
+    return versions
+
+
+def get_versions():
+    """
+    Get the versions of all libvirt components, from memory, from the disk
+    cache or from 'virsh version' in that order.
+
+    :return: Dict returned by parse_versions(), empty on error
+    """
+    global LIBVIRT_LIB_VERSION
+
+    if VERSIONS:
+        return VERSIONS
+    key = _cache_key()
+    versions = _load_cache(key)
+    if not versions:
+        try:
+            versions = parse_versions(virsh.version().stdout)
+        except (ValueError, TypeError, AttributeError):
+            logging.warning("Error determining libvirt version")
+            return {}
+        # Do not cache a failure, such as libvirtd not running.
+        if versions.get("library"):
+            _save_cache(key, versions)
+    VERSIONS.update(versions)
+    LIBVIRT_LIB_VERSION = VERSIONS.get("library", 0)
+    return VERSIONS
+
+
+def get_lib_version():
+    """
+    Determine the current libvirt library version on the system.
+
+    :return: Version as major * 1000000 + minor * 1000 + update,
+             0 if the version can not be determined
+    """
+    return get_versions().get("library", 0)
+
+
+def get_daemon_version():
+    """
+    Get the version of the running libvirtd, 0 if unknown.
+    """
+    return get_versions().get("daemon", 0)
+
+
+def get_hypervisor_version():
+    """
+    Get the version of the running hypervisor, such as QEMU, 0 if unknown.
+    """
+    return get_versions().get("hypervisor", 0)
+
+
+def _compare(version, major, minor, update):
+    if version == 0:
+        return False
+    return version >= major * 1000000 + minor * 1000 + update
+
 
 def version_compare(major, minor, update):
     """
@@ -26,26 +204,21 @@ def version_compare(major, minor, update):
     :return: True if running version is greater than or
                   equal to the input libvirt version
     """
-    global LIBVIRT_LIB_VERSION
+    return _compare(get_lib_version(), major, minor, update)
 
-    if LIBVIRT_LIB_VERSION == 0:
-        try:
-            regex = r'[Uu]sing\s*[Ll]ibrary:\s*[Ll]ibvirt\s*'
-            regex += r'(\d+)\.(\d+)\.(\d+)'
-            lines = virsh.version().stdout.splitlines()
-            for line in lines:
-                mobj = re.search(regex, line)
-                if bool(mobj):
-                    LIBVIRT_LIB_VERSION = int(mobj.group(1)) * 1000000 + \
-                        int(mobj.group(2)) * 1000 + \
-                        int(mobj.group(3))
-                    break
-        except (ValueError, TypeError, AttributeError):
-            logging.warning("Error determining libvirt version")
-            return False
 
-    compare_version = major * 1000000 + minor * 1000 + update
+def daemon_version_compare(major, minor, update):
+    """
+    Same as version_compare(), for the version of the running libvirtd.
+    """
+    return _compare(get_daemon_version(), major, minor, update)
 
-    if LIBVIRT_LIB_VERSION >= compare_version:
-        return True
-    return False
+
+def qemu_version_compare(major, minor, update):
+    """
+    Same as version_compare(), for the version of the running QEMU.
+    False if the hypervisor is not QEMU.
+    """
+    if get_versions().get("hypervisor_name", "").upper() != "QEMU":
+        return False
+    return _compare(get_hypervisor_version(), major, minor, update)
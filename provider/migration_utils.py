@@ -0,0 +1,255 @@
+"""
+Shared code for migration tests that need the statistics of migration jobs
+
+virsh domjobinfo prints one "Name: value unit" line per statistic.
+parse_domjobinfo() turns them into a dict keyed by the lower case name
+with underscores, such as data_processed, with sizes in bytes, rates in
+bytes per second and times in milliseconds. JobInfoSampler polls them
+while jobs run, to see how a migration converges, not only how it ended.
+"""
+
+import re
+import time
+import logging
+import threading
+
+from virttest import virsh
+
+# Multipliers of the size units of domjobinfo.
+SIZE_UNITS = {"B": 1, "bytes": 1, "KiB": 1024, "MiB": 1024 ** 2,
+              "GiB": 1024 ** 3, "TiB": 1024 ** 4}
+# "1.234 GiB", "100.000 MiB/s", "1234 ms" or "42"
+VALUE_RE = re.compile(r"^(-?\d+(?:\.\d+)?)\s*(\w+)?(/s)?$")
+
+
+def parse_value(value):
+    """
+    Convert a domjobinfo value to a number in bytes, bytes per second or
+    milliseconds.
+
+    :return: int or float, the value as is if it is not a number
+    """
+    mobj = VALUE_RE.match(value.strip())
+    if not mobj:
+        return value.strip()
+    number, unit, rate = mobj.groups()
+    number = float(number) if "." in number else int(number)
+    if unit in SIZE_UNITS:
+        number = number * SIZE_UNITS[unit]
+        if not rate:
+            # Sizes are printed rounded, whole bytes are close enough.
+            number = int(number)
+    return number
+
+
+def parse_domjobinfo(output):
+    """
+    Parse the output of virsh domjobinfo.
+
+    :return: Dict of statistic name to value, empty if there is no job
+    """
+    info = {}
+    for line in output.splitlines():
+        if ":" not in line:
+            continue
+        name, value = line.split(":", 1)
+        name = re.sub(r"\W+", "_", name.strip().lower()).strip("_")
+        if name:
+            info[name] = parse_value(value)
+    if info.get("job_type") == "None":
+        return {}
+    return info
+
+
+def get_domjobinfo(vm_name, completed=False, virsh_instance=virsh, **dargs):
+    """
+    Get the statistics of the migration job of vm_name.
+
+    :param completed: Get the statistics of the last completed job
+    :param virsh_instance: virsh module or a Virsh instance to run with
+    :param dargs: Passed to virsh, such as uri of the destination
+    :return: Value of parse_domjobinfo(), empty if it failed
+    """
+    vm_ref = vm_name
+    if completed:
+        vm_ref += " --completed"
+    result = virsh_instance.domjobinfo(vm_ref, ignore_status=True, **dargs)
+    if result.exit_status:
+        logging.debug("domjobinfo of %s failed: %s", vm_name,
+                      result.stderr.strip())
+        return {}
+    return parse_domjobinfo(result.stdout)
+
+
+def get_transferred(info):
+    """
+    Get the bytes a migration job sent, from the output of
+    parse_domjobinfo().
+    """
+    if "data_processed" in info:
+        return info["data_processed"]
+    return (info.get("memory_processed", 0) +
+            info.get("file_processed", 0))
+
+
+# Statistics JobInfoSampler keeps a column for, the ones convergence
+# depends on.
+SAMPLED_FIELDS = ("time_elapsed", "data_processed", "data_remaining",
+                  "data_total", "memory_processed", "memory_remaining",
+                  "memory_bandwidth", "dirty_rate", "iteration",
+                  "expected_downtime", "compression_cache",
+                  "compressed_data", "compressed_pages",
+                  "compression_cache_misses", "compression_overflows",
+                  "file_processed", "file_remaining", "file_total")
+# Progress of virsh blockjob --info, such as "Block Copy: [ 45 %]"
+BLOCKJOB_RE = re.compile(r"^(.+?):\s*\[\s*(\d+(?:\.\d+)?)\s*%\s*\]")
+
+
+def convergence_summary(columns):
+    """
+    Summarize the columns of one migration job sampled by JobInfoSampler.
+
+    A converging migration sends memory faster than the guest dirties it,
+    so data_remaining goes down from one sample to the next. The slope is
+    taken over the second half of the samples, where a migration that
+    never converges has data_remaining flat or growing.
+
+    :return: Dict with samples, last iteration, first, minimum and last
+             data_remaining, its slope in bytes per second, mean memory
+             bandwidth and dirty rate, and compression cache hit ratio
+    """
+    times = columns.get("time", [])
+    summary = {"samples": len(times)}
+    remaining = [(stamp, value) for stamp, value in
+                 zip(times, columns.get("data_remaining", []))
+                 if value is not None]
+    iterations = [value for value in columns.get("iteration", [])
+                  if value is not None]
+    summary["iterations"] = iterations and max(iterations) or None
+    summary["remaining_slope"] = None
+    if remaining:
+        values = [value for _, value in remaining]
+        summary.update({"remaining_first": values[0],
+                        "remaining_min": min(values),
+                        "remaining_last": values[-1]})
+        tail = remaining[len(remaining) // 2:]
+        if len(tail) > 1 and tail[-1][0] > tail[0][0]:
+            summary["remaining_slope"] = ((tail[-1][1] - tail[0][1]) /
+                                          (tail[-1][0] - tail[0][0]))
+    for field in ["memory_bandwidth", "dirty_rate"]:
+        values = [value for value in columns.get(field, [])
+                  if isinstance(value, (int, float))]
+        summary[field] = values and sum(values) / float(len(values)) or None
+    pages = [value for value in columns.get("compressed_pages", [])
+             if value is not None]
+    misses = [value for value in columns.get("compression_cache_misses", [])
+              if value is not None]
+    summary["cache_hit_ratio"] = None
+    if pages and misses and pages[-1] + misses[-1]:
+        summary["cache_hit_ratio"] = (pages[-1] /
+                                      float(pages[-1] + misses[-1]))
+    return summary
+
+
+class JobInfoSampler(object):
+
+    """
+    Poll domjobinfo of some vms, and optionally blockjob --info of some of
+    their disks, in a thread while their jobs run.
+
+    The samples of every job are stored by column, time and one list per
+    statistic, so a series can be plotted or compared without walking
+    samples.
+    """
+
+    def __init__(self, vm_names, interval=1.0, block_disks=None,
+                 virsh_instance=virsh, **dargs):
+        """
+        :param vm_names: Names of the vms to poll domjobinfo of
+        :param interval: Seconds between polls
+        :param block_disks: List of (vm name, disk target) to poll
+                            blockjob --info of
+        :param virsh_instance: virsh module or a Virsh instance to run with
+        :param dargs: Passed to virsh, such as uri
+        """
+        self.vm_names = vm_names
+        self.interval = interval
+        self.block_disks = block_disks or []
+        self.virsh_instance = virsh_instance
+        self.dargs = dargs
+        # Job name to dict of column name to list of values
+        self.jobs = {}
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.start_time = None
+
+    def _append(self, job, row):
+        columns = self.jobs.get(job)
+        if columns is None:
+            columns = self.jobs[job] = {"time": []}
+        count = len(columns["time"])
+        for name, value in row.items():
+            # Columns showing up late are padded to the same length.
+            columns.setdefault(name, [None] * count).append(value)
+        for name, values in columns.items():
+            if len(values) == count:
+                values.append(None)
+
+    def _poll_domjob(self, vm_name, now):
+        info = get_domjobinfo(vm_name, virsh_instance=self.virsh_instance,
+                              **self.dargs)
+        if not info:
+            return
+        row = {"time": now, "job_type": info.get("job_type")}
+        for field in SAMPLED_FIELDS:
+            if field in info:
+                row[field] = info[field]
+        self._append(vm_name, row)
+
+    def _poll_blockjob(self, vm_name, disk, now):
+        result = self.virsh_instance.blockjob(vm_name, disk, "--info",
+                                              ignore_status=True,
+                                              **self.dargs)
+        mobj = BLOCKJOB_RE.search(result.stdout.strip())
+        if result.exit_status or not mobj:
+            return
+        self._append("%s/%s" % (vm_name, disk),
+                     {"time": now, "job_type": mobj.group(1).strip(),
+                      "progress_percent": float(mobj.group(2))})
+
+    def _run(self):
+        while not self.stop_event.is_set():
+            now = time.time() - self.start_time
+            try:
+                for vm_name in self.vm_names:
+                    self._poll_domjob(vm_name, now)
+                for vm_name, disk in self.block_disks:
+                    self._poll_blockjob(vm_name, disk, now)
+            except Exception, detail:
+                logging.warning("Stop sampling jobs: %s", detail)
+                return
+            self.stop_event.wait(self.interval)
+
+    def start(self):
+        self.start_time = time.time()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stop sampling.
+
+        :return: Dict of job name, the vm name or vm/disk for block jobs,
+                 to a dict with its columns and for migration jobs their
+                 convergence_summary()
+        """
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+        report = {}
+        for job, columns in self.jobs.items():
+            report[job] = {"columns": columns}
+            if "data_remaining" in columns or "iteration" in columns:
+                report[job]["summary"] = convergence_summary(columns)
+        return report
@@ -0,0 +1,122 @@
+"""
+Shared code for tests that need to run independent tasks in a bounded
+pool of worker processes
+"""
+
+import time
+import Queue
+import pickle
+import logging
+import multiprocessing
+
+from autotest.client.shared import error
+
+
+def _run_task(result_queue, name, func, args):
+    """
+    Run func(*args) and put its result into result_queue.
+
+    Exceptions are caught here so that a failing task never hides the
+    results of the others.
+    """
+    result = {"name": name, "status": "PASS", "detail": "", "value": None}
+    start = time.time()
+    try:
+        result["value"] = func(*args)
+    except error.TestNAError, detail:
+        result["status"] = "SKIP"
+        result["detail"] = str(detail)
+    except Exception, detail:
+        result["status"] = "FAIL"
+        result["detail"] = "%s: %s" % (detail.__class__.__name__, detail)
+    result["elapsed"] = time.time() - start
+    try:
+        pickle.dumps(result["value"])
+    except Exception, detail:
+        # The return value can not be sent back, keep the status.
+        result["value"] = None
+        result["detail"] += " (value dropped: %s)" % detail
+    result_queue.put(result)
+
+
+def run_in_processes(tasks, workers, timeout=None):
+    """
+    Run tasks in worker processes, at most workers of them at a time.
+
+    Each task runs in a forked process, so it gets its own copy of the
+    caller's state and nothing it changes leaks into other tasks.
+
+    :param tasks: List of (name, func, args) tuples, names must be unique
+    :param workers: Maximum number of processes running at once
+    :param timeout: Seconds a task may run before it is terminated,
+                    None means no limit
+    :return: List of result dicts in the order of tasks, with name,
+             status (PASS, FAIL, SKIP, TIMEOUT or ERROR), detail, elapsed
+             and value, the return value of func
+    """
+    result_queue = multiprocessing.Queue()
+    pending = list(tasks)
+    running = {}
+    results = {}
+    workers = max(int(workers), 1)
+
+    def _collect(wait):
+        # Wait for one result, then take all that are already there.
+        try:
+            result = result_queue.get(timeout=wait)
+            while True:
+                results[result["name"]] = result
+                result = result_queue.get_nowait()
+        except Queue.Empty:
+            pass
+
+    while pending or running:
+        while pending and len(running) < workers:
+            name, func, args = pending.pop(0)
+            process = multiprocessing.Process(target=_run_task,
+                                              args=(result_queue, name,
+                                                    func, args))
+            process.start()
+            running[name] = (process, time.time())
+            logging.debug("Started task %s in process %s", name,
+                          process.pid)
+        # Drain results before joining, a process does not exit while
+        # its result is still in the pipe.
+        _collect(1)
+        for name, (process, start) in running.items():
+            if name in results:
+                process.join()
+                del running[name]
+            elif not process.is_alive():
+                _collect(1)
+                process.join()
+                del running[name]
+                if name not in results:
+                    results[name] = {"name": name, "status": "ERROR",
+                                     "detail": "Process exited with %s" %
+                                               process.exitcode,
+                                     "elapsed": time.time() - start,
+                                     "value": None}
+            elif timeout is not None and time.time() - start > timeout:
+                process.terminate()
+                process.join()
+                del running[name]
+                results[name] = {"name": name, "status": "TIMEOUT",
+                                 "detail": "No result in %s seconds" %
+                                           timeout,
+                                 "elapsed": time.time() - start,
+                                 "value": None}
+    return [results[name] for name, _, _ in tasks]
+
+
+def raise_for_failures(results):
+    """
+    Raise TestFail listing every failed task of run_in_processes().
+    """
+    err_msg = ""
+    for result in results:
+        if result["status"] in ["FAIL", "TIMEOUT", "ERROR"]:
+            err_msg += ("%s %s: %s\n" % (result["name"], result["status"],
+                                         result["detail"]))
+    if err_msg:
+        raise error.TestFail(err_msg)